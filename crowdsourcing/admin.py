@@ -7,7 +7,7 @@ from django.forms.widgets import Select
 from django.utils.translation import ugettext_lazy as _
 
 from crowdsourcing.models import (
-    Question, Survey, Answer, Section, Submission,
+    Question, Survey, Answer, Section, Submission, SurveyEmail,
     SurveyReport, SurveyReportDisplay, OPTION_TYPE_CHOICES,
     SURVEY_DISPLAY_TYPE_CHOICES,
     SURVEY_AGGREGATE_TYPE_CHOICES
@@ -124,6 +124,17 @@ class SubmissionAdmin(admin.ModelAdmin):
 
 admin.site.register(Submission, SubmissionAdmin)
 
+
+class SurveyEmailAdmin(admin.ModelAdmin):
+    raw_id_fields = ('submission',)
+    list_display = ('recipient', 'created_at', 'sent_at', 'attempts',)
+    list_filter = ('sent_at', 'created_at',)
+    search_fields = ('recipient',)
+    date_hierarchy = 'created_at'
+
+
+admin.site.register(SurveyEmail, SurveyEmailAdmin)
+
 SDTC = SURVEY_DISPLAY_TYPE_CHOICES
 TEXT = SDTC.TEXT
 PIE = SDTC.PIE
@@ -31,9 +31,14 @@ from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
 from .fields import RankedChoiceField
-from .geo import get_latitude_and_longitude
-from .models import OPTION_TYPE_CHOICES, Answer, Submission
-from .settings import VIDEO_URL_PATTERNS
+from .models import (
+    OPTION_TYPE_CHOICES,
+    Answer,
+    Submission,
+    geocode,
+    survey_version)
+from .profiling import record_cache
+from .settings import DEFER_GEOCODING, VIDEO_URL_PATTERNS
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
@@ -45,6 +50,10 @@ except ImportError:
 
 
 class BaseAnswerForm(Form):
+    # True for the classes compile_form_class builds, whose answer field
+    # already has everything _configure_answer_field would set on it.
+    precompiled = False
+
     def __init__(self,
                  question,
                  session_key,
@@ -55,7 +64,8 @@ class BaseAnswerForm(Form):
         self.session_key = session_key
         self.submission = submission
         super(BaseAnswerForm, self).__init__(*args, **kwargs)
-        self._configure_answer_field()
+        if not self.precompiled:
+            self._configure_answer_field()
 
     def _configure_answer_field(self):
         answer = self.fields['answer']
@@ -168,7 +178,10 @@ class LocationAnswer(BaseAnswerForm):
     def save(self, commit=True):
         obj = super(LocationAnswer, self).save(commit=False)
         if obj.value:
-            obj.latitude, obj.longitude = get_latitude_and_longitude(obj.value)
+            # With deferred geocoding we only use addresses we already know
+            # and leave the rest to ./manage.py geocode_answers.
+            lookup = not DEFER_GEOCODING
+            obj.latitude, obj.longitude = geocode(obj.value, lookup=lookup)
             if commit:
                 obj.save()
             return obj
@@ -178,6 +191,8 @@ class LocationAnswer(BaseAnswerForm):
 class BaseOptionAnswer(BaseAnswerForm):
     def __init__(self, *args, **kwargs):
         super(BaseOptionAnswer, self).__init__(*args, **kwargs)
+        if self.precompiled:
+            return
         options = self.question.parsed_options
         # appendChoiceButtons in survey.js duplicates this. jQuery and django
         # use " for html attributes, so " will mess them up.
@@ -359,6 +374,43 @@ class SubmissionFormFilter(SurveyFormFilter):
         return filter_kwargs
 
 
+class SurveyFormPlan(object):
+    """ The questions of a survey in order along with an answer form class
+    for each one. Building the plan is the same work for every request, so
+    get_form_plan keeps one per survey until a question changes. """
+
+    def __init__(self, survey, version):
+        self.version = version
+        self.questions = list(survey.questions.order_by("order"))
+        self.form_classes = [compile_form_class(q) for q in self.questions]
+
+    def __iter__(self):
+        return iter(zip(self.questions, self.form_classes))
+
+
+_form_plans = {}
+
+
+def get_form_plan(survey):
+    version = survey_version(survey.id)
+    plan = _form_plans.get(survey.id)
+    stale = plan is None or plan.version != version
+    record_cache(not stale)
+    if stale:
+        plan = _form_plans[survey.id] = SurveyFormPlan(survey, version)
+    return plan
+
+
+def compile_form_class(question):
+    """ Return a subclass of the question's answer form with the answer field
+    configured for the question, choices and all, so instances only have to
+    bind data. """
+    form_class = QTYPE_FORM[question.option_type]
+    answer = form_class(question=question, session_key="").fields['answer']
+    name = "%sForQuestion%d" % (form_class.__name__, question.id)
+    return type(str(name), (form_class,), dict(answer=answer, precompiled=True))
+
+
 def forms_for_survey(survey, request='testing', submission=None):
     testing = bool(request == 'testing')
     session_key = "" if testing or not request.user.is_authenticated() else request.session.session_key.lower()
@@ -366,8 +418,9 @@ def forms_for_survey(survey, request='testing', submission=None):
     files = None if testing else request.FILES or None
     main_form = SubmissionForm(survey, data=post, files=files)
     forms = [main_form]
-    for q in survey.questions.all().order_by("order"):
-        forms.append(_form_for_question(q, session_key, submission, post, files))
+    for q, form_class in get_form_plan(survey):
+        forms.append(_form_for_question(q, session_key, submission, post, files,
+                                        form_class=form_class))
     return forms
 
 
@@ -375,11 +428,14 @@ def _form_for_question(question,
                        session_key="",
                        submission=None,
                        data=None,
-                       files=None):
-    return QTYPE_FORM[question.option_type](
+                       files=None,
+                       form_class=None):
+    if form_class is None:
+        form_class = QTYPE_FORM[question.option_type]
+    return form_class(
         question=question,
         session_key=session_key,
         submission=submission,
-        prefix='%s_%s' % (question.survey.id, question.id),
+        prefix='%s_%s' % (question.survey_id, question.id),
         data=data,
         files=files)
@@ -1,6 +1,4 @@
-import cStringIO
 import logging
-import sys
 
 try:
     import geopy
@@ -18,18 +16,13 @@ def get_latitude_and_longitude(location):
         g = geopy.geocoders.Google(google_key)
     else:
         g = geopy.geocoders.GeoNames(output_format='json')
-    oldstdout = sys.stdout
     try:
-        sys.stdout = cStringIO.StringIO()
-        try:
-            some = list(g.geocode(location, exactly_one=False))
-            if some:
-                place, (lat, long) = some[0]
-            else:
-                lat = long = None
-        except Exception as ex:
-            logging.exception("error in geocoding: %s" % str(ex))
+        some = list(g.geocode(location, exactly_one=False))
+        if some:
+            place, (lat, long) = some[0]
+        else:
             lat = long = None
-    finally:
-        sys.stdout = oldstdout
+    except Exception as ex:
+        logging.exception("error in geocoding: %s" % str(ex))
+        lat = long = None
     return lat, long
@@ -0,0 +1,267 @@
+from __future__ import absolute_import
+
+import json
+import platform
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.backends.utils import CursorDebugWrapper
+from django.test import RequestFactory
+from django.utils import timezone
+
+from crowdsourcing import views
+from crowdsourcing.forms import forms_for_survey
+from crowdsourcing.models import (
+    FORMAT_CHOICES,
+    OPTION_TYPE_CHOICES,
+    ROLLUP_OPTION_TYPES,
+    AggregateResult2AxisCount,
+    AggregateResultAverage,
+    AggregateResultCount,
+    AggregateResultSum,
+    Submission,
+    Survey,
+    extra_from_filters,
+    remember_geocode)
+from crowdsourcing.profiling import profile
+
+OTC = OPTION_TYPE_CHOICES
+
+
+class _RecordingCursor(CursorDebugWrapper):
+    """ Keep each statement with its parameters so that it can be run again
+    under EXPLAIN. The debug log only has the statement with the parameters
+    filled in, which can't always run as is. """
+
+    def execute(self, sql, params=None):
+        self.db._benchmark_statements.append((sql, params))
+        return super(_RecordingCursor, self).execute(sql, params)
+
+
+class Command(BaseCommand):
+    help = ("Time crowdsourcing's hot paths against a survey, like one from "
+            "./manage.py generate_survey_data, and save the timings as JSON "
+            "to compare between versions.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey', help="The slug of the survey.")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--output', default="crowdsourcing-benchmark.json")
+        parser.add_argument('--compare', default="",
+                            help="A JSON file from an earlier run to compare "
+                                 "against.")
+        parser.add_argument('--explain', action='store_true',
+                            help="Save the query plan of every SELECT, to "
+                                 "compare between schemas and indexes.")
+
+    def handle(self, *args, **options):
+        try:
+            self.survey = Survey.objects.get(slug=options['survey'])
+        except Survey.DoesNotExist:
+            raise CommandError("There's no survey %s." % options['survey'])
+        self.repeat = options['repeat']
+        self.explain = options['explain']
+        self.factory = RequestFactory()
+        self.results = {}
+        self.questions = dict((q.option_type, q)
+                              for q in self.survey.questions.all())
+        self.benchmark_submit()
+        self.benchmark_report()
+        self.benchmark_aggregates()
+        self.benchmark_filters()
+        self.benchmark_location_results()
+        self.benchmark_exports()
+        output = dict(
+            survey=self.survey.slug,
+            submissions=self.survey.submission_set.count(),
+            database=connection.vendor,
+            python=platform.python_version(),
+            ran_at=timezone.now().isoformat(),
+            repeat=self.repeat,
+            results=self.results)
+        with open(options['output'], "w") as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        self.stdout.write("Wrote %s." % options['output'])
+        if options['compare']:
+            self.compare(options['compare'])
+
+    def time(self, name, func):
+        """ Run func self.repeat times and record how long it took and how
+        many queries it ran. Record the error instead if it fails. """
+        timings = []
+        try:
+            for i in range(self.repeat):
+                with profile(name, force=True) as current:
+                    started = time.time()
+                    func()
+                    timings.append(time.time() - started)
+        except Exception as ex:
+            self.results[name] = dict(error="%s: %s" % (type(ex).__name__, ex))
+            self.stderr.write("%s failed: %s" % (name, ex))
+            return
+        timings.sort()
+        self.results[name] = dict(min=timings[0],
+                                  median=timings[len(timings) / 2],
+                                  mean=sum(timings) / len(timings),
+                                  queries=current.queries,
+                                  db_time=current.db_time)
+        self.stdout.write("%s: %.4fs median, %d queries" % (
+            name, timings[len(timings) / 2], current.queries))
+        if self.explain:
+            self.results[name]["plans"] = self.plans(func)
+
+    def plans(self, func):
+        """ Run func once more and return the query plans of its SELECTs. """
+        connection._benchmark_statements = []
+        make_debug_cursor = connection.make_debug_cursor
+        connection.make_debug_cursor = (
+            lambda cursor: _RecordingCursor(cursor, connection))
+        was = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        try:
+            func()
+        finally:
+            connection.make_debug_cursor = make_debug_cursor
+            connection.force_debug_cursor = was
+        if connection.vendor == "sqlite":
+            explain = "EXPLAIN QUERY PLAN "
+        else:
+            explain = "EXPLAIN "
+        plans = []
+        for sql, params in connection._benchmark_statements:
+            if not sql.lstrip().upper().startswith("SELECT"):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute(explain + sql, params)
+                rows = cursor.fetchall()
+            plans.append(dict(sql=sql,
+                              plan=[" ".join(u"%s" % v for v in row)
+                                    for row in rows]))
+        del connection._benchmark_statements
+        return plans
+
+    def request(self, path="/", data=None, method="get"):
+        request = getattr(self.factory, method)(path, data or {})
+        request.user = AnonymousUser()
+        SessionMiddleware().process_request(request)
+        return request
+
+    def benchmark_submit(self):
+        def submit():
+            data = {}
+            for form in forms_for_survey(self.survey)[1:]:
+                question = form.question
+                key = form.add_prefix("answer")
+                if question.option_type in (OTC.SELECT, OTC.CHOICE):
+                    data[key] = question.parsed_options[0]
+                elif question.option_type in (OTC.INTEGER, OTC.FLOAT):
+                    data[key] = "42"
+                elif question.option_type in (OTC.CHAR, OTC.TEXT):
+                    data[key] = "benchmark"
+            request = self.request(self.survey.get_absolute_url(), data,
+                                   method="post")
+            # Leave the survey as it was.
+            with transaction.atomic():
+                views.survey_detail(request, self.survey.slug)
+                transaction.set_rollback(True)
+
+        self.time("submit", submit)
+
+    def benchmark_report(self):
+        def report():
+            views.survey_report(self.request(), self.survey.slug)
+
+        self.time("report", report)
+
+    def benchmark_aggregates(self):
+        for question in self.questions.values():
+            if question.option_type in ROLLUP_OPTION_TYPES:
+                self.time(
+                    "AggregateResultCount.%s" % question.fieldname,
+                    lambda: AggregateResultCount(self.survey, question, {}))
+        x_axis = self.questions.get(OTC.SELECT)
+        y_axes = [self.questions[ot] for ot in (OTC.INTEGER, OTC.FLOAT)
+                  if ot in self.questions]
+        if not x_axis or not y_axes:
+            return
+        for aggregate in (AggregateResultSum,
+                          AggregateResultAverage,
+                          AggregateResult2AxisCount):
+            self.time(aggregate.__name__,
+                      lambda: aggregate(y_axes, x_axis, {}))
+
+    def benchmark_filters(self):
+        """ Time a report filter on each kind of value column. """
+        gets = []
+        for ot in (OTC.SELECT, OTC.NUMERIC_SELECT, OTC.BOOL):
+            question = self.questions.get(ot)
+            if question and question.use_as_filter:
+                value = question.parsed_options[0] if question.options else "1"
+                gets.append((ot, {question.fieldname: value}))
+        question = self.questions.get(OTC.INTEGER)
+        if question and question.use_as_filter:
+            gets.append((question.option_type,
+                         {question.fieldname + "_from": "10",
+                          question.fieldname + "_to": "50"}))
+        question = self.questions.get(OTC.LOCATION)
+        located = []
+        if question and question.use_as_filter:
+            located = question.answer_set.exclude(latitude=None)
+            located = located.values_list("text_answer",
+                                          "latitude",
+                                          "longitude")[:1]
+        if located:
+            address, lat, lng = located[0]
+            # Don't time the geocoder.
+            remember_geocode(address, lat, lng)
+            gets.append(("distance",
+                         {question.fieldname + "_location": address,
+                          question.fieldname + "_within": "10"}))
+        for name, get in gets:
+            self.time("filter.%s" % name, lambda: list(extra_from_filters(
+                self.survey.submission_set.all(),
+                Submission.get_id_field(),
+                self.survey,
+                get).values_list("id", flat=True)))
+
+    def benchmark_location_results(self):
+        question = self.questions.get(OTC.LOCATION)
+        if not question:
+            return
+
+        def location_results():
+            views.location_question_results(self.request(), question.pk, "")
+
+        self.time("location_question_results", location_results)
+
+    def benchmark_exports(self):
+        """ Time each export format, and again with a report filter. """
+        gets = [("", {"survey": self.survey.slug})]
+        question = self.questions.get(OTC.SELECT)
+        if question and question.use_as_filter:
+            gets.append((".filtered", {"survey": self.survey.slug,
+                                       question.fieldname:
+                                       question.parsed_options[0]}))
+        for suffix, get in gets:
+            for format in FORMAT_CHOICES:
+                def export():
+                    request = self.request(data=get)
+                    response = views.submissions(request, format)
+                    if response.streaming:
+                        for chunk in response.streaming_content:
+                            pass
+
+                self.time("export.%s%s" % (format, suffix), export)
+
+    def compare(self, path):
+        with open(path) as f:
+            before = json.load(f)["results"]
+        for name in sorted(self.results):
+            now, then = self.results[name], before.get(name, {})
+            if "median" in now and then.get("median"):
+                ratio = now["median"] / then["median"]
+                self.stdout.write("%s: %.2fx the median time, %+d queries" % (
+                    name, ratio, now["queries"] - then["queries"]))
@@ -0,0 +1,31 @@
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand
+
+from crowdsourcing.models import Submission, refresh_answer_documents
+
+
+class Command(BaseCommand):
+    help = ("Fill in the answer documents of submissions that don't have one "
+            "yet. See CROWDSOURCING_ANSWER_DOCUMENTS.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Rewrite every answer document.")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        submissions = Submission.objects.order_by("id")
+        if not options['all']:
+            submissions = submissions.filter(answer_document__isnull=True)
+        ids = submissions.values_list("id", flat=True)
+        built = 0
+        last_id = 0
+        while True:
+            batch = list(ids.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            refresh_answer_documents(batch)
+            built += len(batch)
+            last_id = batch[-1]
+        self.stdout.write("Built %d answer documents." % built)
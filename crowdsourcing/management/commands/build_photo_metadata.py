@@ -0,0 +1,32 @@
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand
+
+from crowdsourcing.models import Answer, compute_photo_metadata
+
+
+class Command(BaseCommand):
+    help = ("Store the sha1, the dimensions and the thumbnail URL of photo "
+            "answers that don't have them yet. See "
+            "CROWDSOURCING_PHOTO_METADATA_WORKERS.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Redo every photo answer.")
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        answers = Answer.objects.exclude(image_answer="").order_by("id")
+        answers = answers.exclude(image_answer__isnull=True)
+        if not options['all']:
+            answers = answers.filter(photo_hash__isnull=True)
+        ids = answers.values_list("id", flat=True)
+        built = 0
+        last_id = 0
+        while True:
+            batch = list(ids.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            built += compute_photo_metadata(batch)
+            last_id = batch[-1]
+        self.stdout.write("Stored the metadata of %d photos." % built)
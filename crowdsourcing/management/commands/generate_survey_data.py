@@ -0,0 +1,154 @@
+from __future__ import absolute_import
+
+import random
+import uuid
+from datetime import date, timedelta
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+import crowdsourcing.settings as crowdsourcing_settings
+from crowdsourcing.models import (
+    OPTION_TYPE_CHOICES,
+    Answer,
+    Submission,
+    Survey,
+    rebuild_answer_counts,
+    refresh_answer_documents,
+    remember_geocode)
+
+OTC = OPTION_TYPE_CHOICES
+
+CITIES = (("New York, NY", 40.7128, -74.0060),
+          ("Brooklyn, NY", 40.6782, -73.9442),
+          ("Newark, NJ", 40.7357, -74.1724),
+          ("Boston, MA", 42.3601, -71.0589),
+          ("Chicago, IL", 41.8781, -87.6298),
+          ("Los Angeles, CA", 34.0522, -118.2437))
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+OPTIONS = {
+    OTC.SELECT: "Red\nGreen\nBlue\nYellow",
+    OTC.CHOICE: "Yes\nNo\nMaybe",
+    OTC.RANKED: "First\nSecond\nThird",
+    OTC.BOOL_LIST: "Nuts\nSprinkles\nFudge\nCherries",
+    OTC.NUMERIC_SELECT: "1\n2\n3\n4\n5",
+    OTC.NUMERIC_CHOICE: "10\n20\n30",
+}
+
+
+class Command(BaseCommand):
+    help = ("Create a survey with a question of every option type and fill "
+            "it with random submissions, for benchmarking. Photo questions "
+            "get no answers.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--submissions', type=int, default=1000)
+        parser.add_argument('--title', default="Benchmark Survey")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        survey = self._create_survey(options['title'])
+        for city, lat, lng in CITIES:
+            remember_geocode(city, lat, lng)
+        questions = list(survey.questions.all())
+        remaining = options['submissions']
+        while remaining > 0:
+            size = min(remaining, options['batch_size'])
+            with transaction.atomic():
+                self._create_batch(survey, questions, size)
+            remaining -= size
+        if crowdsourcing_settings.ANSWER_COUNT_ROLLUPS:
+            rebuild_answer_counts(survey.questions.all())
+        self.stdout.write("Created %d submissions for the survey %s." % (
+            options['submissions'], survey.slug))
+
+    def _create_survey(self, title):
+        survey = Survey.objects.create(
+            title=title,
+            tease="A survey for benchmarking.",
+            is_published=True,
+            allow_multiple_submissions=True,
+            site=Site.objects.get_current())
+        option_types = sorted(value for value, label in OTC)
+        for order, option_type in enumerate(option_types):
+            survey.questions.create(
+                fieldname=option_type,
+                question="What about %s?" % option_type,
+                label=option_type,
+                order=order,
+                option_type=option_type,
+                options=OPTIONS.get(option_type, ""),
+                use_as_filter=True,
+                answer_is_public=True)
+        return survey
+
+    def _create_batch(self, survey, questions, size):
+        # bulk_create doesn't return ids on every database, so tag the batch
+        # to find its submissions again.
+        marker = uuid.uuid4().hex
+        now = timezone.now()
+        Submission.objects.bulk_create([
+            Submission(survey=survey,
+                       ip_address="10.0.%d.%d" % (i / 250 % 250, i % 250),
+                       session_key=marker,
+                       submitted_at=now - timedelta(minutes=random.randint(
+                           0, 60 * 24 * 365)),
+                       featured=random.random() < 0.1)
+            for i in range(size)])
+        ids = list(Submission.objects.filter(
+            session_key=marker).values_list("id", flat=True))
+        answers = []
+        for submission_id in ids:
+            for question in questions:
+                for values in self._values(question):
+                    answers.append(Answer(submission_id=submission_id,
+                                          question=question,
+                                          **values))
+        Answer.objects.bulk_create(answers)
+        Submission.objects.filter(session_key=marker).update(session_key="")
+        if crowdsourcing_settings.ANSWER_DOCUMENTS:
+            refresh_answer_documents(ids)
+
+    def _values(self, question):
+        """ The column values of the question's answers for one submission,
+        as a list since checkbox lists have an answer per checked option. """
+        ot = question.option_type
+        if ot == OTC.PHOTO:
+            return []
+        elif ot == OTC.BOOL:
+            return [dict(boolean_answer=random.random() < 0.5)]
+        elif ot == OTC.DATE:
+            days = random.randint(0, 3650)
+            return [dict(date_answer=date.today() - timedelta(days=days))]
+        elif ot in (OTC.INTEGER, OTC.FLOAT):
+            value = random.uniform(0, 100)
+            return [dict(float_answer=value, integer_answer=int(round(value)))]
+        elif ot in (OTC.NUMERIC_SELECT, OTC.NUMERIC_CHOICE):
+            value = float(random.choice(question.parsed_options))
+            return [dict(float_answer=value, integer_answer=int(value))]
+        elif ot == OTC.BOOL_LIST:
+            options = question.parsed_options
+            checked = random.sample(options, random.randint(0, len(options)))
+            return [dict(text_answer=option) for option in checked]
+        elif ot in (OTC.SELECT, OTC.CHOICE, OTC.RANKED):
+            return [dict(text_answer=random.choice(question.parsed_options))]
+        elif ot == OTC.LOCATION:
+            city, lat, lng = random.choice(CITIES)
+            return [dict(text_answer=city,
+                         latitude=lat + random.uniform(-0.05, 0.05),
+                         longitude=lng + random.uniform(-0.05, 0.05))]
+        elif ot == OTC.EMAIL:
+            return [dict(text_answer="%s@example.com" % random.choice(WORDS))]
+        elif ot == OTC.VIDEO:
+            return [dict(text_answer="http://www.youtube.com/watch?v=%s" %
+                         uuid.uuid4().hex[:11])]
+        words = random.randint(1, 30 if ot == OTC.TEXT else 4)
+        return [dict(text_answer=" ".join(random.choice(WORDS)
+                                          for i in range(words)))]
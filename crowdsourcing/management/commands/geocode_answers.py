@@ -0,0 +1,34 @@
+from __future__ import absolute_import
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from crowdsourcing.models import geocode_pending_answers
+
+
+class Command(BaseCommand):
+    help = ("Geocode the location answers that were saved without a latitude "
+            "and longitude. See CROWDSOURCING_DEFER_GEOCODING.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help="Geocode this many distinct addresses per "
+                                 "batch.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep running, polling for new answers.")
+        parser.add_argument('--interval', type=float, default=30,
+                            help="Seconds to wait between polls with --loop.")
+
+    def handle(self, *args, **options):
+        while True:
+            looked_up = geocode_pending_answers(options['batch_size'])
+            if looked_up:
+                found = [a for a, (lat, lng) in looked_up.items()
+                         if lat is not None and lng is not None]
+                self.stdout.write("Geocoded %d of %d addresses." % (
+                    len(found), len(looked_up)))
+            elif options['loop']:
+                time.sleep(options['interval'])
+            else:
+                break
@@ -0,0 +1,22 @@
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand
+
+from crowdsourcing.models import Question, rebuild_answer_counts
+
+
+class Command(BaseCommand):
+    help = ("Recount the answer count rollups that pie charts read. See "
+            "CROWDSOURCING_ANSWER_COUNT_ROLLUPS.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--survey', action='append', default=[],
+                            help="Only recount the questions of the survey "
+                                 "with this slug. May be repeated.")
+
+    def handle(self, *args, **options):
+        questions = Question.objects.all()
+        if options['survey']:
+            questions = questions.filter(survey__slug__in=options['survey'])
+        written = rebuild_answer_counts(questions)
+        self.stdout.write("Wrote %d answer counts." % written)
@@ -0,0 +1,36 @@
+from __future__ import absolute_import
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from crowdsourcing.notifications import (
+    due_survey_emails, send_queued_survey_emails)
+
+
+class Command(BaseCommand):
+    help = ("Deliver the survey notification emails waiting in the outbox. "
+            "See CROWDSOURCING_SURVEY_EMAIL_BACKEND.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Send at most this many emails per batch.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep running, polling the outbox.")
+        parser.add_argument('--interval', type=float, default=30,
+                            help="Seconds to wait between polls with --loop.")
+
+    def handle(self, *args, **options):
+        while True:
+            # A whole batch can fail, so keep going while emails are due
+            # rather than while batches send. Failed emails wait before
+            # they're due again.
+            while True:
+                sent = send_queued_survey_emails(options['batch_size'])
+                if sent:
+                    self.stdout.write("Sent %d survey emails." % sent)
+                if not due_survey_emails().exists():
+                    break
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
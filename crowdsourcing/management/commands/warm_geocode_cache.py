@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand
+
+from crowdsourcing.models import (
+    OPTION_TYPE_CHOICES,
+    Answer,
+    GeocodeCache,
+    geocode,
+    geocode_stats)
+
+
+class Command(BaseCommand):
+    help = ("Fill the geocode cache from the addresses of existing location "
+            "answers.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lookup', action='store_true',
+                            help="Also geocode addresses that don't have a "
+                                 "latitude and longitude yet.")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        answers = Answer.objects.filter(
+            question__option_type=OPTION_TYPE_CHOICES.LOCATION,
+            text_answer__isnull=False).exclude(text_answer="").order_by()
+        located = answers.filter(latitude__isnull=False,
+                                 longitude__isnull=False)
+        located = located.values_list("text_answer", "latitude", "longitude")
+        batch = {}
+        added = 0
+        for address, lat, lng in located.distinct().iterator():
+            batch[GeocodeCache.key_for(address)] = (lat, lng)
+            if len(batch) >= options['batch_size']:
+                added += self._add(batch)
+                batch = {}
+        added += self._add(batch)
+        self.stdout.write("Added %d geocodes from located answers." % added)
+        if options['lookup']:
+            unlocated = answers.filter(latitude__isnull=True)
+            unlocated = unlocated.values_list("text_answer", flat=True)
+            for address in unlocated.distinct().iterator():
+                geocode(address)
+            self.stdout.write("Geocoder stats: %s" % geocode_stats())
+
+    def _add(self, batch):
+        # Located answers settle the addresses the geocoder failed on.
+        known = GeocodeCache.objects.filter(address_key__in=list(batch))
+        known.filter(latitude__isnull=True).delete()
+        for key in known.values_list("address_key", flat=True):
+            batch.pop(key, None)
+        GeocodeCache.objects.bulk_create([
+            GeocodeCache(address_key=key, latitude=lat, longitude=lng)
+            for key, (lat, lng) in batch.items()])
+        return len(batch)
@@ -1,8 +1,13 @@
 from __future__ import absolute_import
 
+import hashlib
 import logging
-import re
-from math import sin, cos
+import threading
+from collections import defaultdict
+from copy import copy
+from datetime import timedelta
+from math import asin, cos, degrees, pi, sin
+from multiprocessing.pool import ThreadPool
 from operator import itemgetter
 from textwrap import fill
 
@@ -17,18 +22,34 @@ except ImportError:
 
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.utils import timezone
 from django.core.cache import cache
+from django.utils import timezone
 from django.core.urlresolvers import reverse
-from django.db import models, connection
-from django.db.models import Count
+from django.db import (
+    models,
+    connection,
+    connections,
+    transaction,
+    IntegrityError)
+from django.db.models import Count, F, Sum
+from django.db.models.signals import (
+    post_delete,
+    post_migrate,
+    post_save,
+    pre_save)
+from django.dispatch import receiver
 from django.db.models.fields.files import ImageFieldFile
 from decimal import Decimal
 from django.utils.translation import gettext as _
 
 from crowdsourcing.fields import ImageWithThumbnailsField
 from crowdsourcing.geo import get_latitude_and_longitude
-from crowdsourcing.util import ChoiceEnum
+from crowdsourcing.profiling import record_cache
+from crowdsourcing.util import (
+    ChoiceEnum,
+    LRUCache,
+    bump_cache_version,
+    cache_version)
 import crowdsourcing.settings as local_settings
 
 # autoslug support
@@ -50,16 +71,31 @@ ARCHIVE_POLICY_CHOICES = ChoiceEnum(('immediate',
                                      'never'))
 
 
-class LiveSurveyManager(models.Manager):
-    def get_query_set(self):
+class SurveyQuerySet(models.QuerySet):
+    def live(self):
+        """ The SQL version of Survey.is_live. """
         now = timezone.now()
-        return super(LiveSurveyManager, self).get_query_set().filter(
+        return self.filter(
             is_published=True,
             starts_at__lte=now).filter(
             ~models.Q(archive_policy__exact=ARCHIVE_POLICY_CHOICES.NEVER) |
             models.Q(ends_at__isnull=True) |
             models.Q(ends_at__gt=now))
 
+    def with_public_submissions(self):
+        """ The SQL version of Survey.can_have_public_submissions. """
+        now = timezone.now()
+        not_open = models.Q(starts_at__gt=now) | models.Q(ends_at__lte=now)
+        return self.exclude(
+            archive_policy__exact=ARCHIVE_POLICY_CHOICES.NEVER).filter(
+            models.Q(archive_policy__exact=ARCHIVE_POLICY_CHOICES.IMMEDIATE) |
+            not_open)
+
+
+class LiveSurveyManager(models.Manager.from_queryset(SurveyQuerySet)):
+    def get_queryset(self):
+        return super(LiveSurveyManager, self).get_queryset().live()
+
 
 FORMAT_CHOICES = ('json', 'csv', 'xml', 'html',)
 
@@ -175,7 +211,7 @@ class AbstractSurvey(models.Model):
         kwargs = {'slug': self.slug}
         submit_url = reverse('embeded_survey_questions', kwargs=kwargs)
         report_url = reverse('survey_default_report_page_1', kwargs=kwargs)
-        questions = self.questions.order_by("order")
+        questions = self.get_fields()
         return dict(title=self.title,
                     id=self.id,
                     slug=self.slug,
@@ -234,12 +270,12 @@ class AbstractSurvey(models.Model):
 
     def icon_questions(self):
         OTC = OPTION_TYPE_CHOICES
-        return self.questions.filter(
-            ~models.Q(map_icons=""),
-            option_type__in=[OTC.SELECT,
-                             OTC.CHOICE,
-                             OTC.NUMERIC_SELECT,
-                             OTC.NUMERIC_CHOICE])
+        types = (OTC.SELECT,
+                 OTC.CHOICE,
+                 OTC.NUMERIC_SELECT,
+                 OTC.NUMERIC_CHOICE)
+        return [f for f in self.get_fields()
+                if f.map_icons and f.option_type in types]
 
     def parsed_option_icon_pairs(self):
         icon_questions = self.icon_questions()
@@ -297,7 +333,7 @@ class AbstractSurvey(models.Model):
             downloads.append(self.get_download_tag(format))
         return delimiter.join(downloads)
 
-    objects = models.Manager()
+    objects = SurveyQuerySet.as_manager()
     live = LiveSurveyManager()
 
     class Meta:
@@ -459,7 +495,14 @@ class Question(models.Model):
     def parsed_options(self):
         if OPTION_TYPE_CHOICES.BOOL == self.option_type:
             return [True, False]
-        return filter(None, (s.strip() for s in self.options.splitlines()))
+        # Templates read this in loops, so only parse again when the options
+        # change.
+        memo = self.__dict__.get("_parsed_options")
+        if memo is None or memo[0] != self.options:
+            lines = self.options.splitlines()
+            parsed = filter(None, (s.strip() for s in lines))
+            memo = self.__dict__["_parsed_options"] = (self.options, parsed)
+        return list(memo[1])
 
     @property
     def parsed_map_icons(self):
@@ -478,6 +521,13 @@ class Question(models.Model):
 
     @property
     def value_column(self):
+        memo = self.__dict__.get("_value_column")
+        key = (self.option_type, self.numeric_is_int)
+        if memo is None or memo[0] != key:
+            memo = self.__dict__["_value_column"] = (key, self._value_column())
+        return memo[1]
+
+    def _value_column(self):
         ot = self.option_type
         OTC = OPTION_TYPE_CHOICES
         if ot == OTC.BOOL:
@@ -567,76 +617,155 @@ def get_filters(survey, request_data):
 
 
 def extra_from_filters(set, submission_id_column, survey, request_data):
-    sid = submission_id_column
-    for where, params in extra_clauses_from_filters(sid, survey, request_data):
-        set = set.extra(where=[where], params=params)
-    return set
+    return filter_plan(survey, request_data).apply(set, submission_id_column)
 
 
 def extra_clauses_from_filters(submission_id_column, survey, request_data):
-    return_value = []
-    for filter in get_filters(survey, request_data):
-        loc = filter.location_value and filter.within_value
-        if filter.value or filter.from_value or filter.to_value or loc:
-            try:
-                OTC = OPTION_TYPE_CHOICES
-                where = "".join((
-                    submission_id_column,
-                    " IN (SELECT submission_id FROM ",
-                    "crowdsourcing_answer WHERE question_id = %d ",
-                    "AND ")) % filter.field.id
-                if OTC.BOOL == filter.field.option_type:
-                    f = ("0", "f",)
-                    length = len(filter.value)
-                    params = [length and not filter.value[0].lower() in f]
-                    where += "boolean_answer = %s"
-                elif filter.field.is_numeric:
-                    column = filter.field.value_column
-                    convert = float if filter.field.is_float else int
-                    params = []
-                    wheres = []
-                    if filter.from_value:
-                        params.append(convert(filter.from_value))
-                        wheres.append("%s <= " + column)
-                    if filter.to_value:
-                        params.append(convert(filter.to_value))
-                        wheres.append(column + " <= %s")
-                    if filter.value:
-                        params.append(convert(filter.value))
-                        wheres.append(column + " = %s")
-                    where += " AND ".join(wheres)
-                elif OTC.LOCATION == filter.field.option_type:
-                    e = _extra_from_distance(filter, submission_id_column)
-                    if e:
-                        d_where, params = e
-                        where += d_where
-                    else:
-                        break
-                else:
-                    params = [filter.value]
-                    where += "text_answer = %s"
-                where += ")"
-                return_value.append((where, params,))
-            except ValueError:
-                pass
-    return return_value
-
-
-def _extra_from_distance(filter, submission_id_column):
+    return filter_plan(survey, request_data).clauses(submission_id_column)
+
+
+_filter_plans = LRUCache(500)
+
+
+def filter_plan(survey, request_data):
+    """ The FilterPlan of the report filters in request_data. The submission
+    list, the aggregates and the map results of a report all filter the same
+    way, so the plan is only worked out once. """
+    items = tuple(sorted((key, u"%s" % request_data.get(key))
+                         for key in request_data.keys()))
+    key = (survey.pk, survey_version(survey.pk), items)
+    plan = _filter_plans.get(key)
+    if plan is None:
+        plan = FilterPlan(survey, request_data)
+        _filter_plans.set(key, plan)
+    return plan
+
+
+class FilterPlan(object):
+    """ The conditions of the active report filters, most selective first.
+    Each one becomes an EXISTS subquery, correlated on the submission id,
+    which the database can stop at the first matching answer. Ordering
+    them lets the database rule out the most submissions before it checks
+    the other filters. """
+
+    def __init__(self, survey, request_data):
+        conditions = []
+        for filter in get_filters(survey, request_data):
+            condition = _filter_condition(filter)
+            if condition:
+                where, params = condition
+                conditions.append((_estimate_selectivity(filter),
+                                   filter.field.id,
+                                   where,
+                                   params))
+        conditions.sort(key=itemgetter(0, 1))
+        self.conditions = [c[1:] for c in conditions]
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def clauses(self, submission_id_column):
+        """ Return a (where, params) pair per filter for a query whose
+        submission ids are in submission_id_column. Qualify the column with
+        its table, as in "crowdsourcing_answer.submission_id", or the
+        clauses fall back to slower IN subqueries. """
+        if "." in submission_id_column:
+            template = ("EXISTS (SELECT 1 FROM crowdsourcing_answer AS "
+                        "filter_answer WHERE filter_answer.submission_id = "
+                        "%s AND filter_answer.question_id = %%d AND %%s)" %
+                        submission_id_column)
+        else:
+            template = ("%s IN (SELECT submission_id FROM crowdsourcing_answer "
+                        "WHERE question_id = %%d AND %%s)" %
+                        submission_id_column)
+        return [(template % (question_id, where), list(params))
+                for question_id, where, params in self.conditions]
+
+    def apply(self, queryset, submission_id_column):
+        clauses = self.clauses(submission_id_column)
+        if not clauses:
+            return queryset
+        params = []
+        for where, next_params in clauses:
+            params += next_params
+        return queryset.extra(where=[where for where, _ in clauses],
+                              params=params)
+
+
+def _filter_condition(filter):
+    """ The condition an answer to the filter's question has to meet, as a
+    (where, params) pair, or None if the filter isn't in use. """
+    loc = filter.location_value and filter.within_value
+    if not (filter.value or filter.from_value or filter.to_value or loc):
+        return None
+    OTC = OPTION_TYPE_CHOICES
+    try:
+        if OTC.BOOL == filter.field.option_type:
+            f = ("0", "f",)
+            length = len(filter.value)
+            params = [length and not filter.value[0].lower() in f]
+            return "boolean_answer = %s", params
+        elif filter.field.is_numeric:
+            column = filter.field.value_column
+            convert = float if filter.field.is_float else int
+            params = []
+            wheres = []
+            if filter.from_value:
+                params.append(convert(filter.from_value))
+                wheres.append("%s <= " + column)
+            if filter.to_value:
+                params.append(convert(filter.to_value))
+                wheres.append(column + " <= %s")
+            if filter.value:
+                params.append(convert(filter.value))
+                wheres.append(column + " = %s")
+            return " AND ".join(wheres), params
+        elif OTC.LOCATION == filter.field.option_type:
+            return _extra_from_distance(filter)
+        return "text_answer = %s", [filter.value]
+    except ValueError:
+        return None
+
+
+def _estimate_selectivity(filter):
+    """ Guess what fraction of the question's answers pass the filter. """
+    field = filter.field
+    if FILTER_TYPE.DISTANCE == filter.type:
+        return 0.1
+    if FILTER_TYPE.RANGE == filter.type:
+        bounds = [v for v in (filter.from_value, filter.to_value) if v]
+        return 0.5 ** len(bounds)
+    if local_settings.ANSWER_COUNT_ROLLUPS and \
+            "text_answer" == field.value_column and \
+            field.option_type in ROLLUP_OPTION_TYPES:
+        counts = field.answercount_set.values_list("value_hash", "count")
+        total = sum(count for _, count in counts)
+        if total:
+            value_hash = AnswerCount.hash_for(filter.value)
+            return sum(c for h, c in counts if h == value_hash) / float(total)
+    return 1.0 / max(len(field.parsed_options), 2)
+
+
+def _extra_from_distance(filter):
     """ This uses the Spherical Law of Cosines for a close enough approximation
     of distances. distance = acos(sin(lat1) * sin(lat2) +
                                   cos(lat1) * cos(lat2) *
                                   cos(lng2 - lng1)) * 3959
-    The "radius" of the earth varies between 3,950 and 3,963 miles. """
-    spaces = re.compile(r'\s')
-    key = spaces.sub("+", "lat_lng_of_" + str(filter.location_value.lower()))
-    lat_lng = cache.get(key, None)
-    if lat_lng is None:
-        lat_lng = get_latitude_and_longitude(filter.location_value)
-        cache.set(key, lat_lng)
-    (lat, lng) = lat_lng
+    The "radius" of the earth varies between 3,950 and 3,963 miles.
+    The returned conditions apply to the answers of the location question.
+    They restrict latitude and longitude to a bounding box first so the
+    database can use the (question, latitude, longitude) index and only
+    computes distances for the answers inside the box. """
+    (lat, lng) = geocode(filter.location_value)
     if lat is None or lng is None:
         return
+    within = float(filter.within_value)
+    min_lat, min_lng, max_lat, max_lng = _bounding_box(lat, lng, within)
+    wheres = ["latitude BETWEEN %s AND %s"]
+    params = [min_lat, max_lat]
+    if min_lng is not None:
+        wheres.append("longitude BETWEEN %s AND %s")
+        params.extend([min_lng, max_lng])
     acos_of_args = (
         sin(_radians(lat)),
         _D_TO_R,
@@ -648,34 +777,70 @@ def _extra_from_distance(filter, submission_id_column):
                   "%f * sin(latitude / %f) + "
                   "%f * cos(latitude / %f) * "
                   "cos((longitude - %f) / %f)") % acos_of_args
-    # if acos_of >= 1 then the address in the database is practically the
-    # same address we're searching for and acos(acos_of) is mathematically 
-    # impossible so just always include it. If acos_of < 1 then we need to
-    # check the distance.
-    where = "".join((
-        submission_id_column,
-        " IN (SELECT ca.submission_id FROM ",
-        "crowdsourcing_answer AS ca JOIN crowdsourcing_submission AS cs ",
-        "ON ca.submission_id = cs.id ",
-        "WHERE cs.survey_id = %s AND latitude IS NOT NULL ",
-        "AND longitude IS NOT NULL AND ",
-        acos_of,
-        " >= 1 OR (",
-        acos_of,
-        " < 1 AND 3959.0 * acos(",
-        acos_of,
-        ") <= %s))"))
-    params = [int(filter.field.survey_id), int(filter.within_value)]
-    return where, params
+    # acos is decreasing, so distance <= within exactly when acos_of is at
+    # least cos(within / 3959). Comparing that way avoids calling acos, which
+    # fails when rounding pushes acos_of just past 1 for identical points.
+    wheres.append(acos_of + " >= %s")
+    params.append(cos(min(within / _EARTH_RADIUS, pi)))
+    return " AND ".join(wheres), params
+
+
+def _bounding_box(lat, lng, miles):
+    """ Return (min_lat, min_lng, max_lat, max_lng) of a box that contains
+    every point within miles of lat, lng. min_lng and max_lng are None when
+    the box reaches a pole or crosses the 180th meridian, in which case only
+    the latitudes narrow anything down. """
+    angle = miles / _EARTH_RADIUS
+    min_lat = lat - degrees(angle)
+    max_lat = lat + degrees(angle)
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90.0), None, min(max_lat, 90.0), None
+    lng_delta = degrees(asin(min(sin(angle) / cos(_radians(lat)), 1.0)))
+    min_lng, max_lng = lng - lng_delta, lng + lng_delta
+    if min_lng < -180 or max_lng > 180:
+        return min_lat, None, max_lat, None
+    return min_lat, min_lng, max_lat, max_lng
 
 
 _D_TO_R = 57.295779
 
+_EARTH_RADIUS = 3959.0
+
 
 def _radians(degrees):
     return degrees / _D_TO_R
 
 
+_chart_labels = LRUCache(5000)
+
+
+def _chart_label(value):
+    """ The answer value wrapped to fit on a chart. Charts show the same
+    options over and over, so each distinct value is only wrapped once. """
+    text = u"%s" % value
+    label = _chart_labels.get(text)
+    if label is None:
+        label = fill(text, 30)
+        _chart_labels.set(text, label)
+    return label
+
+
+def _x_axis_options(x_axis):
+    """ The x axis' options in the type that its answers come back from the
+    database, so that they match up and numeric ones sort as numbers. """
+    column = x_axis.value_column
+    if column not in ("integer_answer", "float_answer"):
+        return x_axis.parsed_options
+    convert = int if column == "integer_answer" else float
+    options = []
+    for option in x_axis.parsed_options:
+        try:
+            options.append(convert(option))
+        except ValueError:
+            pass
+    return options
+
+
 class AggregateResultCount(object):
     """ This helper class makes it easier to write templates that display
     pie charts. """
@@ -688,35 +853,56 @@ class AggregateResultCount(object):
                  is_staff=False):
         self.answer_set = field.answer_set.none()
         self.answer_value_lookup = {}
-        if is_staff or field.answer_is_public:
+        use_rollups = (local_settings.ANSWER_COUNT_ROLLUPS and
+                       field.option_type in ROLLUP_OPTION_TYPES and
+                       not filter_plan(survey, request_data))
+        if use_rollups and (is_staff or field.answer_is_public):
+            # No filters, so the precomputed counts will do.
+            self.answer_set = field.answercount_set.filter(count__gt=0)
+            if not is_staff:
+                self.answer_set = self.answer_set.filter(is_public=True)
+            if surveyreport and surveyreport.featured:
+                self.answer_set = self.answer_set.filter(featured=True)
+            self.answer_set = self.answer_set.order_by().values("value")
+            self.answer_set = self.answer_set.annotate(count=Sum("count"))
+            self.answer_set = [{field.value_column: a["value"],
+                                "count": a["count"]}
+                               for a in self.answer_set]
+        elif is_staff or field.answer_is_public:
             self.answer_set = field.public_answers
             if is_staff:
                 self.answer_set = field.answer_set
             self.answer_set = self.answer_set.values(field.value_column)
             self.answer_set = self.answer_set.annotate(count=Count("id"))
-            self.answer_set = extra_from_filters(self.answer_set,
-                                                 "submission_id",
-                                                 survey,
-                                                 request_data)
+            self.answer_set = extra_from_filters(
+                self.answer_set,
+                "crowdsourcing_answer.submission_id",
+                survey,
+                request_data)
             if surveyreport and surveyreport.featured:
                 self.answer_set = self.answer_set.filter(
                     submission__featured=True)
-        for answer in self.answer_set:
-            text = fill(u"%s" % answer[field.value_column], 30)
-            if answer["count"]:
-                self.answer_value_lookup[text] = {
-                    field.fieldname: text,
-                    "count": answer["count"]}
+        # Shape the rows as columns. Each distinct value is wrapped once,
+        # and where two wrap to the same label the later count wins.
+        column = field.value_column
+        rows = [(a[column], a["count"]) for a in self.answer_set if a["count"]]
+        labels = [_chart_label(value) for value, count in rows]
+        counts = dict(zip(labels, [count for value, count in rows]))
         # 2-axis aggregate results put the results in the same order as the
         # options, so we do that here as well to make 1-axis graphs like pie
-        # charts and simple count bar charts match.
-        self.answer_values = []
-        for answer in field.parsed_options:
-            value = self.answer_value_lookup.pop(answer, None)
-            if value:
-                self.answer_values.append(value)
-        for value in self.answer_value_lookup.values():
-            self.answer_values.append(value)
+        # charts and simple count bar charts match. Anything that isn't an
+        # option follows in the order the database returned it.
+        rank = {}
+        for option in field.parsed_options:
+            rank.setdefault(_chart_label(option), len(rank))
+        seen = set()
+        order = [label for label in labels
+                 if not (label in seen or seen.add(label))]
+        order.sort(key=lambda label: rank.get(label, len(rank)))
+        self.answer_values = [{field.fieldname: label, "count": counts[label]}
+                              for label in order]
+        self.answer_value_lookup = dict(
+            (value[field.fieldname], value) for value in self.answer_values)
         self.yahoo_answer_string = json.dumps(self.answer_values)
 
 
@@ -742,56 +928,82 @@ class AggregateResult2Axis(object):
         # We could just add new x-axis values as we encounter them. However,
         # say someone has parsed_options ["January", ... , "December"].
         # Then doing it this way puts them in order.
-        [new_answer_value(x_value) for x_value in x_axis.parsed_options]
+        [new_answer_value(x_value) for x_value in _x_axis_options(x_axis)]
 
+        # One query computes every y axis as its own column. Each column
+        # only aggregates the answers to its question, so the x axis answers
+        # are joined and the filters are applied just once.
         x_value_column = "x_axis." + x_axis.value_column
-        found_any = False
+        aggregates = []
+        not_null = []
+        params = []
+        where_params = []
         for y_axis in y_axes:
-            params = [y_axis.id, x_axis.id]
             y_axis_column = y_axis.value_column
             if "boolean_answer" == y_axis_column:
                 y_axis_column = "CAST(y_axis." + y_axis_column + " AS int)"
             else:
                 y_axis_column = "y_axis." + y_axis_column
-            query = [
-                "SELECT ",
-                x_value_column,
-                " AS x_value, ",
-                aggregate_function,
-                "(",
-                y_axis_column,
-                ") AS y_value FROM crowdsourcing_answer AS y_axis ",
-                "JOIN crowdsourcing_answer AS x_axis "
-                "ON y_axis.submission_id = x_axis.submission_id ",
-                "JOIN crowdsourcing_submission AS submission ",
-                "ON submission.id = y_axis.submission_id ",
-                "WHERE submission.is_public = true AND ",
-                "y_axis.question_id = %s AND ",
-                y_axis_column,
-                " IS NOT NULL AND x_axis.question_id = %s"]
-            if report and report.featured:
-                query.append(" AND submission.featured = true")
-            y = "y_axis.submission_id"
-            extras = extra_clauses_from_filters(y, x_axis.survey, request_data)
-            for where, next_params in extras:
-                query.append(" AND ")
-                query.append(where)
-                params += next_params
-            query.append(" GROUP BY ")
-            query.append(x_value_column)
+            aggregates.append("%s(CASE WHEN y_axis.question_id = %%s "
+                              "THEN %s END)" % (aggregate_function,
+                                                y_axis_column))
+            params.append(y_axis.id)
+            not_null.append("(y_axis.question_id = %%s AND %s IS NOT NULL)" %
+                            y_axis_column)
+            where_params.append(y_axis.id)
+        query = [
+            "SELECT ",
+            x_value_column,
+            " AS x_value, ",
+            ", ".join(aggregates),
+            " FROM crowdsourcing_answer AS y_axis ",
+            "JOIN crowdsourcing_answer AS x_axis "
+            "ON y_axis.submission_id = x_axis.submission_id ",
+            "JOIN crowdsourcing_submission AS submission ",
+            "ON submission.id = y_axis.submission_id ",
+            "WHERE submission.is_public = true AND (",
+            " OR ".join(not_null),
+            ") AND x_axis.question_id = %s"]
+        params += where_params + [x_axis.id]
+        if report and report.featured:
+            query.append(" AND submission.featured = true")
+        y = "y_axis.submission_id"
+        extras = extra_clauses_from_filters(y, x_axis.survey, request_data)
+        for where, next_params in extras:
+            query.append(" AND ")
+            query.append(where)
+            params += next_params
+        query.append(" GROUP BY ")
+        query.append(x_value_column)
+        if y_axes:
             cursor = connection.cursor()
             cursor.execute("".join(query), params)
-            for x_value, y_value in cursor.fetchall():
-                found_any = True
-                if isinstance(y_value, Decimal):
-                    y_value = round(y_value, 2)
-                answer_value = answer_value_lookup.get(x_value)
-                if not answer_value:
-                    answer_value = new_answer_value(x_value)
-                answer_value[y_axis.fieldname] += y_value
+            rows = cursor.fetchall()
+        else:
+            rows = []
+        # Shape the rows as columns: the x values, then one column per y
+        # axis. A column's values all come back as the same type, so whether
+        # it needs rounding is worked out once per column.
+        columns = zip(*rows) if rows else [()] * (len(y_axes) + 1)
+        x_values = columns[0]
+        found_any = False
+        for y_axis, y_values in zip(y_axes, columns[1:]):
+            sample = next((v for v in y_values if v is not None), None)
+            if sample is None:
+                continue
+            found_any = True
+            if isinstance(sample, Decimal):
+                y_values = [None if v is None else round(v, 2)
+                            for v in y_values]
+            key = y_axis.fieldname
+            for x_value, y_value in zip(x_values, y_values):
+                if y_value is not None:
+                    answer_value = answer_value_lookup.get(x_value)
+                    if not answer_value:
+                        answer_value = new_answer_value(x_value)
+                    answer_value[key] += y_value
         if x_axis.is_numeric:
-            key = x_axis.fieldname
-            self.answer_values.sort(lambda x, y: x[key] - y[key])
+            self.answer_values.sort(key=itemgetter(x_axis.fieldname))
         if not found_any:
             self.answer_values = []
         self.yahoo_answer_string = json.dumps(self.answer_values)
@@ -833,11 +1045,18 @@ class Submission(models.Model):
         help_text=_("Only displays public submissions. The "
                     "'Moderate submissions' checkbox of the survey determines "
                     "the default value of this field."))
+    # A JSON copy of the answers, keyed by fieldname, for reading a submission
+    # without its answer rows. See settings.ANSWER_DOCUMENTS.
+    answer_document = models.TextField(blank=True,
+                                       null=True,
+                                       editable=False)
 
     class Meta:
         verbose_name = _("Submission")
         verbose_name_plural = _("Submissions")
         ordering = ('-submitted_at',)
+        # For the public submissions of a survey, newest first.
+        index_together = (('survey', 'is_public', 'submitted_at'),)
 
     @classmethod
     def get_id_field(cls):
@@ -875,7 +1094,8 @@ class Submission(models.Model):
             # avoid called __getattr__
             return self.__dict__['_answer_dict']
         except KeyError:
-            answers = self.answer_set.all()
+            answers = get_all_answers([self], include_private_questions=True)
+            answers = answers.get(self.pk, [])
             d = dict((a.question.fieldname, a.value) for a in answers)
             self.__dict__['_answer_dict'] = d
             return d
@@ -916,6 +1136,18 @@ class Answer(models.Model):
                                   null=True,
                                   blank=True,
                                   editable=False)
+    # Stored by compute_photo_metadata so that rendering a photo doesn't have
+    # to read it from storage.
+    image_width = models.PositiveIntegerField(null=True,
+                                              blank=True,
+                                              editable=False)
+    image_height = models.PositiveIntegerField(null=True,
+                                               blank=True,
+                                               editable=False)
+    thumbnail_url = models.CharField(max_length=500,
+                                     null=True,
+                                     blank=True,
+                                     editable=False)
 
     @property
     def value(self):
@@ -947,11 +1179,268 @@ class Answer(models.Model):
         verbose_name = _("Answer")
         verbose_name_plural = _("Answers")
         ordering = ('question',)
+        # One index per value column for the filter subqueries and the
+        # aggregates, which always restrict question_id. See
+        # ensure_answer_indexes for text_answer.
+        index_together = (('question', 'latitude', 'longitude'),
+                          ('question', 'integer_answer'),
+                          ('question', 'float_answer'),
+                          ('question', 'boolean_answer'),
+                          ('question', 'submission'))
 
     def __unicode__(self):
         return unicode(self.question)
 
 
+ROLLUP_OPTION_TYPES = (OPTION_TYPE_CHOICES.BOOL,
+                       OPTION_TYPE_CHOICES.SELECT,
+                       OPTION_TYPE_CHOICES.CHOICE,
+                       OPTION_TYPE_CHOICES.BOOL_LIST,
+                       OPTION_TYPE_CHOICES.NUMERIC_SELECT,
+                       OPTION_TYPE_CHOICES.NUMERIC_CHOICE,
+                       OPTION_TYPE_CHOICES.RANKED,)
+
+
+class AnswerCount(models.Model):
+    """ How many answers to a question have a given value, split by the
+    moderation flags of their submissions. AggregateResultCount reads these
+    instead of counting the answer table when
+    settings.ANSWER_COUNT_ROLLUPS is on. """
+    question = models.ForeignKey(Question)
+    value = models.TextField(blank=True)
+    # A sha1 of value so that the unique index stays small.
+    value_hash = models.CharField(max_length=40, editable=False)
+    is_public = models.BooleanField(default=True)
+    featured = models.BooleanField(default=False)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = _("Answer count")
+        verbose_name_plural = _("Answer counts")
+        unique_together = (
+            ('question', 'value_hash', 'is_public', 'featured'),)
+
+    @staticmethod
+    def hash_for(value):
+        return hashlib.sha1(value.encode("utf-8")).hexdigest()
+
+    def __unicode__(self):
+        return u"%s: %s (%d)" % (self.question, self.value, self.count)
+
+
+def _rollup_value(answer, question=None):
+    question = question or answer.question
+    return u"%s" % getattr(answer, question.value_column)
+
+
+def add_answer_counts(counts, is_public, featured):
+    """ counts maps (question id, value) to how many answers to add to, or
+    with negative numbers remove from, the rollup for the given submission
+    flags. """
+    for (question_id, value), delta in counts.items():
+        if not delta:
+            continue
+        rows = AnswerCount.objects.filter(
+            question_id=question_id,
+            value_hash=AnswerCount.hash_for(value),
+            is_public=is_public,
+            featured=featured)
+        if rows.update(count=F("count") + delta) or delta < 0:
+            continue
+        try:
+            with transaction.atomic():
+                AnswerCount.objects.create(
+                    question_id=question_id,
+                    value=value,
+                    value_hash=AnswerCount.hash_for(value),
+                    is_public=is_public,
+                    featured=featured,
+                    count=delta)
+        except IntegrityError:
+            rows.update(count=F("count") + delta)
+
+
+def count_answers(answers, submission, delta=1):
+    """ Add, or with delta=-1 remove, answers belonging to submission in the
+    rollups. Answers to questions without rollups are ignored. """
+    if not local_settings.ANSWER_COUNT_ROLLUPS:
+        return
+    counts = defaultdict(int)
+    for answer in answers:
+        if answer.question.option_type in ROLLUP_OPTION_TYPES:
+            counts[(answer.question_id, _rollup_value(answer))] += delta
+    add_answer_counts(counts, submission.is_public, submission.featured)
+
+
+def rebuild_answer_counts(questions=None):
+    """ Recount the rollups from scratch for questions, or for every question
+    that has them. Return the number of rollup rows written. """
+    if questions is None:
+        questions = Question.objects.all()
+    questions = questions.filter(option_type__in=ROLLUP_OPTION_TYPES)
+    written = 0
+    for question in questions:
+        column = question.value_column
+        rows = question.answer_set.order_by().values(
+            column,
+            "submission__is_public",
+            "submission__featured").annotate(count=Count("id"))
+        counts = defaultdict(int)
+        for row in rows:
+            key = (u"%s" % row[column],
+                   row["submission__is_public"],
+                   row["submission__featured"])
+            counts[key] += row["count"]
+        with transaction.atomic():
+            AnswerCount.objects.filter(question=question).delete()
+            AnswerCount.objects.bulk_create([
+                AnswerCount(question=question,
+                            value=value,
+                            value_hash=AnswerCount.hash_for(value),
+                            is_public=is_public,
+                            featured=featured,
+                            count=count)
+                for (value, is_public, featured), count in counts.items()])
+        written += len(counts)
+    return written
+
+
+class SurveyEmail(models.Model):
+    """ A notification email about a new submission waiting in the outbox.
+    See crowdsourcing.notifications.queue_survey_email. """
+    submission = models.ForeignKey(Submission)
+    recipient = models.CharField(verbose_name=_("Recipient"), max_length=255)
+    # The scheme and host the submission came in on, for building links.
+    site_url = models.CharField(max_length=255)
+    created_at = models.DateTimeField(verbose_name=_("Created at"),
+                                      default=timezone.now)
+    sent_at = models.DateTimeField(verbose_name=_("Sent at"),
+                                   blank=True, null=True)
+    attempts = models.PositiveIntegerField(verbose_name=_("Attempts"),
+                                           default=0)
+    last_error = models.TextField(verbose_name=_("Last error"), blank=True)
+    # Not before this time, if it's set: a failed email waits out its
+    # backoff, and one a worker is sending is claimed until then.
+    next_attempt_at = models.DateTimeField(
+        verbose_name=_("Next attempt at"), blank=True, null=True)
+
+    class Meta:
+        verbose_name = _("Survey email")
+        verbose_name_plural = _("Survey emails")
+        ordering = ('created_at',)
+        index_together = (('sent_at', 'recipient'),)
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.recipient, self.submission)
+
+
+class GeocodeCache(models.Model):
+    """ Every address crowdsourcing has successfully geocoded, keyed by the
+    normalized address, so each address only goes to the geocoder once. Use
+    geocode() rather than querying this directly. Addresses that
+    geocode_pending_answers couldn't locate are here too, with no latitude
+    or longitude and the time of the last try in failed_at. """
+    address_key = models.CharField(max_length=255, unique=True)
+    latitude = models.FloatField(null=True)
+    longitude = models.FloatField(null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _("Geocode")
+        verbose_name_plural = _("Geocodes")
+
+    @staticmethod
+    def key_for(address):
+        key = u" ".join(address.lower().split())
+        if len(key) > 255:
+            digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+            key = key[:255 - len(digest)] + digest
+        return key
+
+    def __unicode__(self):
+        return self.address_key
+
+
+GEOCODE_STATS = dict(memory_hits=0, database_hits=0, misses=0)
+
+_geocode_lru = LRUCache(local_settings.GEOCODE_LRU_SIZE)
+
+
+def geocode(address, lookup=True):
+    """ Return the (latitude, longitude) of address. Look in this process's
+    memory first, then in GeocodeCache, and only then ask the geocoder,
+    remembering what it finds. If lookup is False, don't ask the geocoder.
+    Return (None, None) for addresses we can't locate. Failed lookups are
+    only remembered for settings.GEOCODE_FAILURE_TIMEOUT seconds so they get
+    another chance later. """
+    key = GeocodeCache.key_for(address)
+    lat_lng = _geocode_lru.get(key)
+    record_cache(lat_lng is not None)
+    if lat_lng is not None:
+        GEOCODE_STATS["memory_hits"] += 1
+        return lat_lng
+    found = GeocodeCache.objects.filter(address_key=key,
+                                        latitude__isnull=False,
+                                        longitude__isnull=False)
+    found = found.values_list("latitude", "longitude")[:1]
+    if found:
+        GEOCODE_STATS["database_hits"] += 1
+        lat_lng = tuple(found[0])
+    else:
+        GEOCODE_STATS["misses"] += 1
+        if not lookup or cache.get(_geocode_failed_key(key)):
+            return None, None
+        lat_lng = get_latitude_and_longitude(address)
+        if None in lat_lng:
+            cache.set(_geocode_failed_key(key),
+                      True,
+                      local_settings.GEOCODE_FAILURE_TIMEOUT)
+            return None, None
+        remember_geocode(address, *lat_lng)
+    _geocode_lru.set(key, lat_lng)
+    return lat_lng
+
+
+def remember_geocode(address, latitude, longitude):
+    key = GeocodeCache.key_for(address)
+    try:
+        with transaction.atomic():
+            GeocodeCache.objects.create(address_key=key,
+                                        latitude=latitude,
+                                        longitude=longitude)
+    except IntegrityError:
+        GeocodeCache.objects.filter(address_key=key).update(
+            latitude=latitude,
+            longitude=longitude,
+            failed_at=None)
+    _geocode_lru.set(key, (latitude, longitude))
+    cache.delete(_geocode_failed_key(key))
+
+
+def _geocode_failed_key(key):
+    # Addresses can have spaces and run long, which memcached doesn't allow.
+    digest = hashlib.md5(key.encode("utf-8")).hexdigest()
+    return "crowdsourcing_geocode_failed_%s" % digest
+
+
+def _remember_geocode_failure(address):
+    key = GeocodeCache.key_for(address)
+    now = timezone.now()
+    try:
+        with transaction.atomic():
+            GeocodeCache.objects.create(address_key=key, failed_at=now)
+    except IntegrityError:
+        GeocodeCache.objects.filter(address_key=key,
+                                    latitude__isnull=True).update(
+            failed_at=now)
+
+
+def geocode_stats():
+    """ Hit and miss counts for geocode() in this process. """
+    return dict(GEOCODE_STATS, memory_size=len(_geocode_lru))
+
+
 class SurveyReport(models.Model):
     """
     a survey report permits the presentation of data submitted in a
@@ -1170,15 +1659,580 @@ class SurveyReportDisplay(models.Model):
 
 
 def get_all_answers(submission_list, include_private_questions=False):
-    ids = [submission.id for submission in submission_list]
+    """ Return a dictionary of submission id to the list of its answers.
+    Submissions with an answer document read their answers from it rather
+    than from the answer table. """
+    page_answers = {}
+    from_table = []
+    documents = []
+    for submission in submission_list:
+        if submission.answer_document and local_settings.ANSWER_DOCUMENTS:
+            documents.append(submission)
+        else:
+            from_table.append(submission)
+    if documents:
+        survey_ids = set(s.survey_id for s in documents)
+        questions = Question.objects.filter(survey__in=survey_ids)
+        if not include_private_questions:
+            questions = questions.filter(answer_is_public=True)
+        question_lookup = dict((q.pk, q) for q in questions)
+        for submission in documents:
+            page_answers[submission.pk] = _answers_from_document(
+                submission,
+                question_lookup)
+    if not from_table:
+        return page_answers
+    ids = [submission.id for submission in from_table]
     page_answers_list = Answer.objects.filter(submission__id__in=ids)
     if not include_private_questions:
         kwargs = dict(question__answer_is_public=True)
         page_answers_list = page_answers_list.filter(**kwargs)
     page_answers_list = page_answers_list.select_related("question")
-    page_answers = {}
     for answer in page_answers_list:
         if not answer.submission_id in page_answers:
             page_answers[answer.submission_id] = []
         page_answers[answer.submission_id].append(answer)
     return page_answers
+
+
+ANSWER_VALUE_COLUMNS = ("text_answer",
+                        "date_answer",
+                        "integer_answer",
+                        "float_answer",
+                        "boolean_answer",
+                        "image_answer",)
+
+ANSWER_EXTRA_COLUMNS = ("latitude",
+                        "longitude",
+                        "photo_hash",
+                        "image_width",
+                        "image_height",
+                        "thumbnail_url",)
+
+
+def answer_document(answers):
+    """ The JSON for Submission.answer_document. Each fieldname maps to a list,
+    as checkbox list questions have an answer for every checked option. Every
+    answer keeps all of its non-empty columns, so the document still reads
+    right if the question later switches between, say, integer and float. """
+    document = {}
+    for answer in answers:
+        entry = {"id": answer.pk, "question": answer.question_id}
+        for column in ANSWER_VALUE_COLUMNS + ANSWER_EXTRA_COLUMNS:
+            value = getattr(answer, column)
+            if value is None or value == "":
+                continue
+            if column == "date_answer":
+                value = value.isoformat()
+            elif column == "image_answer":
+                value = value.name
+            entry[column] = value
+        document.setdefault(answer.question.fieldname, []).append(entry)
+    return json.dumps(document)
+
+
+def _answers_from_document(submission, question_lookup):
+    answers = []
+    for entries in json.loads(submission.answer_document).values():
+        for entry in entries:
+            question = question_lookup.get(entry["question"])
+            if not question:
+                continue
+            kwargs = {}
+            for column in ANSWER_VALUE_COLUMNS + ANSWER_EXTRA_COLUMNS:
+                if column in entry:
+                    field = Answer._meta.get_field(column)
+                    kwargs[column] = field.to_python(entry[column])
+            answer = Answer(id=entry["id"],
+                            submission=submission,
+                            question=question,
+                            **kwargs)
+            answer._state.adding = False
+            answer._state.db = submission._state.db
+            answers.append(answer)
+    answers.sort(key=lambda a: (a.question_id, a.pk))
+    return answers
+
+
+def refresh_answer_documents(submission_ids):
+    """ Rewrite the answer documents of the submissions from their answer
+    rows. Return a dictionary of submission id to its new document. """
+    submission_ids = list(submission_ids)
+    answers = Answer.objects.filter(submission__in=submission_ids)
+    answers = answers.select_related("question")
+    answers = answers.order_by("submission", "question", "id")
+    grouped = dict((pk, []) for pk in submission_ids)
+    for answer in answers:
+        grouped[answer.submission_id].append(answer)
+    documents = {}
+    for pk, submission_answers in grouped.items():
+        documents[pk] = answer_document(submission_answers)
+        Submission.objects.filter(pk=pk).update(
+            answer_document=documents[pk])
+    return documents
+
+
+def save_answers(submission, answers):
+    """ Save all of a submission's answers with one bulk INSERT rather than one
+    query per answer. Photo answers still save one at a time because saving
+    them writes the uploaded file to storage. Call this inside a transaction
+    so a failure doesn't leave a partial submission behind. """
+    bulk = []
+    for answer in answers:
+        answer.submission = submission
+        if answer.question.option_type == OPTION_TYPE_CHOICES.PHOTO:
+            # The answer document is refreshed once below, not per photo.
+            answer._defer_answer_document = True
+            try:
+                answer.save()
+            finally:
+                answer._defer_answer_document = False
+        else:
+            bulk.append(answer)
+    if bulk:
+        Answer.objects.bulk_create(bulk)
+        # bulk_create doesn't send post_save, so count these by hand.
+        count_answers(bulk, submission)
+    if local_settings.ANSWER_DOCUMENTS:
+        documents = refresh_answer_documents([submission.pk])
+        submission.answer_document = documents[submission.pk]
+    return answers
+
+
+def compute_photo_metadata(answer_ids):
+    """ Store the sha1, the dimensions and the default thumbnail URL of the
+    photo answers, reading each photo from storage once. Return how many
+    answers it updated. """
+    from django.core.files.images import get_image_dimensions  # lazy import
+    answers = Answer.objects.filter(pk__in=list(answer_ids))
+    answers = answers.exclude(image_answer="").order_by("pk")
+    submission_ids = set()
+    updated = 0
+    for answer in answers:
+        image = answer.image_answer
+        try:
+            sha1 = hashlib.sha1()
+            image.open("rb")
+            try:
+                for chunk in image.chunks():
+                    sha1.update(chunk)
+                width, height = get_image_dimensions(image)
+            finally:
+                image.close()
+        except Exception as ex:
+            logging.exception("error reading photo answer %d: %s" % (
+                answer.pk, str(ex)))
+            continue
+        try:
+            thumbnail_url = image.thumbnail.url
+        except Exception as ex:
+            # sorl isn't installed or can't make the thumbnail. Rendering
+            # falls back to the photo itself.
+            logging.warn("error making thumbnail for photo answer %d: %s" % (
+                answer.pk, str(ex)))
+            thumbnail_url = None
+        Answer.objects.filter(pk=answer.pk).update(
+            photo_hash=sha1.hexdigest(),
+            image_width=width,
+            image_height=height,
+            thumbnail_url=thumbnail_url)
+        submission_ids.add(answer.submission_id)
+        updated += 1
+    if submission_ids and local_settings.ANSWER_DOCUMENTS:
+        refresh_answer_documents(submission_ids)
+    return updated
+
+
+_photo_pool = None
+
+_photo_pool_lock = threading.Lock()
+
+
+def queue_photo_metadata(answer_ids):
+    """ Compute the photo metadata of the answers right away, or on the
+    worker pool if settings.PHOTO_METADATA_WORKERS is set. """
+    global _photo_pool
+    answer_ids = list(answer_ids)
+    workers = local_settings.PHOTO_METADATA_WORKERS
+    if not workers:
+        compute_photo_metadata(answer_ids)
+        return
+    with _photo_pool_lock:
+        if _photo_pool is None:
+            _photo_pool = ThreadPool(workers)
+    _photo_pool.apply_async(_compute_photo_metadata_in_worker, (answer_ids,))
+
+
+def _compute_photo_metadata_in_worker(answer_ids):
+    try:
+        compute_photo_metadata(answer_ids)
+    except Exception as ex:
+        logging.exception("error computing photo metadata: %s" % str(ex))
+    finally:
+        # Each worker thread has its own connection.
+        connection.close()
+
+
+def geocode_pending_answers(batch_size=50):
+    """ Fill in the latitude and longitude of up to batch_size distinct
+    addresses among the location answers saved without them. Each address is
+    geocoded once no matter how many answers share it. Addresses the
+    geocoder couldn't find are marked as failed in GeocodeCache and left
+    alone for settings.GEOCODE_RETRY_FAILED_AFTER seconds. Return a
+    dictionary of address to (latitude, longitude), with (None, None) for
+    the ones the geocoder couldn't find. """
+    pending = Answer.objects.filter(
+        question__option_type=OPTION_TYPE_CHOICES.LOCATION,
+        latitude__isnull=True,
+        text_answer__isnull=False).exclude(text_answer="")
+    addresses = pending.order_by().values_list("text_answer", flat=True)
+    retry_after = timedelta(seconds=local_settings.GEOCODE_RETRY_FAILED_AFTER)
+    failed = GeocodeCache.objects.filter(
+        failed_at__gt=timezone.now() - retry_after)
+    failed = set(failed.values_list("address_key", flat=True))
+    looked_up = {}
+    # Read the addresses up front rather than updating answers while a
+    # cursor over them is still open.
+    for address in list(addresses.distinct()):
+        if len(looked_up) >= batch_size:
+            break
+        if GeocodeCache.key_for(address) in failed:
+            continue
+        lat, lng = looked_up[address] = geocode(address)
+        if lat is None or lng is None:
+            _remember_geocode_failure(address)
+        else:
+            located = pending.filter(text_answer=address)
+            if local_settings.ANSWER_DOCUMENTS:
+                ids = list(located.values_list("submission_id", flat=True))
+            located.update(latitude=lat, longitude=lng)
+            if local_settings.ANSWER_DOCUMENTS:
+                refresh_answer_documents(set(ids))
+    return looked_up
+
+
+SURVEY_VERSION_KEY = "crowdsourcing_survey_version_%d"
+
+
+SUBMISSION_VERSION_KEY = "crowdsourcing_submission_version_%d"
+
+
+def survey_version(survey_id):
+    """ A number that changes whenever the survey, its questions, or its
+    reports change. Use it to key anything cached from them. """
+    return cache_version(SURVEY_VERSION_KEY % survey_id)
+
+
+def submission_version(survey_id):
+    """ A number that changes whenever a submission to the survey, or one of
+    its answers, is added, changed, moderated or deleted. """
+    return cache_version(SUBMISSION_VERSION_KEY % survey_id)
+
+
+MAP_VERSION_KEY = "crowdsourcing_map_version_%d"
+
+
+def map_version(survey_id):
+    """ A number that changes whenever a submission to the survey, or one of
+    its answers, is changed, moderated or deleted. Unlike submission_version,
+    new submissions leave it alone, since maps add their points as they
+    come. """
+    return cache_version(MAP_VERSION_KEY % survey_id)
+
+
+def _bump_on_commit(key):
+    # Wait for the commit so that nothing caches the old data again under
+    # the new version in the meantime.
+    transaction.on_commit(lambda: bump_cache_version(key))
+
+
+COMPILED_SURVEY_KEY = "crowdsourcing_compiled_survey_%d"
+
+
+SURVEY_ID_KEY = "crowdsourcing_survey_id_%s"
+
+
+class CompiledSurvey(object):
+    """ A survey with everything the views read from its definition on every
+    request: the questions in order, with their options parsed and their
+    value columns worked out, and the default report. None of that changes
+    until someone edits the survey, so get_compiled_survey keeps one per
+    survey, both in the process and in the cache, until the survey's
+    version changes. """
+
+    def __init__(self, survey, version):
+        self.version = version
+        self.survey = survey
+        self.questions = list(survey.questions.order_by("order"))
+        for question in self.questions:
+            question.survey = survey
+            question.parsed_options
+            question.value_column
+        # Survey.get_fields keeps its questions here.
+        survey.__dict__["_fields"] = self.questions
+        # Fetch the default report now rather than on every request.
+        survey.default_report
+
+    def get_survey(self):
+        """ A copy of the survey for one request to use, so that whatever
+        the request sets on it doesn't leak into other requests. """
+        return copy(self.survey)
+
+
+_compiled_surveys = {}
+
+
+def get_compiled_survey(slug=None, survey_id=None):
+    """ The CompiledSurvey of the survey with the slug or id, or None if
+    there's no such survey. """
+    if survey_id is None:
+        survey_id = cache.get(SURVEY_ID_KEY % slug)
+    compiled = None
+    if survey_id is not None:
+        version = survey_version(survey_id)
+        compiled = _compiled_surveys.get(survey_id)
+        if compiled is None or compiled.version != version:
+            compiled = cache.get(COMPILED_SURVEY_KEY % survey_id)
+            if compiled is not None and compiled.version == version:
+                _compiled_surveys[survey_id] = compiled
+            else:
+                compiled = None
+    if compiled is not None and slug is not None and \
+            compiled.survey.slug != slug:
+        # The slug moved to another survey.
+        compiled = None
+    record_cache(compiled is not None)
+    if compiled is None:
+        surveys = Survey.objects.all()
+        if slug is not None:
+            surveys = surveys.filter(slug=slug)
+        else:
+            surveys = surveys.filter(pk=survey_id)
+        survey = surveys.first()
+        if survey is None:
+            return None
+        compiled = CompiledSurvey(survey, survey_version(survey.pk))
+        _compiled_surveys[survey.pk] = compiled
+        cache.set(COMPILED_SURVEY_KEY % survey.pk, compiled)
+        cache.set(SURVEY_ID_KEY % survey.slug, survey.pk)
+    return compiled
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+@receiver(post_save, sender=SurveyReport)
+@receiver(post_delete, sender=SurveyReport)
+def _survey_part_changed(sender, instance, **kwargs):
+    _bump_on_commit(SURVEY_VERSION_KEY % instance.survey_id)
+
+
+@receiver(post_save, sender=Section)
+@receiver(post_delete, sender=Section)
+def _section_changed(sender, instance, **kwargs):
+    _bump_on_commit(SURVEY_VERSION_KEY % instance.survey_id)
+
+
+@receiver(post_save, sender=Survey)
+@receiver(post_delete, sender=Survey)
+def _survey_changed(sender, instance, **kwargs):
+    _bump_on_commit(SURVEY_VERSION_KEY % instance.pk)
+
+
+@receiver(post_save, sender=SurveyReportDisplay)
+@receiver(post_delete, sender=SurveyReportDisplay)
+def _report_display_changed(sender, instance, **kwargs):
+    try:
+        survey_id = instance.report.survey_id
+    except SurveyReport.DoesNotExist:
+        return
+    _bump_on_commit(SURVEY_VERSION_KEY % survey_id)
+
+
+@receiver(post_save, sender=Submission)
+@receiver(post_delete, sender=Submission)
+def _submission_changed(sender, instance, **kwargs):
+    _bump_on_commit(SUBMISSION_VERSION_KEY % instance.survey_id)
+
+
+@receiver(post_save, sender=Answer)
+def _photo_answer_saved(sender, instance, raw=False, **kwargs):
+    if raw or not instance.image_answer:
+        return
+    pk = instance.pk
+    # The workers need the committed row to find the photo.
+    transaction.on_commit(lambda: queue_photo_metadata([pk]))
+
+
+@receiver(post_save, sender=Answer)
+@receiver(post_delete, sender=Answer)
+def _answer_changed(sender, instance, **kwargs):
+    try:
+        survey_id = instance.question.survey_id
+    except Question.DoesNotExist:
+        return
+    _bump_on_commit(SUBMISSION_VERSION_KEY % survey_id)
+
+
+@receiver(post_save, sender=Submission)
+@receiver(post_delete, sender=Submission)
+def _submission_moderated(sender, instance, created=False, **kwargs):
+    if not created:
+        _bump_on_commit(MAP_VERSION_KEY % instance.survey_id)
+
+
+@receiver(post_save, sender=Answer)
+@receiver(post_delete, sender=Answer)
+def _map_answer_changed(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    try:
+        survey_id = instance.question.survey_id
+    except Question.DoesNotExist:
+        return
+    _bump_on_commit(MAP_VERSION_KEY % survey_id)
+
+
+@receiver(pre_save, sender=Answer)
+def _answer_changing(sender, instance, raw=False, **kwargs):
+    instance._rollup_was = None
+    if raw or not instance.pk or not local_settings.ANSWER_COUNT_ROLLUPS:
+        return
+    question = instance.question
+    if question.option_type in ROLLUP_OPTION_TYPES:
+        old = Answer.objects.filter(pk=instance.pk)
+        old = old.values_list(question.value_column, "question_id")[:1]
+        if old:
+            instance._rollup_was = (old[0][1], u"%s" % old[0][0])
+
+
+@receiver(post_save, sender=Answer)
+def _answer_saved(sender, instance, created, raw=False, **kwargs):
+    if raw or not local_settings.ANSWER_COUNT_ROLLUPS:
+        return
+    was = getattr(instance, "_rollup_was", None)
+    counts = defaultdict(int)
+    if was:
+        counts[was] -= 1
+    if instance.question.option_type in ROLLUP_OPTION_TYPES:
+        counts[(instance.question_id, _rollup_value(instance))] += 1
+    if created or was:
+        submission = instance.submission
+        add_answer_counts(counts, submission.is_public, submission.featured)
+
+
+@receiver(post_delete, sender=Answer)
+def _answer_deleted(sender, instance, **kwargs):
+    if not local_settings.ANSWER_COUNT_ROLLUPS:
+        return
+    flags = Submission.objects.filter(pk=instance.submission_id)
+    flags = flags.values_list("is_public", "featured")[:1]
+    # Deleting a submission deletes its answers before the submission itself,
+    # so the submission should still be there.
+    if not flags:
+        return
+    is_public, featured = flags[0]
+    try:
+        question = instance.question
+    except Question.DoesNotExist:
+        return
+    if question.option_type in ROLLUP_OPTION_TYPES:
+        key = (instance.question_id, _rollup_value(instance, question))
+        add_answer_counts({key: -1}, is_public, featured)
+
+
+@receiver(pre_save, sender=Submission)
+def _submission_changing(sender, instance, raw=False, **kwargs):
+    instance._rollup_flags_were = None
+    if raw or not instance.pk or not local_settings.ANSWER_COUNT_ROLLUPS:
+        return
+    old = Submission.objects.filter(pk=instance.pk)
+    old = old.values_list("is_public", "featured")[:1]
+    if old:
+        instance._rollup_flags_were = tuple(old[0])
+
+
+@receiver(post_save, sender=Submission)
+def _submission_saved(sender, instance, raw=False, **kwargs):
+    was = getattr(instance, "_rollup_flags_were", None)
+    if raw or not was or not local_settings.ANSWER_COUNT_ROLLUPS:
+        return
+    if was == (instance.is_public, instance.featured):
+        return
+    answers = instance.answer_set.filter(
+        question__option_type__in=ROLLUP_OPTION_TYPES)
+    counts = defaultdict(int)
+    for answer in answers.select_related("question"):
+        counts[(answer.question_id, _rollup_value(answer))] += 1
+    add_answer_counts(dict((k, -v) for k, v in counts.items()), *was)
+    add_answer_counts(counts, instance.is_public, instance.featured)
+
+
+@receiver(post_save, sender=Answer)
+@receiver(post_delete, sender=Answer)
+def _answer_document_changed(sender, instance, raw=False, **kwargs):
+    if getattr(instance, "_defer_answer_document", False):
+        return
+    if not raw and local_settings.ANSWER_DOCUMENTS:
+        refresh_answer_documents([instance.submission_id])
+
+
+def ensure_answer_indexes(using="default"):
+    """ Add the index_together indexes of Submission and Answer that an
+    existing database lacks, since crowdsourcing has no migrations, and the
+    (question_id, text_answer) index, which index_together can't declare on
+    every database. Return the names of the indexes it created. """
+    db = connections[using]
+    created = []
+    with db.cursor() as cursor:
+        tables = db.introspection.table_names(cursor)
+        with db.schema_editor() as editor:
+            for model in (Submission, Answer):
+                table = model._meta.db_table
+                if table not in tables:
+                    continue
+                constraints = db.introspection.get_constraints(cursor, table)
+                existing = set(tuple(c["columns"])
+                               for c in constraints.values())
+                wanted = model._meta.index_together
+                # Tell the schema editor the database already has the ones
+                # it has, so that it only creates the rest.
+                found = [names for names in wanted
+                         if tuple(model._meta.get_field(name).column
+                                  for name in names) in existing]
+                if len(found) < len(wanted):
+                    editor.alter_index_together(model, found, wanted)
+                    after = db.introspection.get_constraints(cursor, table)
+                    created.extend(sorted(set(after) - set(constraints)))
+                if model is Answer and \
+                        ("question_id", "text_answer") not in existing:
+                    sql = _text_answer_index_sql(editor)
+                    if sql:
+                        editor.execute(sql)
+                        created.append(_TEXT_ANSWER_INDEX)
+    return created
+
+
+_TEXT_ANSWER_INDEX = "crowdsourcing_answer_question_text_idx"
+
+
+def _text_answer_index_sql(editor):
+    vendor = editor.connection.vendor
+    if vendor == "mysql":
+        # MySQL can only index a prefix of a TEXT column.
+        columns = "question_id, text_answer(255)"
+    elif vendor == "sqlite":
+        columns = "question_id, text_answer"
+    else:
+        # PostgreSQL rejects index rows over about 2.7kB, which a long
+        # text answer can exceed, and Oracle can't index an NCLOB at all.
+        return None
+    return "CREATE INDEX %s ON %s (%s)" % (
+        editor.quote_name(_TEXT_ANSWER_INDEX),
+        editor.quote_name(Answer._meta.db_table),
+        columns)
+
+
+@receiver(post_migrate)
+def _add_answer_indexes(sender, using="default", **kwargs):
+    if sender.name == "crowdsourcing":
+        ensure_answer_indexes(using)
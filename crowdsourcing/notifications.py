@@ -0,0 +1,174 @@
+"""
+Notification emails that surveys with an email address send for every new
+submission. settings.SURVEY_EMAIL_BACKEND picks how they go out.
+"""
+from __future__ import absolute_import
+
+import logging
+import smtplib
+from datetime import timedelta
+from itertools import groupby
+
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.html import escape
+from django.utils.translation import ugettext as _
+
+import crowdsourcing.settings as crowdsourcing_settings
+from crowdsourcing.models import SurveyEmail, get_all_answers
+
+admin_app_name = crowdsourcing_settings.CROWDSOURCING_ADMIN_APP_NAME
+
+
+def send_survey_email(request, survey, submission):
+    """ Send the notification right away, during the request. """
+    html_email = render_survey_email(submission, _site_url(request))
+    email_msg = _email_message(survey.title,
+                               html_email,
+                               _recipients(survey))
+    try:
+        email_msg.send()
+    except smtplib.SMTPException as ex:
+        logging.exception("SMTP error sending email: %s" % str(ex))
+    except Exception as ex:
+        logging.exception("Unexpected error sending email: %s" % str(ex))
+
+
+def queue_survey_email(request, survey, submission):
+    """ Store the notification in the outbox. Run
+    ./manage.py send_survey_emails to deliver it. """
+    site_url = _site_url(request)
+    SurveyEmail.objects.bulk_create([
+        SurveyEmail(submission=submission, recipient=r, site_url=site_url)
+        for r in _recipients(survey)])
+
+
+# How long a worker has to send the emails it claimed before another worker
+# may take them over, in case it died in the middle.
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def due_survey_emails(max_attempts=None, now=None):
+    """ The outbox emails that haven't been sent or failed max_attempts times
+    and aren't waiting to be retried or claimed by a worker. """
+    if max_attempts is None:
+        max_attempts = crowdsourcing_settings.SURVEY_EMAIL_MAX_ATTEMPTS
+    if now is None:
+        now = timezone.now()
+    due = Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)
+    return SurveyEmail.objects.filter(due,
+                                      sent_at__isnull=True,
+                                      attempts__lt=max_attempts)
+
+
+def send_queued_survey_emails(batch_size=100, max_attempts=None):
+    """ Deliver up to batch_size outbox emails over a single connection. Each
+    recipient gets one email for all of their pending notifications. Failed
+    emails stay in the outbox, waiting longer after each failure, until they
+    have failed max_attempts times. Each email is claimed before it's sent so
+    that workers running at the same time don't send it twice. Return the
+    number of notifications sent. """
+    now = timezone.now()
+    due = due_survey_emails(max_attempts, now)
+    queued = due.select_related("submission__survey")
+    queued = list(queued.order_by("recipient", "created_at")[:batch_size])
+    # Another worker may have claimed some of them since.
+    queued = [email for email in queued if due.filter(pk=email.pk).update(
+        next_attempt_at=now + CLAIM_TIMEOUT)]
+    if not queued:
+        return 0
+    submissions = set(email.submission for email in queued)
+    answer_lookup = get_all_answers(submissions,
+                                    include_private_questions=True)
+    sent = 0
+    connection = get_connection()
+    for recipient, emails in groupby(queued, lambda e: e.recipient):
+        emails = list(emails)
+        parts = [render_survey_email(e.submission,
+                                     e.site_url,
+                                     answer_lookup.get(e.submission.pk, []))
+                 for e in emails]
+        titles = set(e.submission.survey.title for e in emails)
+        if len(titles) == 1:
+            subject = titles.pop()
+        else:
+            subject = _("%d new survey submissions") % len(emails)
+        email_msg = _email_message(subject,
+                                   "<br/>\n<hr/>\n".join(parts),
+                                   [recipient],
+                                   connection=connection)
+        ids = [e.pk for e in emails]
+        try:
+            email_msg.send()
+        except Exception as ex:
+            logging.exception("Error sending email to %s: %s" % (recipient,
+                                                                 str(ex)))
+            delay = crowdsourcing_settings.SURVEY_EMAIL_RETRY_DELAY
+            for email in emails:
+                wait = timedelta(seconds=delay * 2 ** email.attempts)
+                SurveyEmail.objects.filter(pk=email.pk).update(
+                    attempts=F("attempts") + 1,
+                    last_error=str(ex),
+                    next_attempt_at=timezone.now() + wait)
+        else:
+            SurveyEmail.objects.filter(pk__in=ids).update(
+                attempts=F("attempts") + 1,
+                sent_at=timezone.now(),
+                next_attempt_at=None)
+            sent += len(ids)
+    connection.close()
+    return sent
+
+
+def render_survey_email(submission, site_url, answers=None):
+    survey = submission.survey
+    links = [(_url_for_edit(site_url, submission), _("Edit Submission")),
+             (_url_for_edit(site_url, survey), _("Edit Survey")), ]
+    if survey.can_have_public_submissions():
+        url = site_url + reverse('survey_default_report_page_1',
+                                 kwargs={'slug': survey.slug})
+        links.append((url, _("View Survey"),))
+    parts = ["<a href=\"%s\">%s</a>" % link for link in links]
+    if answers is None:
+        answers = submission.answer_set.select_related("question")
+    lines = ["%s: %s" % (a.question.label, escape(a.value),) for a in answers]
+    parts.extend(lines)
+    return "<br/>\n".join(parts)
+
+
+def _url_for_edit(site_url, obj):
+    view_args = (obj._meta.app_label, obj._meta.model_name,)
+    try:
+        s = admin_app_name + ":%s_%s_change"
+        edit_url = reverse(s % view_args, args=(obj.id,))
+    except NoReverseMatch:
+        # Probably 'admin' is not a registered namespace on a site without an
+        # admin. Just fake it.
+        edit_url = "/{}/{}".format(admin_app_name, "%s/%s/%d/" % (view_args + (obj.id,)))
+    admin_url = crowdsourcing_settings.SURVEY_ADMIN_SITE
+    if not admin_url:
+        admin_url = site_url
+    elif len(admin_url) < 4 or admin_url[:4].lower() != "http":
+        admin_url = site_url.split("//")[0] + "//" + admin_url
+    return admin_url + edit_url
+
+
+def _site_url(request):
+    http = "http{}://".format("s" if request.is_secure() else "")
+    return http + request.META["HTTP_HOST"]
+
+
+def _recipients(survey):
+    return [a.strip() for a in survey.email.split(",") if a.strip()]
+
+
+def _email_message(subject, html_email, recipients, connection=None):
+    email_msg = EmailMultiAlternatives(subject,
+                                       html_email,
+                                       crowdsourcing_settings.SURVEY_EMAIL_FROM,
+                                       recipients,
+                                       connection=connection)
+    email_msg.attach_alternative(html_email, 'text/html')
+    return email_msg
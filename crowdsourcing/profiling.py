@@ -0,0 +1,190 @@
+"""
+Opt-in profiling of crowdsourcing's views and template tags. Add
+'crowdsourcing.profiling.ProfilingMiddleware' to your middleware to record the
+number of queries, the database time, the Python time, and the cache hits and
+misses of every crowdsourcing view and of the template tags it renders. See
+settings.PROFILE_HEADERS, settings.PROFILE_SINK, and settings.QUERY_BUDGETS.
+"""
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+import crowdsourcing.settings as crowdsourcing_settings
+from crowdsourcing.util import get_function
+
+logger = logging.getLogger("crowdsourcing.profiling")
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    """ A view or template tag ran more queries than settings.QUERY_BUDGETS
+    allows. This is an AssertionError so that it fails tests. """
+
+
+class Profile(object):
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.db_time = 0.0
+        self.total_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # The profiles of the template tags rendered inside this one.
+        self.children = []
+        self._started_at = time.time()
+        self._log_starts = dict((c.alias, len(c.queries_log))
+                                for c in connections.all())
+
+    @property
+    def python_time(self):
+        return max(self.total_time - self.db_time, 0.0)
+
+    def finish(self):
+        self.total_time = time.time() - self._started_at
+        for connection in connections.all():
+            start = self._log_starts.get(connection.alias, 0)
+            for query in islice(connection.queries_log, start, None):
+                self.queries += 1
+                self.db_time += float(query["time"])
+
+    def as_dict(self):
+        return dict(name=self.name,
+                    queries=self.queries,
+                    db_time=self.db_time,
+                    python_time=self.python_time,
+                    cache_hits=self.cache_hits,
+                    cache_misses=self.cache_misses,
+                    children=[c.as_dict() for c in self.children])
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+@contextmanager
+def profile(name, force=False):
+    """ Record the cost of the block as name, if the request is being
+    profiled or force is True, and check it against name's query budget.
+    Yield the Profile, or None if nothing is being profiled. """
+    stack = _stack()
+    if not stack and not force:
+        yield None
+        return
+    debug_cursors = [(c, c.force_debug_cursor) for c in connections.all()]
+    for connection, _ in debug_cursors:
+        connection.force_debug_cursor = True
+        if not stack:
+            # The queries log is a deque that drops its oldest queries once
+            # it's full, after which its length stops growing and the
+            # profiles would count nothing. So each profiled view starts
+            # with an empty log.
+            connection.queries_log.clear()
+    current = Profile(name)
+    if stack:
+        stack[-1].children.append(current)
+    stack.append(current)
+    try:
+        yield current
+    finally:
+        stack.pop()
+        current.finish()
+        for connection, was in debug_cursors:
+            connection.force_debug_cursor = was
+    check_budget(current)
+
+
+def check_budget(current):
+    budget = crowdsourcing_settings.QUERY_BUDGETS.get(current.name)
+    if budget is not None and current.queries > budget:
+        raise QueryBudgetExceeded(
+            "%s ran %d queries but its budget is %d." % (current.name,
+                                                        current.queries,
+                                                        budget))
+
+
+def record_cache(hit):
+    """ Count a cache hit, or a miss if hit is False, for everything being
+    profiled. """
+    for current in _stack():
+        if hit:
+            current.cache_hits += 1
+        else:
+            current.cache_misses += 1
+
+
+def profiled_tag(func):
+    """ Wrap a template tag function so that each call gets profiled. """
+    def wrapper(*args, **kwargs):
+        with profile(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def log_profile(stats):
+    """ The default settings.PROFILE_SINK. """
+    logger.info("%(name)s: %(queries)d queries, %(db_time).3fs database, "
+                "%(python_time).3fs Python, %(cache_hits)d cache hits, "
+                "%(cache_misses)d cache misses" % stats)
+    for child in stats["children"]:
+        log_profile(child)
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """ Profile every request that a crowdsourcing view handles. Queries run
+    while a streaming response streams aren't counted. """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        module = getattr(view_func, "__module__", "") or ""
+        if not module.startswith("crowdsourcing."):
+            return None
+        # Leftovers from a request that failed before process_response.
+        del _stack()[:]
+        request._crowdsourcing_profile = profile(view_func.__name__,
+                                                 force=True)
+        request._crowdsourcing_profile.__enter__()
+        return None
+
+    def process_response(self, request, response):
+        context = getattr(request, "_crowdsourcing_profile", None)
+        if context is None:
+            return response
+        del request._crowdsourcing_profile
+        current = _stack()[-1] if _stack() else None
+        try:
+            context.__exit__(None, None, None)
+        finally:
+            if current:
+                self._report(current, response)
+        # Django silences errors in {% include %}d templates when template
+        # debugging is off, so check the template tags' budgets again here.
+        self._check_budgets(current)
+        return response
+
+    def _check_budgets(self, current):
+        if current:
+            check_budget(current)
+            for child in current.children:
+                self._check_budgets(child)
+
+    def _report(self, current, response):
+        if crowdsourcing_settings.PROFILE_HEADERS:
+            response["X-Crowdsourcing-Queries"] = str(current.queries)
+            response["X-Crowdsourcing-DB-Time"] = "%.3f" % current.db_time
+            response["X-Crowdsourcing-Python-Time"] = "%.3f" % (
+                current.python_time)
+            response["X-Crowdsourcing-Cache"] = "%d hits, %d misses" % (
+                current.cache_hits, current.cache_misses)
+        sink = crowdsourcing_settings.PROFILE_SINK
+        if sink:
+            get_function(sink)(current.as_dict())
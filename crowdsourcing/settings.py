@@ -20,6 +20,25 @@ IMAGE_UPLOAD_PATTERN = getattr(settings,
 # that takes a submission list and a request object.
 PRE_REPORT = getattr(settings, 'CROWDSOURCING_PRE_REPORT', '')
 
+# Cache rendered report pages for this many seconds. Each page is cached
+# separately for staff and everyone else and for every combination of
+# filters. Any new, changed, or moderated submission to the survey, and any
+# change to the survey, its questions, or its reports, invalidates the cached
+# pages right away. 0 turns the cache off. Only turn this on if your report
+# templates and CROWDSOURCING_PRE_REPORT show the same thing to every user.
+REPORT_CACHE_TIMEOUT = getattr(settings,
+                               'CROWDSOURCING_REPORT_CACHE_TIMEOUT',
+                               0)
+
+# Page through report submissions with cursors on (submitted_at, id) in the
+# page links instead of OFFSETs, and cache the total number of submissions.
+# Only the first page and the pages next to the current one get links, since
+# jumping to any other page would need an OFFSET. Reports that use
+# CROWDSOURCING_PRE_REPORT or "Limit results to" always use plain pagination.
+KEYSET_PAGINATION = getattr(settings,
+                            'CROWDSOURCING_KEYSET_PAGINATION',
+                            False)
+
 # If a survey is set to e-mail someone every time someone enters the survey,
 # this will be the return address.
 SURVEY_EMAIL_FROM = getattr(settings, 'CROWDSOURCING_SURVEY_EMAIL_FROM', None)
@@ -28,6 +47,26 @@ if SURVEY_EMAIL_FROM is None:
 if SURVEY_EMAIL_FROM is None:
     SURVEY_EMAIL_FROM = 'donotreply@donotreply.com'
 
+# How crowdsourcing delivers those notification emails. The default sends
+# them during the request. Set this to
+# 'crowdsourcing.notifications.queue_survey_email' to store them in an outbox
+# instead and deliver them with ./manage.py send_survey_emails, or use the
+# path to your own function that takes a request, a survey, and a submission.
+SURVEY_EMAIL_BACKEND = getattr(settings,
+                               'CROWDSOURCING_SURVEY_EMAIL_BACKEND',
+                               'crowdsourcing.notifications.send_survey_email')
+
+# send_survey_emails gives up on an outbox email after this many failures.
+SURVEY_EMAIL_MAX_ATTEMPTS = getattr(settings,
+                                    'CROWDSOURCING_SURVEY_EMAIL_MAX_ATTEMPTS',
+                                    5)
+
+# After a failure send_survey_emails waits this many seconds before trying an
+# outbox email again, doubling the wait after each further failure.
+SURVEY_EMAIL_RETRY_DELAY = getattr(settings,
+                                   'CROWDSOURCING_SURVEY_EMAIL_RETRY_DELAY',
+                                   60)
+
 # This site is for the notification emails that crowdsourcing sends when
 # a user enters a survey. The default is the site the user entered the survey
 # on.
@@ -53,6 +92,68 @@ VIDEO_URL_PATTERNS = getattr(
 # crowdsourcing.templatetags.crowdsourcing.google_map uses this setting.
 GOOGLE_MAPS_API_KEY = getattr(settings, 'CROWDSOURCING_GOOGLE_MAPS_API_KEY', '')
 
+# Set this to True to save location answers without a latitude and longitude
+# and have ./manage.py geocode_answers fill them in later, so that a slow
+# geocoder doesn't slow down submissions. Run it from cron or with --loop. By
+# default location answers are geocoded during the request.
+DEFER_GEOCODING = getattr(settings, 'CROWDSOURCING_DEFER_GEOCODING', False)
+
+# ./manage.py geocode_answers leaves addresses the geocoder couldn't find
+# alone for this many seconds before trying them again.
+GEOCODE_RETRY_FAILED_AFTER = getattr(settings,
+                                     'CROWDSOURCING_GEOCODE_RETRY_FAILED_AFTER',
+                                     60 * 60 * 24)
+
+# The location_question_clusters view groups map points into a grid with this
+# many cells across each 256 pixel map tile, at any zoom level.
+MAP_CLUSTER_CELLS = getattr(settings, 'CROWDSOURCING_MAP_CLUSTER_CELLS', 4)
+
+# Crowdsourcing remembers every address it geocodes in the database. It also
+# keeps this many of them in memory in each process.
+GEOCODE_LRU_SIZE = getattr(settings, 'CROWDSOURCING_GEOCODE_LRU_SIZE', 1000)
+
+# Remember in the cache for this many seconds that the geocoder couldn't find
+# an address, rather than asking it again on every request.
+GEOCODE_FAILURE_TIMEOUT = getattr(settings,
+                                  'CROWDSOURCING_GEOCODE_FAILURE_TIMEOUT',
+                                  600)
+
+# Keep a running count of the answers to each option of the choice, checkbox
+# and numeric list questions so that pie charts and count charts without any
+# filters don't have to count the answer table on every page view. Run
+# ./manage.py rebuild_answer_counts after turning this on, and whenever the
+# counts may have drifted, for example after changing answers with raw SQL or
+# QuerySet.update().
+ANSWER_COUNT_ROLLUPS = getattr(settings,
+                               'CROWDSOURCING_ANSWER_COUNT_ROLLUPS',
+                               False)
+
+# Keep a JSON copy of each submission's answers on the submission so that
+# reports, permalinks, and exports read one column instead of joining every
+# answer row. Submissions without a copy still read the answer table. Run
+# ./manage.py build_answer_documents after turning this on, and again if you
+# turn it off for a while and back on, since the copies aren't kept up to date
+# while it's off.
+ANSWER_DOCUMENTS = getattr(settings, 'CROWDSOURCING_ANSWER_DOCUMENTS', False)
+
+# With 'crowdsourcing.profiling.ProfilingMiddleware' in your middleware,
+# crowdsourcing records the queries, database time, Python time, and cache
+# hits of its views and template tags. This adds them to each response as
+# X-Crowdsourcing-* headers.
+PROFILE_HEADERS = getattr(settings, 'CROWDSOURCING_PROFILE_HEADERS', True)
+
+# The python path to a function that takes the dictionary of profiling stats
+# for each profiled request. The default logs them to the
+# crowdsourcing.profiling logger. Set it to '' to turn that off.
+PROFILE_SINK = getattr(settings,
+                       'CROWDSOURCING_PROFILE_SINK',
+                       'crowdsourcing.profiling.log_profile')
+
+# A dictionary of view or template tag name, like 'survey_report' or
+# 'yahoo_pie_chart', to the most queries it may run while profiled. Going over
+# raises crowdsourcing.profiling.QueryBudgetExceeded, which fails tests.
+QUERY_BUDGETS = getattr(settings, 'CROWDSOURCING_QUERY_BUDGETS', {})
+
 # A dictionary of extra thumbnails for Submission.image_answer, which is a sorl
 # ImageWithThumbnailsField. For example, {'slideshow': {'size': (620, 350)}}
 # max_enlarge is in case users upload huge images that enlarge far too big.
@@ -61,3 +162,13 @@ EXTRA_THUMBNAILS = {
     'max_enlarge': {'size': (1000, 1000)}
 }
 EXTRA_THUMBNAILS.update(getattr(settings, 'CROWDSOURCING_EXTRA_THUMBNAILS', {}))
+
+# Crowdsourcing works out the sha1, the dimensions and the default thumbnail of
+# each uploaded photo once, after the submission commits, so that report pages
+# only read what it stored. By default the request does that work itself. Set
+# this to a number of threads per process to hand it to a pool instead; work
+# still queued there is lost if the process exits. ./manage.py
+# build_photo_metadata fills in photos uploaded before, or that were missed.
+PHOTO_METADATA_WORKERS = getattr(settings,
+                                 'CROWDSOURCING_PHOTO_METADATA_WORKERS',
+                                 0)
@@ -5,9 +5,9 @@ import logging
 from django import template
 from django.contrib.sites.models import Site
 from django.core.cache import cache
-from django.core.files.images import get_image_dimensions
 from django.core.urlresolvers import reverse
-from django.utils.html import escape, strip_tags
+from django.utils.html import escape, escapejs, strip_tags
+from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
@@ -17,10 +17,11 @@ except ImportError:
     ThumbnailException = Exception
 
 from crowdsourcing.models import (
-    extra_from_filters, AggregateResultCount, AggregateResultSum,
-    AggregateResultAverage, AggregateResult2AxisCount, Answer, FILTER_TYPE,
-    OPTION_TYPE_CHOICES, SURVEY_AGGREGATE_TYPE_CHOICES, get_all_answers)
-from crowdsourcing.views import location_question_results
+    extra_from_filters, Answer, FILTER_TYPE, OPTION_TYPE_CHOICES,
+    SURVEY_AGGREGATE_TYPE_CHOICES, get_all_answers)
+from crowdsourcing.profiling import profiled_tag, record_cache
+from crowdsourcing.views import (
+    CURSOR_PARAMS, _normalized_get, chart_results, location_question_results)
 from crowdsourcing.util import ChoiceEnum, get_function
 from crowdsourcing import settings as local_settings
 
@@ -48,6 +49,22 @@ else:
 register = template.Library()
 
 
+def simple_tag(func):
+    """ register.simple_tag, except that each use of the tag in a template gets
+    profiled when crowdsourcing.profiling is on. Calling the function directly
+    doesn't. """
+    register.simple_tag(func)
+    compile_func = register.tags[func.__name__]
+
+    def compile_profiled(parser, token):
+        node = compile_func(parser, token)
+        node.func = profiled_tag(func)
+        return node
+
+    register.tags[func.__name__] = compile_profiled
+    return func
+
+
 def yahoo_api():
     return mark_safe("\n".join([
         '<script src="http://yui.yahooapis.com/2.8.1/build/yuiloader/yuiloader-min.js"></script>',
@@ -56,7 +73,7 @@ def yahoo_api():
         '</style>']))
 
 
-register.simple_tag(yahoo_api)
+simple_tag(yahoo_api)
 
 
 def jquery_and_google_api():
@@ -74,7 +91,7 @@ def jquery_and_google_api():
         '</script>']))
 
 
-register.simple_tag(jquery_and_google_api)
+simple_tag(jquery_and_google_api)
 
 
 def filter(wrapper_format, key, label, html):
@@ -82,7 +99,7 @@ def filter(wrapper_format, key, label, html):
     return mark_safe(wrapper_format % (label_html + html))
 
 
-register.simple_tag(filter)
+simple_tag(filter)
 
 
 def select_filter(wrapper_format, key, label, value, choices, blank=True):
@@ -104,7 +121,7 @@ def select_filter(wrapper_format, key, label, value, choices, blank=True):
     return filter(wrapper_format, key, label, "\n".join(html))
 
 
-register.simple_tag(select_filter)
+simple_tag(select_filter)
 
 
 def range_filter(wrapper_format, key, label, from_value, to_value):
@@ -120,7 +137,7 @@ def range_filter(wrapper_format, key, label, from_value, to_value):
     return filter(wrapper_format, key, label, "\n".join(html))
 
 
-register.simple_tag(range_filter)
+simple_tag(range_filter)
 
 
 def distance_filter(wrapper_format, key, label, within_value, location_value):
@@ -136,7 +153,7 @@ def distance_filter(wrapper_format, key, label, within_value, location_value):
     return filter(wrapper_format, key, label, "\n".join(html))
 
 
-register.simple_tag(distance_filter)
+simple_tag(distance_filter)
 
 
 def filter_as_li(filter):
@@ -163,7 +180,7 @@ def filter_as_li(filter):
     return mark_safe("\n".join(output))
 
 
-register.simple_tag(filter_as_li)
+simple_tag(filter_as_li)
 
 
 def filters_as_ul(filters):
@@ -178,25 +195,19 @@ def filters_as_ul(filters):
     return mark_safe("\n".join(out))
 
 
-register.simple_tag(filters_as_ul)
+simple_tag(filters_as_ul)
 
 
 def yahoo_pie_chart(display, question, request_get, is_staff=False):
-    report = display.get_report()
-    survey = report.survey
-    aggregate = AggregateResultCount(survey,
-                                     question,
-                                     request_get,
-                                     report,
-                                     is_staff=is_staff)
-    if not aggregate.answer_values:
+    if not chart_results(display, question, request_get, is_staff):
         return ""
     fieldname = question.fieldname
     args = {
-        "answer_string": aggregate.yahoo_answer_string,
+        "data_url": _chart_data_url(display, question, request_get),
         "option_setup": "",
         "chart_type": "PieChart",
-        "response_schema": '{fields: ["%s", "count"]}' % fieldname,
+        "response_schema": '{resultsList: "results", fields: ["%s", "count"]}'
+                           % fieldname,
         "options": "dataField: 'count', categoryField: '%s'" % fieldname,
         "style": """
             {padding: 20,
@@ -212,7 +223,7 @@ def yahoo_pie_chart(display, question, request_get, is_staff=False):
     return _yahoo_chart(display, "%d_%d" % id_args, args)
 
 
-register.simple_tag(yahoo_pie_chart)
+simple_tag(yahoo_pie_chart)
 
 
 def yahoo_bar_chart(display, request_get, is_staff=False):
@@ -222,7 +233,7 @@ def yahoo_bar_chart(display, request_get, is_staff=False):
                                         is_staff=is_staff)
 
 
-register.simple_tag(yahoo_bar_chart)
+simple_tag(yahoo_bar_chart)
 
 
 def yahoo_line_chart(display, request_get, is_staff=False):
@@ -232,7 +243,14 @@ def yahoo_line_chart(display, request_get, is_staff=False):
                                         is_staff=is_staff)
 
 
-register.simple_tag(yahoo_line_chart)
+simple_tag(yahoo_line_chart)
+
+
+AGGREGATE_FUNCTIONS = {
+    SURVEY_AGGREGATE_TYPE_CHOICES.DEFAULT: "Sum",
+    SURVEY_AGGREGATE_TYPE_CHOICES.SUM: "Sum",
+    SURVEY_AGGREGATE_TYPE_CHOICES.AVERAGE: "Average",
+    SURVEY_AGGREGATE_TYPE_CHOICES.COUNT: "Count"}
 
 
 def _yahoo_bar_line_chart_helper(display,
@@ -251,37 +269,12 @@ def _yahoo_bar_line_chart_helper(display,
         message = ("This chart uses x axis '%s' which isn't a question in "
                    "this survey.") % display.x_axis_fieldname
         return issue(message)
-    single_count = False
-    report = display.get_report()
-    if display.aggregate_type in [SATC.DEFAULT, SATC.SUM]:
-        aggregate_function = "Sum"
-        aggregate = AggregateResultSum(y_axes, x_axis, request_get, report)
-    elif display.aggregate_type == SATC.AVERAGE:
-        aggregate_function = "Average"
-        aggregate = AggregateResultAverage(y_axes, x_axis, request_get, report)
-    elif display.aggregate_type == SATC.COUNT:
-        aggregate_function = "Count"
-        if y_axes:
-            aggregate = AggregateResult2AxisCount(
-                y_axes,
-                x_axis,
-                request_get,
-                report)
-        else:
-            single_count = True
-            survey = x_axis.survey
-            aggregate = AggregateResultCount(
-                survey,
-                x_axis,
-                request_get,
-                report,
-                is_staff=is_staff)
-    if not aggregate.answer_values:
+    if not chart_results(display, None, request_get, is_staff):
         return ""
-    answer_string = aggregate.yahoo_answer_string
+    aggregate_function = AGGREGATE_FUNCTIONS[display.aggregate_type]
     series = []
     series_format = '{displayName: "%s", yField: "%s", style: {size: 10}}'
-    if single_count:
+    if display.aggregate_type == SATC.COUNT and not y_axes:
         y_axis_label = "Count"
         fieldnames = ["count", x_axis.fieldname]
         series.append(series_format % ("Count", "count"))
@@ -312,10 +305,11 @@ def _yahoo_bar_line_chart_helper(display,
     options = ",\n".join(["%s: %s" % item for item in options.items()])
     fieldnames_str = ", ".join(['"%s"' % f for f in fieldnames])
     args = {
-        "answer_string": answer_string,
+        "data_url": _chart_data_url(display, None, request_get),
         "option_setup": option_setup,
         "chart_type": chart_type,
-        "response_schema": '{fields: [%s]}' % fieldnames_str,
+        "response_schema": '{resultsList: "results", fields: [%s]}' % (
+            fieldnames_str),
         "style": '{xAxis: {labelRotation: -45}, yAxis: {titleRotation: -90}}',
         "options": options}
     return_value.append(_yahoo_chart(display, str(index), args))
@@ -328,6 +322,25 @@ def _yahoo_bar_line_chart_helper(display,
     return mark_safe("\n".join(return_value))
 
 
+def _chart_data_url(display, question, request_get):
+    """ The URL of the chart's data, with the report filters but not the
+    page, so that every page of the report shares it. """
+    report = display.get_report()
+    kwargs = {
+        "slug": report.survey.slug,
+        "display_index": display.index_in_report(),
+        "question_id": question.pk if question else 0}
+    if report.slug:
+        kwargs["report"] = report.slug
+        url = reverse("chart_data", kwargs=kwargs)
+    else:
+        url = reverse("chart_data_default", kwargs=kwargs)
+    get = _normalized_get(request_get, CURSOR_PARAMS)
+    if get:
+        url += "?" + urlencode(get, doseq=True)
+    return url
+
+
 def _yahoo_chart(display, unique_id, args):
     out = [
         '<h2 class="chart_title">%s</h2>' % display.annotation,
@@ -339,6 +352,7 @@ def _yahoo_chart(display, unique_id, args):
         'Adobe Flash Player Download Center</a>.',
         '</div>']
     args.update(
+        data_url=escapejs(args["data_url"]),
         data_var='data%s' % unique_id,
         div_id="chart%s" % unique_id)
     script = """
@@ -346,9 +360,8 @@ def _yahoo_chart(display, unique_id, args):
           yahooChartCallbacks.push(function() {
             YAHOO.widget.Chart.SWFURL =
               "http://yui.yahooapis.com/2.8.0r4/build/charts/assets/charts.swf";
-            var answerData = %(answer_string)s;
-            var %(data_var)s = new YAHOO.util.DataSource(answerData);
-            %(data_var)s.responseType = YAHOO.util.DataSource.TYPE_JSARRAY;
+            var %(data_var)s = new YAHOO.util.XHRDataSource("%(data_url)s");
+            %(data_var)s.responseType = YAHOO.util.DataSource.TYPE_JSON;
             %(data_var)s.responseSchema = %(response_schema)s;
             %(option_setup)s
             var %(div_id)s = new YAHOO.widget.%(chart_type)s(
@@ -415,14 +428,14 @@ def google_map(display, question, report, is_popup=False):
     return mark_safe("\n".join(out))
 
 
-register.simple_tag(google_map)
+simple_tag(google_map)
 
 
 def popup_google_map(display, question, report):
     return google_map(display, question, report, is_popup=True)
 
 
-register.simple_tag(popup_google_map)
+simple_tag(popup_google_map)
 
 
 def simple_slideshow(display, question, request_GET, css):
@@ -437,14 +450,14 @@ def simple_slideshow(display, question, request_GET, css):
         captions = Answer.objects.filter(
             question__fieldname__in=caption_fieldnames,
             question__survey=display.report.survey,
-            submission__is_public=True)
+            submission__is_public=True).select_related("question")
         for caption in captions:
             if caption.submission_id not in caption_lookup:
                 caption_lookup[caption.submission_id] = []
             append = "<div class='caption'>%s</div>" % str(caption.value)
             caption_lookup[caption.submission_id].append(append)
     answers = extra_from_filters(question.answer_set.all(),
-                                 "submission_id",
+                                 "crowdsourcing_answer.submission_id",
                                  display.report.survey,
                                  request_GET)
     for answer in answers:
@@ -468,7 +481,7 @@ def simple_slideshow(display, question, request_GET, css):
     return mark_safe("\n".join(out))
 
 
-register.simple_tag(simple_slideshow)
+simple_tag(simple_slideshow)
 
 
 def load_maps_and_charts():
@@ -478,7 +491,7 @@ def load_maps_and_charts():
         '</script>']))
 
 
-register.simple_tag(load_maps_and_charts)
+simple_tag(load_maps_and_charts)
 
 
 def submission_fields(submission,
@@ -510,21 +523,17 @@ def submission_fields(submission,
             out.append('<div class="field">')
             out.append('<label>%s</label>: ' % question.label)
             if answer.image_answer:
-                valid = True
-                try:
-                    thmb = answer.image_answer.thumbnail.url
-                    args = (thmb, answer.pk,)
-                    out.append('<img src="%s" id="img_%d" />' % args)
-                    x_y = get_image_dimensions(answer.image_answer.file)
-                except ThumbnailException as err:
-                    valid = False
-                    out.append('<div class="error">%s</div>' % str(ex))
-                    print err
+                # Only read what compute_photo_metadata stored, since
+                # opening the photo means a trip to storage.
+                thmb = answer.thumbnail_url or answer.image_answer.url
+                args = (thmb, answer.pk,)
+                out.append('<img src="%s" id="img_%d" />' % args)
                 thumb_width = answer.image_answer.extra_thumbnails['default']["size"][0]
                 # This extra hidden input is in case you want to enlarge
                 # images. Don't bother enlarging images unless we'll increase
                 # their dimensions by at least 10%.
-                if valid and x_y and float(x_y[0]) / thumb_width > 1.1:
+                width = answer.image_width
+                if width and float(width) / thumb_width > 1.1:
                     format = ('<input type="hidden" id="img_%d_full_url" '
                               'value="%s" class="enlargeable" />')
                     enlarge = answer.image_answer
@@ -545,12 +554,13 @@ def submission_fields(submission,
     return mark_safe("\n".join(out))
 
 
-register.simple_tag(submission_fields)
+simple_tag(submission_fields)
 
 
 def video_html(vid, maxheight, maxwidth):
     key = "%s_%d_%d" % (vid, maxheight, maxwidth)
     value = cache.get(key, None)
+    record_cache(bool(value))
     if not value:
         value = "Unable to find video %s." % escape(vid)
         try:
@@ -581,7 +591,7 @@ def submissions(object_list, fields):
     return mark_safe("\n".join(out))
 
 
-register.simple_tag(submissions)
+simple_tag(submissions)
 
 
 def submission_link(submission,
@@ -605,7 +615,7 @@ def submission_link(submission,
     return mark_safe("\n".join(out))
 
 
-register.simple_tag(submission_link)
+simple_tag(submission_link)
 
 
 def paginator(survey, report, pages_to_link, page_obj):
@@ -615,11 +625,23 @@ def paginator(survey, report, pages_to_link, page_obj):
     if report.slug:
         view_name = "survey_report"
         url_args["report"] = report.slug
+    # Keyset pages know the cursor for their neighbors.
+    cursors = {}
+    previous_cursor = getattr(page_obj, "previous_cursor", None)
+    if previous_cursor:
+        cursors[page_obj.previous_page_number()] = "?before=" + previous_cursor
+    next_cursor = getattr(page_obj, "next_cursor", None)
+    if next_cursor:
+        cursors[page_obj.next_page_number()] = "?after=" + next_cursor
+
+    def page_url(page):
+        url_args["page"] = page
+        return reverse(view_name, kwargs=url_args) + cursors.get(page, "")
+
     if len(pages_to_link) > 1:
         out.append('<div class="pages">')
         if page_obj.has_previous():
-            url_args["page"] = page_obj.previous_page_number()
-            url = reverse(view_name, kwargs=url_args)
+            url = page_url(page_obj.previous_page_number())
             out.append('<a href="%s">&laquo; Previous</a>' % url)
         for page in pages_to_link:
             if not page:
@@ -627,18 +649,15 @@ def paginator(survey, report, pages_to_link, page_obj):
             elif page_obj.number == page:
                 out.append(str(page))
             else:
-                url_args["page"] = page
-                url = reverse(view_name, kwargs=url_args)
-                out.append('<a href="%s">%d</a>' % (url, page))
+                out.append('<a href="%s">%d</a>' % (page_url(page), page))
         if page_obj.has_next():
-            url_args["page"] = page_obj.next_page_number()
-            url = reverse(view_name, kwargs=url_args)
+            url = page_url(page_obj.next_page_number())
             out.append('<a href="%s">Next &raquo;</a>' % url)
         out.append("</div>")
     return mark_safe("\n".join(out))
 
 
-register.simple_tag(paginator)
+simple_tag(paginator)
 
 
 def map_key(survey):
@@ -654,7 +673,7 @@ def map_key(survey):
     return mark_safe("\n".join(out))
 
 
-register.simple_tag(map_key)
+simple_tag(map_key)
 
 
 def number_to_javascript(number):
@@ -667,7 +686,7 @@ def issue(message):
     return mark_safe("<div class=\"issue\">%s</div>" % message)
 
 
-register.simple_tag(issue)
+simple_tag(issue)
 
 
 def thanks_for_entering(request, forms, survey, tag='p'):
@@ -677,7 +696,7 @@ def thanks_for_entering(request, forms, survey, tag='p'):
     return ""
 
 
-register.simple_tag(thanks_for_entering)
+simple_tag(thanks_for_entering)
 
 
 def download_tags(survey):
@@ -686,4 +705,4 @@ def download_tags(survey):
         '<p class="download_tags">%s</p>' % survey.get_download_tags()]))
 
 
-register.simple_tag(download_tags)
+simple_tag(download_tags)
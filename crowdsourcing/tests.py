@@ -4,9 +4,79 @@ run these tests with nose.
 
 from __future__ import absolute_import
 
+import hashlib
+import json
+import tempfile
 import unittest
+from cStringIO import StringIO
+from datetime import timedelta
 
-from .models import Survey
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core import mail
+from django.db import connection, transaction
+from django.http import QueryDict
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .forms import forms_for_survey, get_form_plan
+from . import models
+from . import profiling
+from . import settings as crowdsourcing_settings
+from .models import (
+    ARCHIVE_POLICY_CHOICES,
+    AggregateResultCount,
+    AggregateResultSum,
+    Answer,
+    AnswerCount,
+    GeocodeCache,
+    Survey,
+    SurveyEmail,
+    ensure_answer_indexes,
+    extra_from_filters,
+    filter_plan,
+    geocode,
+    get_compiled_survey,
+    geocode_pending_answers,
+    get_all_answers,
+    save_answers)
+from .notifications import queue_survey_email, send_queued_survey_emails
+from .templatetags.crowdsourcing import (
+    paginator, submission_fields, yahoo_pie_chart)
+from .views import (
+    _default_report,
+    _filtered_point_indexes,
+    _map_icons,
+    _map_points,
+    chart_data,
+    location_question_clusters,
+    location_question_results,
+    _iter_submission_data,
+    _iter_xml,
+    _report_cache_key,
+    encode_cursor,
+    pages_to_link_from_keyset_page,
+    paginate_by_keyset_or_404,
+    submissions)
+
+
+class BoundingBoxTestCase(unittest.TestCase):
+    def testBox(self):
+        min_lat, min_lng, max_lat, max_lng = models._bounding_box(40.0, -74.0, 69.1)
+        self.assertAlmostEquals(min_lat, 39.0, 2)
+        self.assertAlmostEquals(max_lat, 41.0, 2)
+        # A degree of longitude is shorter than a degree of latitude at 40N.
+        self.assertTrue(max_lng - min_lng > 2.6)
+        self.assertAlmostEquals((min_lng + max_lng) / 2, -74.0)
+
+    def testWrapsAround(self):
+        self.assertEquals(models._bounding_box(89.5, 0.0, 100)[1::2],
+                          (None, None))
+        self.assertEquals(models._bounding_box(0.0, 179.9, 100)[1::2],
+                          (None, None))
 
 
 class SurveyTestCase(unittest.TestCase):
@@ -14,7 +84,8 @@ class SurveyTestCase(unittest.TestCase):
         self.survey = Survey.objects.create(
             title="Test Survey",
             slug="test-survey",
-            is_published=True)
+            is_published=True,
+            site=Site.objects.get_current())
         self.survey.questions.create(
             fieldname="color",
             question="What is your favorite color?",
@@ -47,6 +118,98 @@ class SurveyTestCase(unittest.TestCase):
 
         self.assertRaises(Survey.DoesNotExist, getit)
 
+    def testWithPublicSubmissions(self):
+        now = timezone.now()
+        day = timedelta(days=1)
+        for policy, name in ARCHIVE_POLICY_CHOICES:
+            for starts_at, ends_at in ((now - day, None),
+                                       (now - day, now + day),
+                                       (now - 2 * day, now - day),
+                                       (now + day, None)):
+                self.survey.archive_policy = policy
+                self.survey.starts_at = starts_at
+                self.survey.ends_at = ends_at
+                self.survey.save()
+                found = Survey.objects.with_public_submissions().filter(
+                    pk=self.survey.pk).exists()
+                self.assertEquals(found,
+                                  self.survey.can_have_public_submissions())
+
+    def testQueryBudget(self):
+        original = crowdsourcing_settings.QUERY_BUDGETS
+        crowdsourcing_settings.QUERY_BUDGETS = {'plan': 1}
+        try:
+            with profiling.profile('survey', force=True) as survey:
+                with profiling.profile('forms') as plan:
+                    get_form_plan(Survey.objects.get(pk=self.survey.pk))
+                    get_form_plan(self.survey)
+            self.assertEquals(survey.children, [plan])
+            self.assertEquals((plan.cache_hits, plan.cache_misses), (1, 1))
+            self.assertEquals(survey.queries, plan.queries)
+
+            def over_budget():
+                with profiling.profile('plan', force=True):
+                    list(Survey.objects.all())
+                    list(Survey.objects.all())
+
+            self.assertRaises(profiling.QueryBudgetExceeded, over_budget)
+            # Still counted once a long-lived connection's log is full.
+            log = connection.queries_log
+            log.extend([{"sql": "", "time": "0.000"}] * log.maxlen)
+            with profiling.profile('survey', force=True) as survey:
+                list(Survey.objects.all())
+            self.assertEquals(survey.queries, 1)
+        finally:
+            crowdsourcing_settings.QUERY_BUDGETS = original
+
+    def testCompiledSurvey(self):
+        compiled = get_compiled_survey(slug=self.survey.slug)
+        with CaptureQueriesContext(connection) as queries:
+            same = get_compiled_survey(slug="test-survey")
+            self.assertTrue(compiled is same)
+            survey = compiled.get_survey()
+            self.assertEquals(len(survey.get_public_fields()), 3)
+            self.assertEquals(survey.icon_questions(), [])
+        self.assertEquals(len(queries), 0)
+        self.assertFalse(survey is compiled.survey)
+        self.survey.questions.create(
+            fieldname='flavor',
+            question='Your favorite flavor',
+            order=4,
+            option_type='select',
+            options='Vanilla\nChocolate',
+            map_icons='vanilla.png\nchocolate.png')
+        compiled = get_compiled_survey(survey_id=self.survey.pk)
+        self.assertEquals(len(compiled.questions), 4)
+        flavor = compiled.get_survey().icon_questions()[0]
+        self.assertEquals(flavor.parsed_option_icon_pairs(),
+                          [('Vanilla', 'vanilla.png'),
+                           ('Chocolate', 'chocolate.png')])
+        self.assertEquals(get_compiled_survey(slug="no-such-survey"), None)
+        # Nothing compiled mid-transaction outlives the commit.
+        with transaction.atomic():
+            flavor.question = 'Your least favorite flavor'
+            flavor.save()
+            stale = get_compiled_survey(survey_id=self.survey.pk)
+        compiled = get_compiled_survey(survey_id=self.survey.pk)
+        self.assertFalse(compiled is stale)
+        self.assertEquals(compiled.questions[-1].question,
+                          'Your least favorite flavor')
+
+    def testFormPlan(self):
+        plan = get_form_plan(self.survey)
+        self.assertTrue(plan is get_form_plan(self.survey))
+        self.survey.questions.create(
+            fieldname='flavor',
+            question='Your favorite flavor',
+            order=4,
+            option_type='select',
+            options='Vanilla\nChocolate')
+        self.assertEquals(len(get_form_plan(self.survey).questions), 4)
+        form = forms_for_survey(self.survey)[-1]
+        choices = [key for key, label in form.fields['answer'].choices]
+        self.assertEquals(choices, ['', 'Vanilla', 'Chocolate'])
+
 
 class SubmissionTestCase(SurveyTestCase):
     def setUp(self):
@@ -82,3 +245,742 @@ class SubmissionTestCase(SurveyTestCase):
         answer.save()
         self.assertEquals(answer.text_answer, e)
         self.assertEquals(self.submission.email, e)
+
+    def testSaveAnswers(self):
+        color = self.survey.questions.get(fieldname='color')
+        email = self.survey.questions.get(fieldname='email')
+        answers = [Answer(question=color), Answer(question=email)]
+        answers[0].value = 'mauve'
+        answers[1].value = 'grappelli@fudgesickle.com'
+        save_answers(self.submission, answers)
+        self.assertEquals(self.submission.answer_set.count(), 2)
+        self.assertEquals(self.submission.get_answer_dict()['color'], 'mauve')
+
+    def testQueuedEmail(self):
+        self.survey.email = 'a@example.com, b@example.com'
+        request = RequestFactory().post('/', HTTP_HOST='example.com')
+        queue_survey_email(request, self.survey, self.submission)
+        queue_survey_email(request, self.survey, self.submission)
+        self.assertEquals(SurveyEmail.objects.count(), 4)
+        del mail.outbox[:]
+        self.assertEquals(send_queued_survey_emails(), 4)
+        self.assertEquals(len(mail.outbox), 2)
+        self.assertFalse(SurveyEmail.objects.filter(sent_at=None).exists())
+
+    def testQueuedEmailRetries(self):
+        self.survey.email = 'a@example.com'
+        request = RequestFactory().post('/', HTTP_HOST='example.com')
+        queue_survey_email(request, self.survey, self.submission)
+        email = SurveyEmail.objects.get()
+        # Claimed by another worker.
+        email.next_attempt_at = timezone.now() + timedelta(minutes=5)
+        email.save()
+        self.assertEquals(send_queued_survey_emails(), 0)
+        email.next_attempt_at = None
+        email.save()
+        original = mail.EmailMultiAlternatives.send
+
+        def fail(self, *args, **kwargs):
+            raise IOError("Connection refused")
+
+        mail.EmailMultiAlternatives.send = fail
+        try:
+            self.assertEquals(send_queued_survey_emails(), 0)
+            # Not due again yet.
+            self.assertEquals(send_queued_survey_emails(), 0)
+        finally:
+            mail.EmailMultiAlternatives.send = original
+        email = SurveyEmail.objects.get()
+        self.assertEquals(email.attempts, 1)
+        self.assertTrue(email.next_attempt_at > timezone.now())
+        email.next_attempt_at = timezone.now()
+        email.save()
+        self.assertEquals(send_queued_survey_emails(), 1)
+
+    def testSendSurveyEmailsCommand(self):
+        self.survey.email = 'a@example.com, b@example.com'
+        request = RequestFactory().post('/', HTTP_HOST='example.com')
+        queue_survey_email(request, self.survey, self.submission)
+        original = mail.EmailMultiAlternatives.send
+
+        def send(self, *args, **kwargs):
+            if self.to == ['a@example.com']:
+                raise IOError("Connection refused")
+            return original(self, *args, **kwargs)
+
+        del mail.outbox[:]
+        mail.EmailMultiAlternatives.send = send
+        try:
+            # The first batch fails, which doesn't hold up the second.
+            call_command('send_survey_emails', batch_size=1, stdout=StringIO())
+        finally:
+            mail.EmailMultiAlternatives.send = original
+        self.assertEquals([m.to for m in mail.outbox], [['b@example.com']])
+        self.assertEquals(SurveyEmail.objects.filter(sent_at=None).count(), 1)
+
+    def testAggregateResultSum(self):
+        flavor = self.survey.questions.create(
+            fieldname='flavor',
+            question='Your favorite flavor',
+            order=4,
+            option_type='select',
+            options='Vanilla\nChocolate')
+        scoops = self.survey.questions.create(
+            fieldname='scoops',
+            question='How many scoops?',
+            order=5,
+            option_type='integer')
+        cones = self.survey.questions.create(
+            fieldname='cones',
+            question='How many cones?',
+            order=6,
+            option_type='integer')
+        for value, scoop_count, cone_count in (('Vanilla', 2, 1),
+                                               ('Vanilla', 3, None),
+                                               ('Chocolate', 1, 1)):
+            submission = self.survey.submission_set.create(
+                ip_address='127.0.0.1')
+            submission.answer_set.create(question=flavor, text_answer=value)
+            submission.answer_set.create(question=scoops,
+                                         integer_answer=scoop_count)
+            if cone_count is not None:
+                submission.answer_set.create(question=cones,
+                                             integer_answer=cone_count)
+        result = AggregateResultSum([scoops, cones], flavor, {})
+        self.assertEquals(result.answer_values, [
+            {'flavor': 'Vanilla', 'scoops': 5, 'cones': 1},
+            {'flavor': 'Chocolate', 'scoops': 1, 'cones': 1}])
+
+    def testAggregateResultNumericXAxis(self):
+        rating = self.survey.questions.create(
+            fieldname='rating',
+            question='How good was it?',
+            order=4,
+            option_type='numeric_select',
+            options='1\n2\n3\n10')
+        scoops = self.survey.questions.create(
+            fieldname='scoops',
+            question='How many scoops?',
+            order=5,
+            option_type='float')
+        for value, scoop_count in ((10, 1.5), (2, 2.0), (10, 0.5)):
+            submission = self.survey.submission_set.create(
+                ip_address='127.0.0.1')
+            submission.answer_set.create(question=rating,
+                                         float_answer=value,
+                                         integer_answer=value)
+            submission.answer_set.create(question=scoops,
+                                         float_answer=scoop_count)
+        result = AggregateResultSum([scoops], rating, {})
+        self.assertEquals([(a['rating'], a['scoops'])
+                           for a in result.answer_values],
+                          [(1, 0), (2, 2.0), (3, 0), (10, 2.0)])
+
+    def testAggregateResultBoolXAxis(self):
+        liked = self.survey.questions.create(
+            fieldname='liked',
+            question='Did you like it?',
+            order=4,
+            option_type='bool')
+        scoops = self.survey.questions.create(
+            fieldname='scoops',
+            question='How many scoops?',
+            order=5,
+            option_type='float')
+        for value, scoop_count in ((True, 1.5), (False, 2.0), (True, 0.5)):
+            submission = self.survey.submission_set.create(
+                ip_address='127.0.0.1')
+            submission.answer_set.create(question=liked,
+                                         boolean_answer=value)
+            submission.answer_set.create(question=scoops,
+                                         float_answer=scoop_count)
+        result = AggregateResultSum([scoops], liked, {})
+        self.assertEquals([(a['liked'], a['scoops'])
+                           for a in result.answer_values],
+                          [(False, 2.0), (True, 2.0)])
+        self.assertTrue(all(type(a['liked']) is bool
+                            for a in result.answer_values))
+
+    def testFilterPlan(self):
+        flavor = self.survey.questions.create(
+            fieldname='flavor',
+            question='Your favorite flavor',
+            order=4,
+            option_type='select',
+            options='Vanilla\nChocolate\nMint',
+            use_as_filter=True,
+            answer_is_public=True)
+        scoops = self.survey.questions.create(
+            fieldname='scoops',
+            question='How many scoops?',
+            order=5,
+            option_type='integer',
+            use_as_filter=True,
+            answer_is_public=True)
+        expected = []
+        for value, scoop_count in (('Vanilla', 2),
+                                   ('Vanilla', 5),
+                                   ('Mint', 2)):
+            submission = self.survey.submission_set.create(
+                ip_address='127.0.0.1')
+            submission.answer_set.create(question=flavor, text_answer=value)
+            submission.answer_set.create(question=scoops,
+                                         integer_answer=scoop_count)
+            if (value, scoop_count) == ('Vanilla', 2):
+                expected.append(submission.pk)
+        get = QueryDict("flavor=Vanilla&scoops_from=1&scoops_to=3")
+        plan = filter_plan(self.survey, get)
+        self.assertTrue(plan is filter_plan(self.survey, get.copy()))
+        # Two bounds out of an open range beat one of three flavors.
+        self.assertEquals([c[0] for c in plan.conditions],
+                          [scoops.id, flavor.id])
+        submissions = extra_from_filters(self.survey.submission_set.all(),
+                                         "crowdsourcing_submission.id",
+                                         self.survey,
+                                         get)
+        self.assertEquals([s.pk for s in submissions], expected)
+        self.assertTrue("EXISTS" in plan.clauses("y_axis.submission_id")[0][0])
+        self.assertTrue(" IN " in plan.clauses("submission_id")[0][0])
+        answers = extra_from_filters(flavor.answer_set.all(),
+                                     "crowdsourcing_answer.submission_id",
+                                     self.survey,
+                                     get)
+        self.assertEquals([a.submission_id for a in answers], expected)
+
+    def testAnswerCountRollups(self):
+        flavor = self.survey.questions.create(
+            fieldname='flavor',
+            question='Your favorite flavor',
+            order=4,
+            option_type='select',
+            options='Vanilla\nChocolate')
+        original = crowdsourcing_settings.ANSWER_COUNT_ROLLUPS
+        crowdsourcing_settings.ANSWER_COUNT_ROLLUPS = True
+        try:
+            answer = Answer(question=flavor)
+            answer.value = 'Vanilla'
+            save_answers(self.submission, [answer])
+            other = self.survey.submission_set.create(ip_address='127.0.0.1')
+            other.answer_set.create(question=flavor, text_answer='Vanilla')
+            other.answer_set.create(question=flavor, text_answer='Chocolate')
+
+            def counts():
+                result = AggregateResultCount(self.survey, flavor, {})
+                return [(a['flavor'], a['count']) for a in result.answer_values]
+
+            self.assertEquals(counts(), [('Vanilla', 2), ('Chocolate', 1)])
+            other.is_public = False
+            other.save()
+            self.assertEquals(counts(), [('Vanilla', 1)])
+            answer = self.submission.answer_set.get(question=flavor)
+            answer.text_answer = 'Chocolate'
+            answer.save()
+            self.assertEquals(counts(), [('Chocolate', 1)])
+            other.is_public = True
+            other.save()
+            other.answer_set.filter(text_answer='Vanilla').get().delete()
+            self.assertEquals(counts(), [('Chocolate', 2)])
+            AnswerCount.objects.filter(count__gt=0).update(count=10)
+            self.assertEquals(counts(), [('Chocolate', 10)])
+            models.rebuild_answer_counts()
+            self.assertEquals(counts(), [('Chocolate', 2)])
+        finally:
+            crowdsourcing_settings.ANSWER_COUNT_ROLLUPS = original
+
+    def testReportCacheKey(self):
+        factory = RequestFactory()
+
+        def key(query):
+            request = factory.get('/report/', query)
+            request.user = AnonymousUser()
+            return _report_cache_key(request, self.survey, '', 1, ['t.html'])
+
+        first = key({'color': 'red', 'flavor': 'mint'})
+        self.assertEquals(first, key([('flavor', 'mint'), ('color', 'red')]))
+        self.assertNotEquals(first, key({'color': 'red'}))
+        self.submission.is_public = False
+        self.submission.save()
+        self.assertNotEquals(first, key({'color': 'red', 'flavor': 'mint'}))
+
+    def testExportChunks(self):
+        color = self.survey.questions.get(fieldname='color')
+        for value in ('red', 'green', 'blue', 'mauve'):
+            submission = self.survey.submission_set.create(
+                ip_address='127.0.0.1',
+                submitted_at=self.submission.submitted_at)
+            submission.answer_set.create(question=color, text_answer=value)
+        submissions = self.survey.submission_set.all()
+        rows = list(_iter_submission_data(submissions, True, chunk_size=2))
+        self.assertEquals([row.get('color') for row in rows],
+                          ['mauve', 'blue', 'green', 'red', None])
+        rows = _iter_submission_data(submissions, True, limit=3, chunk_size=2)
+        self.assertEquals(len(list(rows)), 3)
+
+    def testExportWithFilter(self):
+        flavor = self.survey.questions.create(
+            fieldname='flavor',
+            question='Your favorite flavor',
+            order=4,
+            option_type='select',
+            options='Vanilla\nChocolate',
+            use_as_filter=True,
+            answer_is_public=True)
+        for value in ('Vanilla', 'Chocolate'):
+            submission = self.survey.submission_set.create(
+                ip_address='127.0.0.1')
+            submission.answer_set.create(question=flavor, text_answer=value)
+        request = RequestFactory().get('/', {'survey': self.survey.slug,
+                                             'flavor': 'Vanilla'})
+        request.user = AnonymousUser()
+        response = submissions(request, 'csv')
+        lines = "".join(response.streaming_content).splitlines()
+        self.assertTrue('flavor' in lines[0].split(','))
+        self.assertEquals(len(lines), 2)
+        self.assertTrue('Vanilla' in lines[1])
+
+    def testExportXML(self):
+        rows = [{'color': u'caf\xe9 <noir>'},
+                {'survey': 'test-survey', 'featured': False}]
+        self.assertEquals("".join(_iter_xml(rows)).split("\n")[1], (
+            '<submissions>'
+            '<submission><color>caf\xc3\xa9 &lt;noir&gt;</color></submission>'
+            '<submission><survey>test-survey</survey></submission>'
+            '</submissions>'))
+
+    def testKeysetPagination(self):
+        for i in range(4):
+            self.survey.submission_set.create(
+                ip_address='127.0.0.1',
+                submitted_at=self.submission.submitted_at)
+        submissions = self.survey.submission_set.all()
+        ids = list(submissions.order_by('-submitted_at', '-id').values_list(
+            'id', flat=True))
+
+        def paginate(page, query=''):
+            return paginate_by_keyset_or_404(
+                submissions, page, QueryDict(query), 'test-count', 2)[1]
+
+        first = paginate(1)
+        second = paginate(2, 'after=' + first.next_cursor)
+        third = paginate(3, 'after=' + second.next_cursor)
+        pages = [first, second, third]
+        self.assertEquals([[s.id for s in p.object_list] for p in pages],
+                          [ids[:2], ids[2:4], ids[4:]])
+        self.assertEquals([p.has_next() for p in pages], [True, True, False])
+        self.assertEquals(third.paginator.num_pages, 3)
+        back = paginate(2, 'before=' + third.previous_cursor)
+        self.assertEquals([s.id for s in back.object_list], ids[2:4])
+        self.assertEquals([s.id for s in paginate(2).object_list], ids[2:4])
+        # Fewer than a page before the cursor falls back to the first page.
+        newest = submissions.get(id=ids[1])
+        short = paginate(2, 'before=' + encode_cursor(newest))
+        self.assertEquals([s.id for s in short.object_list], ids[:2])
+        self.assertEquals((short.number, short.has_next()), (1, True))
+        full = paginate(2, 'before=' + second.previous_cursor)
+        self.assertEquals([s.id for s in full.object_list], ids[:2])
+        self.assertTrue(full.has_next())
+        # Every page link is reached by a cursor, except the first page's.
+        self.assertEquals([pages_to_link_from_keyset_page(p) for p in pages],
+                          [[1, 2, False], [1, 2, 3], [1, 2, 3]])
+        html = paginator(self.survey, _default_report(self.survey),
+                         pages_to_link_from_keyset_page(third), third)
+        self.assertTrue('/report/2/?before=%s"' % third.previous_cursor
+                        in html)
+        self.assertFalse('/report/1/?' in html)
+
+    def testAnswerDocument(self):
+        color = self.survey.questions.get(fieldname='color')
+        toppings = self.survey.questions.create(
+            fieldname='toppings',
+            question='Toppings',
+            order=4,
+            option_type='bool_list',
+            options='Nuts\nSprinkles')
+        original = crowdsourcing_settings.ANSWER_DOCUMENTS
+        crowdsourcing_settings.ANSWER_DOCUMENTS = True
+        try:
+            answers = [Answer(question=color),
+                       Answer(question=toppings),
+                       Answer(question=toppings)]
+            for answer, value in zip(answers, ['mauve', 'Nuts', 'Sprinkles']):
+                answer.value = value
+            save_answers(self.submission, answers)
+
+            def values():
+                submission = self.survey.submission_set.get()
+                answers = get_all_answers([submission])[submission.pk]
+                return [(a.question.fieldname, a.value) for a in answers]
+
+            self.assertEquals(values(), [('color', 'mauve'),
+                                         ('toppings', 'Nuts'),
+                                         ('toppings', 'Sprinkles')])
+            # Reads come from the document, not from the answer table.
+            Answer.objects.filter(text_answer='mauve').update(
+                text_answer='teal')
+            self.assertEquals(values()[0], ('color', 'mauve'))
+            answer = Answer.objects.get(text_answer='teal')
+            answer.save()
+            self.assertEquals(values()[0], ('color', 'teal'))
+            answer.delete()
+            self.assertEquals(len(values()), 2)
+        finally:
+            crowdsourcing_settings.ANSWER_DOCUMENTS = original
+
+    def testAnswerDocumentWithPhotos(self):
+        photo = self.survey.questions.create(
+            fieldname='photo',
+            question='Your photo',
+            order=4,
+            option_type='photo')
+        refreshed = []
+        refresh = models.refresh_answer_documents
+
+        def refresh_answer_documents(submission_ids):
+            refreshed.append(list(submission_ids))
+            return refresh(submission_ids)
+
+        original = crowdsourcing_settings.ANSWER_DOCUMENTS
+        crowdsourcing_settings.ANSWER_DOCUMENTS = True
+        models.refresh_answer_documents = refresh_answer_documents
+        try:
+            save_answers(self.submission, [Answer(question=photo),
+                                           Answer(question=photo)])
+        finally:
+            models.refresh_answer_documents = refresh
+            crowdsourcing_settings.ANSWER_DOCUMENTS = original
+        self.assertEquals(refreshed, [[self.submission.pk]])
+
+    def testPhotoMetadata(self):
+        from PIL import Image
+        from django.core.files.base import ContentFile
+        photo = self.survey.questions.create(
+            fieldname='photo',
+            question='Your photo',
+            label='Photo',
+            order=4,
+            option_type='photo')
+        data = StringIO()
+        Image.new("RGB", (600, 400)).save(data, "PNG")
+        original = crowdsourcing_settings.PHOTO_METADATA_WORKERS
+        crowdsourcing_settings.PHOTO_METADATA_WORKERS = 0
+        try:
+            answer = Answer(submission=self.submission, question=photo)
+            answer.image_answer.save("photo.png",
+                                     ContentFile(data.getvalue()),
+                                     save=False)
+            save_answers(self.submission, [answer])
+        finally:
+            crowdsourcing_settings.PHOTO_METADATA_WORKERS = original
+        answer = Answer.objects.get(pk=answer.pk)
+        self.assertEquals(answer.photo_hash,
+                          hashlib.sha1(data.getvalue()).hexdigest())
+        self.assertEquals((answer.image_width, answer.image_height),
+                          (600, 400))
+        self.assertTrue(answer.thumbnail_url)
+        html = submission_fields(self.submission, [photo])
+        self.assertTrue(answer.thumbnail_url in html)
+        self.assertTrue("enlargeable" in html)
+        answer.image_answer.delete(save=False)
+
+    def testMapIcons(self):
+        flavor = self.survey.questions.create(
+            fieldname='flavor',
+            question='Your favorite flavor',
+            order=4,
+            option_type='select',
+            options='Vanilla\nMint\nChocolate',
+            map_icons='vanilla.png\nmint.png')
+        submissions = [self.submission]
+        for i in range(3):
+            submissions.append(self.survey.submission_set.create(
+                ip_address='127.0.0.1'))
+        for submission, value in zip(submissions,
+                                     ('Vanilla', 'Chocolate', 'Mint',
+                                      'Vanilla')):
+            submission.answer_set.create(question=flavor, text_answer=value)
+        ids = [s.pk for s in submissions[:3]]
+        with CaptureQueriesContext(connection) as queries:
+            icons = _map_icons(self.survey.pk, ids)
+        self.assertEquals(icons, {ids[0]: 'vanilla.png', ids[2]: 'mint.png'})
+        self.assertEquals(
+            len([q for q in queries if "crowdsourcing_answer" in q["sql"]]),
+            1)
+        self.assertEquals(_map_icons(self.survey.pk, ids, chunk_size=2),
+                          icons)
+
+    def testLocationClusters(self):
+        where = self.survey.questions.create(
+            fieldname='where',
+            question='Where are you?',
+            order=4,
+            option_type='location')
+        flavor = self.survey.questions.create(
+            fieldname='flavor',
+            question='Your favorite flavor',
+            order=5,
+            option_type='select',
+            options='Vanilla\nChocolate',
+            map_icons='vanilla.png\nchocolate.png')
+        for lat, lng, value in ((40.70, -74.00, 'Vanilla'),
+                                (40.71, -74.01, 'Chocolate'),
+                                (40.72, -74.02, 'Chocolate'),
+                                (34.05, -118.24, 'Vanilla')):
+            submission = self.survey.submission_set.create(
+                ip_address='127.0.0.1')
+            submission.answer_set.create(question=where,
+                                         text_answer='Somewhere',
+                                         latitude=lat,
+                                         longitude=lng)
+            submission.answer_set.create(question=flavor, text_answer=value)
+
+        def clusters(**get):
+            request = RequestFactory().get('/', get)
+            request.user = AnonymousUser()
+            response = location_question_clusters(request, where.pk)
+            if response.status_code != 200:
+                return response.status_code
+            return sorted((e["count"], e.get("icon"), "url" in e)
+                          for e in json.loads(response.content)["entries"])
+
+        self.assertEquals(clusters(bbox="-130,20,-60,50", zoom="4"),
+                          [(1, 'vanilla.png', True),
+                           (3, 'chocolate.png', False)])
+        self.assertEquals(len(clusters(bbox="-130,20,-60,50", zoom="16")), 4)
+        self.assertEquals(clusters(bbox="-80,20,-60,50", zoom="4"),
+                          [(3, 'chocolate.png', False)])
+        self.assertEquals(clusters(bbox="-130,20,-60,50",
+                                   zoom="4",
+                                   flavor="Vanilla"),
+                          [(1, 'vanilla.png', True),
+                           (1, 'vanilla.png', True)])
+        self.assertEquals(clusters(bbox="-130,20"), 400)
+
+    def testMapPoints(self):
+        where = self.survey.questions.create(
+            fieldname='where',
+            question='Where are you?',
+            order=4,
+            option_type='location')
+        flavor = self.survey.questions.create(
+            fieldname='flavor',
+            question='Your favorite flavor',
+            order=5,
+            option_type='select',
+            options='Vanilla\nChocolate',
+            map_icons='vanilla.png\nchocolate.png')
+
+        def submit(lat, value):
+            submission = self.survey.submission_set.create(
+                ip_address='127.0.0.1')
+            submission.answer_set.create(question=where,
+                                         text_answer='Somewhere',
+                                         latitude=lat,
+                                         longitude=-74.0)
+            submission.answer_set.create(question=flavor, text_answer=value)
+            return submission
+
+        def points(**get):
+            request = RequestFactory().get('/', get)
+            request.user = AnonymousUser()
+            response = location_question_results(request, where.pk, None)
+            return [(e["lat"], e.get("icon"), e["url"])
+                    for e in json.loads(response.content)["entries"]]
+
+        first = submit(40.0, 'Vanilla')
+        self.assertEquals(points(), [
+            (40.0, 'vanilla.png', '/crowdsourcing/submission_for_map/%d/' %
+             first.pk)])
+        second = submit(41.0, 'Chocolate')
+        self.assertEquals([p[:2] for p in points()],
+                          [(41.0, 'chocolate.png'), (40.0, 'vanilla.png')])
+        self.assertEquals([p[:2] for p in points(flavor='Vanilla')],
+                          [(40.0, 'vanilla.png')])
+        third = submit(42.0, 'Vanilla')
+        cached = _map_points(where, False, False)
+        vanilla = self.survey.submission_set.filter(
+            answer__question=flavor, answer__text_answer='Vanilla')
+        self.assertEquals(
+            _filtered_point_indexes(cached, vanilla, chunk_size=1), [0, 2])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(_filtered_point_indexes(
+                cached, vanilla, limit=1, chunk_size=1), [0])
+        self.assertEquals(len(queries), 1)
+        third.delete()
+        second.is_public = False
+        second.save()
+        self.assertEquals([p[:2] for p in points()], [(40.0, 'vanilla.png')])
+
+    def testChartData(self):
+        flavor = self.survey.questions.create(
+            fieldname='flavor',
+            question='Your favorite flavor',
+            order=4,
+            option_type='select',
+            options='Vanilla\nChocolate',
+            answer_is_public=True)
+
+        def submit(value):
+            submission = self.survey.submission_set.create(
+                ip_address='127.0.0.1')
+            submission.answer_set.create(question=flavor, text_answer=value)
+
+        def get(**headers):
+            request = RequestFactory().get('/', **headers)
+            request.user = AnonymousUser()
+            return chart_data(request, self.survey.slug, '0', str(flavor.pk))
+
+        display = _default_report(self.survey).get_survey_report_displays()[0]
+        # No answers yet, so there's no chart to load.
+        self.assertEquals(yahoo_pie_chart(display, flavor, QueryDict('')), "")
+        submit('Vanilla')
+        self.assertTrue(yahoo_pie_chart(display, flavor, QueryDict('')))
+        response = get()
+        self.assertEquals(json.loads(response.content)["results"],
+                          [{'flavor': 'Vanilla', 'count': 1}])
+        etag = response["ETag"]
+        self.assertEquals(get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        submit('Chocolate')
+        response = get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response["ETag"], etag)
+        self.assertEquals(len(json.loads(response.content)["results"]), 2)
+
+    def testGeocodePendingAnswers(self):
+        q = self.survey.questions.create(
+            fieldname='home',
+            question='Where do you live?',
+            order=4,
+            option_type='location')
+        for i in range(3):
+            submission = self.survey.submission_set.create(
+                ip_address='127.0.0.1')
+            submission.answer_set.create(question=q, text_answer='Brooklyn')
+        looked_up = []
+
+        def geocode(address):
+            looked_up.append(address)
+            return 40.65, -73.95
+
+        original = models.get_latitude_and_longitude
+        models.get_latitude_and_longitude = geocode
+        try:
+            geocode_pending_answers()
+        finally:
+            models.get_latitude_and_longitude = original
+        self.assertEquals(looked_up, ['Brooklyn'])
+        self.assertEquals(q.answer_set.filter(latitude=40.65).count(), 3)
+
+    def testGeocodePendingFailures(self):
+        q = self.survey.questions.create(
+            fieldname='home',
+            question='Where do you live?',
+            order=4,
+            option_type='location')
+        submission = self.survey.submission_set.create(ip_address='127.0.0.1')
+        submission.answer_set.create(question=q, text_answer='Atlantis')
+        looked_up = []
+
+        def geocode(address):
+            looked_up.append(address)
+            return None, None
+
+        original = models.get_latitude_and_longitude
+        models.get_latitude_and_longitude = geocode
+        try:
+            self.assertEquals(geocode_pending_answers(),
+                              {'Atlantis': (None, None)})
+            self.assertEquals(geocode_pending_answers(), {})
+            failure = GeocodeCache.objects.get(address_key='atlantis')
+            failure.failed_at -= timedelta(days=2)
+            failure.save()
+            cache.clear()
+            self.assertEquals(geocode_pending_answers(),
+                              {'Atlantis': (None, None)})
+        finally:
+            models.get_latitude_and_longitude = original
+            GeocodeCache.objects.all().delete()
+        self.assertEquals(looked_up, ['Atlantis', 'Atlantis'])
+
+    def testGeocodeCache(self):
+        looked_up = []
+
+        def lookup(address):
+            looked_up.append(address)
+            return 40.58, -74.15
+
+        original = models.get_latitude_and_longitude
+        models.get_latitude_and_longitude = lookup
+        try:
+            self.assertEquals(geocode(' Staten  Island'), (40.58, -74.15))
+            self.assertEquals(geocode('staten island'), (40.58, -74.15))
+            models._geocode_lru.clear()
+            self.assertEquals(geocode('STATEN ISLAND'), (40.58, -74.15))
+            self.assertEquals(geocode('Queens', lookup=False), (None, None))
+        finally:
+            models.get_latitude_and_longitude = original
+            GeocodeCache.objects.all().delete()
+        self.assertEquals(looked_up, [' Staten  Island'])
+
+    def testGeocodeFailure(self):
+        looked_up = []
+
+        def lookup(address):
+            looked_up.append(address)
+            return None, None
+
+        original = models.get_latitude_and_longitude
+        models.get_latitude_and_longitude = lookup
+        try:
+            self.assertEquals(geocode('Atlantis'), (None, None))
+            self.assertEquals(geocode('atlantis'), (None, None))
+            self.assertEquals(looked_up, ['Atlantis'])
+            models.remember_geocode('Atlantis', 31.0, -24.0)
+            self.assertEquals(geocode('Atlantis'), (31.0, -24.0))
+        finally:
+            models.get_latitude_and_longitude = original
+            GeocodeCache.objects.all().delete()
+            models._geocode_lru.clear()
+
+    def testEnsureAnswerIndexes(self):
+        def indexes():
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(
+                    cursor, Answer._meta.db_table)
+            return dict((tuple(c["columns"]), name)
+                        for name, c in constraints.items())
+
+        self.assertEquals(ensure_answer_indexes(), [])
+        self.assertTrue(("question_id", "text_answer") in indexes())
+        name = indexes()[("question_id", "integer_answer")]
+        with connection.cursor() as cursor:
+            cursor.execute("DROP INDEX %s" % connection.ops.quote_name(name))
+        self.assertEquals(ensure_answer_indexes(), [name])
+        self.assertEquals(indexes()[("question_id", "integer_answer")], name)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def tearDown(self):
+        Survey.objects.filter(slug__startswith="benchmark-survey").delete()
+
+    def testGenerateAndBenchmark(self):
+        call_command("generate_survey_data",
+                     submissions=20,
+                     seed=1,
+                     stdout=StringIO())
+        survey = Survey.objects.get(slug__startswith="benchmark-survey")
+        self.assertEquals(survey.submission_set.count(), 20)
+        output = tempfile.NamedTemporaryFile(suffix=".json")
+        with output:
+            call_command("benchmark_crowdsourcing",
+                         survey.slug,
+                         repeat=1,
+                         output=output.name,
+                         stdout=StringIO(),
+                         stderr=StringIO())
+            results = json.load(open(output.name))["results"]
+        errors = dict((name, result["error"])
+                      for name, result in results.items()
+                      if "error" in result)
+        self.assertEquals(errors, {})
+        self.assertTrue("export.csv.filtered" in results)
+
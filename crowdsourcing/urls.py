@@ -4,8 +4,10 @@ from django.conf.urls import url
 
 from crowdsourcing.views import (
     allowed_actions,
+    chart_data,
     embeded_survey_questions,
     embeded_survey_report,
+    location_question_clusters,
     location_question_results,
     location_question_map,
     questions,
@@ -29,7 +31,8 @@ urlpatterns = [
         submissions, name='submissions_search_and_format'),
 
     url(r'submission/(?P<id>\d+)/$', submission),
-    url(r'submission_for_map/(?P<id>\d+)/$', submission_for_map),
+    url(r'submission_for_map/(?P<id>\d+)/$', submission_for_map,
+        name='submission_for_map'),
 
     url(r'location_question_results/(?P<question_id>\d+)/(?P<limit_map_answers>\d+)/$',
         location_question_results,
@@ -39,6 +42,14 @@ urlpatterns = [
         location_question_results,
         name="location_question_results"),
 
+    url(r'location_question_clusters/(?P<question_id>\d+)/$',
+        location_question_clusters,
+        name="location_question_clusters"),
+
+    url(r'location_question_clusters/(?P<question_id>\d+)/(?P<survey_report_slug>[-a-z0-9_]*)/$',
+        location_question_clusters,
+        name="location_question_clusters"),
+
     url(r'location_question_map/(?P<question_id>\d+)/(?P<display_id>\d+)/$',
         location_question_map,
         name="location_question_map"),
@@ -69,6 +80,15 @@ urlpatterns = [
         embeded_survey_report,
         name="embeded_survey_report"),
 
+    url(r'(?P<slug>[-a-z0-9_]+)/api/chart/(?P<display_index>\d+)/(?P<question_id>\d+)/$',
+        chart_data,
+        {"report": ""},
+        name="chart_data_default"),
+
+    url(r'(?P<slug>[-a-z0-9_]+)/api/chart/(?P<report>[-a-z0-9_]+)/(?P<display_index>\d+)/(?P<question_id>\d+)/$',
+        chart_data,
+        name="chart_data"),
+
     url(r'(?P<slug>[-a-z0-9_]+)/report/$',
         survey_report,
         name="survey_default_report_page_1"),
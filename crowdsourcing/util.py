@@ -1,5 +1,10 @@
 import itertools
 import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
 from django.utils.module_loading import import_string
 
 
@@ -8,6 +13,61 @@ def get_function(path):
     return import_string(path)
 
 
+def cache_version(key):
+    """ Return the current value of the version counter stored in the cache
+    under key, starting a new counter if there isn't one. Anything cached
+    against the counter goes stale when bump_cache_version changes it. """
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_cache_version(key):
+    cache.set(key, max(_new_version(), cache.get(key, 0) + 1), None)
+
+
+def _new_version():
+    # Milliseconds since the epoch, so a counter that gets evicted from the
+    # cache starts again higher than any value it had before.
+    return int(time.time() * 1000)
+
+
+class LRUCache(object):
+    """ A thread safe, in-process cache that forgets the least recently used
+    key once it holds more than max_size keys. """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
 class ChoiceEnum(object):
     def __init__(self, choices):
         if isinstance(choices, basestring):
@@ -1,44 +1,74 @@
 from __future__ import absolute_import
 
+import hashlib
 import httplib
-import logging
-import smtplib
+from array import array
+from cStringIO import StringIO
 from datetime import datetime
 from itertools import count
-from xml.dom.minidom import Document
+from math import ceil
+from xml.sax.saxutils import XMLGenerator
 
 import unicodecsv as csv
-from django.core.mail import EmailMultiAlternatives
-from django.core.paginator import Paginator, EmptyPage
-from django.core.urlresolvers import reverse, NoReverseMatch
-from django.db.models import Q
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import Paginator, EmptyPage, InvalidPage
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models import (
+    Avg,
+    Count,
+    F,
+    Func,
+    Min,
+    OuterRef,
+    Q,
+    Subquery)
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext as _rc
-from django.utils.html import escape
-from django.utils.translation import ugettext_lazy as _
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.utils.translation import get_language, ugettext_lazy as _
 from django.core import serializers
 
 import crowdsourcing.settings as crowdsourcing_settings
 from crowdsourcing.forms import forms_for_survey, SubmissionFormFilter, SurveyFormFilter
-from crowdsourcing.jsonutils import dump, datetime_to_string
+from crowdsourcing.jsonutils import datetime_to_string, dump, dumps
 from crowdsourcing.models import (
+    AggregateResult2AxisCount,
+    AggregateResultAverage,
+    AggregateResultCount,
+    AggregateResultSum,
+    Answer,
     BALLOT_STUFFING_FIELDS,
     FORMAT_CHOICES,
     OPTION_TYPE_CHOICES,
     Question,
+    SURVEY_AGGREGATE_TYPE_CHOICES,
     SURVEY_DISPLAY_TYPE_CHOICES,
     Submission,
     Survey,
     SurveyReport,
     SurveyReportDisplay,
     extra_from_filters,
+    filter_plan,
     get_all_answers,
-    get_filters)
+    get_compiled_survey,
+    get_filters,
+    map_version,
+    save_answers,
+    submission_version,
+    survey_version)
+from crowdsourcing.profiling import record_cache
 from crowdsourcing.util import get_function
 
-admin_app_name = crowdsourcing_settings.CROWDSOURCING_ADMIN_APP_NAME
-
 
 def _user_entered_survey(request, survey):
     if not request.user.is_authenticated():
@@ -70,10 +100,13 @@ def _login_url(request):
 
 
 def _get_survey_or_404(slug, request=None):
-    manager = Survey.live
-    if request and request.user.is_staff:
-        manager = Survey.objects
-    return get_object_or_404(manager, slug=slug)
+    compiled = get_compiled_survey(slug=slug)
+    if compiled is None:
+        raise Http404
+    survey = compiled.get_survey()
+    if not survey.is_live and not (request and request.user.is_staff):
+        raise Http404
+    return survey
 
 
 def _survey_submit(request, survey):
@@ -117,65 +150,26 @@ def _submit_valid_forms(forms, request, survey):
         submission.object_pk = object_pk
     if request.user.is_authenticated():
         submission.user = request.user
-    submission.save()
+    # Build every answer before opening the transaction so slow work in the
+    # forms, like geocoding locations, doesn't hold it open.
+    answers = []
     for form in forms[1:]:
         answer = form.save(commit=False)
         if isinstance(answer, (list, tuple)):
-            for a in answer:
-                a.submission = submission
-                a.save()
+            answers.extend(answer)
         elif answer:
-            answer.submission = submission
-            answer.save()
+            answers.append(answer)
+    with transaction.atomic():
+        submission.save()
+        save_answers(submission, answers)
     if survey.email:
         _send_survey_email(request, survey, submission)
     return True
 
 
-def _url_for_edit(request, obj):
-    view_args = (obj._meta.app_label, obj._meta.model_name,)
-    try:
-        s = admin_app_name + ":%s_%s_change"
-        edit_url = reverse(s % view_args, args=(obj.id,))
-    except NoReverseMatch:
-        # Probably 'admin' is not a registered namespace on a site without an
-        # admin. Just fake it.
-        edit_url = "/{}/{}".format(admin_app_name, "%s/%s/%d/" % (view_args + (obj.id,)))
-    admin_url = crowdsourcing_settings.SURVEY_ADMIN_SITE
-    http = "http{}://".format("s" if request.is_secure() else "")
-    if not admin_url:
-        admin_url = http + request.META["HTTP_HOST"]
-    elif len(admin_url) < 4 or admin_url[:4].lower() != "http":
-        admin_url = http + admin_url
-    return admin_url + edit_url
-
-
 def _send_survey_email(request, survey, submission):
-    subject = survey.title
-    sender = crowdsourcing_settings.SURVEY_EMAIL_FROM
-    links = [(_url_for_edit(request, submission), _("Edit Submission")),
-             (_url_for_edit(request, survey), _("Edit Survey")), ]
-    http = "http{}://".format("s" if request.is_secure() else "")
-    if survey.can_have_public_submissions():
-        url = http + request.META["HTTP_HOST"] + _survey_report_url(survey)
-        links.append((url, _("View Survey"),))
-    parts = ["<a href=\"%s\">%s</a>" % link for link in links]
-    set = submission.answer_set.all()
-    lines = ["%s: %s" % (a.question.label, escape(a.value),) for a in set]
-    parts.extend(lines)
-    html_email = "<br/>\n".join(parts)
-    recipients = [a.strip() for a in survey.email.split(",")]
-    email_msg = EmailMultiAlternatives(subject,
-                                       html_email,
-                                       sender,
-                                       recipients)
-    email_msg.attach_alternative(html_email, 'text/html')
-    try:
-        email_msg.send()
-    except smtplib.SMTPException as ex:
-        logging.exception("SMTP error sending email: %s" % str(ex))
-    except Exception as ex:
-        logging.exception("Unexpected error sending email: %s" % str(ex))
+    send = get_function(crowdsourcing_settings.SURVEY_EMAIL_BACKEND)
+    send(request, survey, submission)
 
 
 def _survey_show_form(request, survey, forms):
@@ -323,8 +317,6 @@ def submissions(request, format, **kwargs):
     if is_staff:
         results = Submission.objects.all()
     else:
-        # survey.can_have_public_submissions is complicated enough that
-        # we'll check it in Python, not the database.
         results = Submission.objects.filter(is_public=True)
     if kwargs:  # content type filters
         kwargs.update(SubmissionFormFilter.get_field_filters(get))
@@ -406,74 +398,150 @@ def submissions(request, format, **kwargs):
             message = message % (", ".join(basic_filters), item[0], item[1])
             return HttpResponse(message)
     if not is_staff:
-        if survey_slug:
-            if not get_survey().can_have_public_submissions():
-                results = []
-        else:
-            rs = [r for r in results if r.survey.can_have_public_submissions()]
-            results = rs
-    if limit:
-        results = results[:limit]
-    answer_lookup = get_all_answers(results,
-                                    include_private_questions=is_staff)
-    result_data = []
-    for r in results:
-        data = r.to_jsondata(answer_lookup, include_private_questions=is_staff)
-        result_data.append(data)
-
-    for data in result_data:
-        data.update(data["data"])
-        data.pop("data")
-
-    def get_keys():
-        key_lookup = {}
-        for data in result_data:
-            for key in data.keys():
-                key_lookup[key] = True
-        return sorted(key_lookup.keys())
+        results = results.filter(
+            survey__in=Survey.objects.with_public_submissions())
+    rows = _iter_submission_data(results, is_staff, limit)
 
     if format == 'json':
-        response = HttpResponse(content_type='application/json')
-        dump(result_data, response)
+        response = StreamingHttpResponse(_iter_json(rows),
+                                         content_type='application/json')
     elif format == 'csv':
-        response = HttpResponse(content_type='text/csv')
-        writer = csv.writer(response)
-        keys = get_keys()
-        writer.writerow(keys)
-        for data in result_data:
-            row = []
-            for k in keys:
-                row.append((u"%s" % _encode(data.get(k, ""))).encode("utf-8"))
-            writer.writerow(row)
+        keys = _export_keys(results, is_staff, survey_slug)
+        response = StreamingHttpResponse(_iter_csv(keys, rows),
+                                         content_type='text/csv')
     elif format == 'xml':
-        doc = Document()
-        submissions = doc.createElement("submissions")
-        doc.appendChild(submissions)
-        for data in result_data:
-            submission = doc.createElement("submission")
-            submissions.appendChild(submission)
-            for key, value in data.items():
-                if value:
-                    cell = doc.createElement(key)
-                    submission.appendChild(cell)
-                    cell.appendChild(doc.createTextNode(u"%s" % value))
-        response = HttpResponse(doc.toxml(), content_type='text/xml')
+        response = StreamingHttpResponse(_iter_xml(rows),
+                                         content_type='text/xml')
     elif format == 'html':  # mostly for debugging.
-        keys = get_keys()
-        results = [
-            "<html><body><table>",
-            "<tr>%s</tr>" % "".join(["<th>%s</th>" % k for k in keys])]
-        for data in result_data:
-            cell = "<td>%s</td>"
-            cells = [cell % _encode(data.get(key, "")) for key in keys]
-            results.append("<tr>%s</tr>" % "".join(cells))
-        results.append("</table></body></html>")
-        response = HttpResponse("\n".join(results))
+        keys = _export_keys(results, is_staff, survey_slug)
+        response = StreamingHttpResponse(_iter_html(keys, rows))
     else:
         return HttpResponse(_("Unsure how to handle %s format") % format)
     return response
 
 
+def _iter_submission_data(results, is_staff, limit=0, chunk_size=500):
+    """ Yield the export data of each submission in results, newest first.
+    Rather than loading every submission and answer at once, page through
+    the submissions chunk_size at a time, ordered on (submitted_at, id) so
+    each chunk picks up right where the last one ended. """
+    results = results.order_by("-submitted_at", "-id")
+    if limit:
+        chunk_size = min(chunk_size, limit)
+    yielded = 0
+    last = None
+    while True:
+        chunk = results
+        if last:
+            chunk = chunk.filter(
+                Q(submitted_at__lt=last.submitted_at) |
+                Q(submitted_at=last.submitted_at, id__lt=last.id))
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        answer_lookup = get_all_answers(chunk,
+                                        include_private_questions=is_staff)
+        for r in chunk:
+            data = r.to_jsondata(answer_lookup,
+                                 include_private_questions=is_staff)
+            data.update(data.pop("data"))
+            yield data
+            yielded += 1
+            if yielded == limit:
+                return
+        last = chunk[-1]
+
+
+def _export_keys(results, is_staff, survey_slug=""):
+    """ The columns for exporting results, from the questions of their surveys
+    rather than from the exported data itself, so that exports can stream. """
+    keys = set(['survey', 'submitted_at', 'featured', 'is_public', 'user'])
+    if is_staff:
+        keys.update(BALLOT_STUFFING_FIELDS)
+    if survey_slug:
+        questions = Question.objects.filter(survey__slug=survey_slug)
+    else:
+        # Not a subquery, since the report filters name the submission table
+        # literally and a subquery would alias it.
+        survey_ids = results.order_by().values_list("survey_id", flat=True)
+        questions = Question.objects.filter(
+            survey__in=list(survey_ids.distinct()))
+    if not is_staff:
+        questions = questions.filter(answer_is_public=True)
+    for question in questions:
+        if question.option_type == OPTION_TYPE_CHOICES.BOOL_LIST:
+            keys.update(question.parsed_options)
+        else:
+            keys.add(question.fieldname)
+    return sorted(keys)
+
+
+class _Echo(object):
+    """ A file-like object that hands back whatever is written to it, so the
+    csv writer can produce one row at a time. """
+
+    def write(self, value):
+        return value
+
+
+def _iter_json(rows):
+    yield "["
+    separator = ""
+    for data in rows:
+        yield separator + dumps(data)
+        separator = ", "
+    yield "]"
+
+
+def _iter_csv(keys, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(keys)
+    for data in rows:
+        row = []
+        for k in keys:
+            row.append((u"%s" % _encode(data.get(k, ""))).encode("utf-8"))
+        yield writer.writerow(row)
+
+
+def _iter_xml(rows):
+    """ Write one <submission> element at a time, handing back the XML
+    written so far, so the memory used doesn't grow with the export. """
+    out = StringIO()
+    xml = XMLGenerator(out, "utf-8")
+
+    def flush():
+        value = out.getvalue()
+        out.seek(0)
+        out.truncate()
+        return value
+
+    xml.startDocument()
+    xml.startElement("submissions", {})
+    yield flush()
+    for data in rows:
+        xml.startElement("submission", {})
+        for key, value in data.items():
+            if value:
+                xml.startElement(key, {})
+                xml.characters(u"%s" % value)
+                xml.endElement(key)
+        xml.endElement("submission")
+        yield flush()
+    xml.endElement("submissions")
+    xml.endDocument()
+    yield flush()
+
+
+def _iter_html(keys, rows):
+    yield "<html><body><table>\n"
+    yield "<tr>%s</tr>\n" % "".join(["<th>%s</th>" % k for k in keys])
+    for data in rows:
+        cell = "<td>%s</td>"
+        cells = [cell % _encode(data.get(key, "")) for key in keys]
+        yield "<tr>%s</tr>\n" % "".join(cells)
+    yield "</table></body></html>"
+
+
 def _encode(possible):
     if possible is True:
         return 1
@@ -535,6 +603,149 @@ def embeded_survey_report(request, slug, report=''):
     return _survey_report(request, slug, report, None, templates)
 
 
+def chart_data(request, slug, display_index, question_id, report=""):
+    """ The data behind one of a report's charts, as JSON, so that the report
+    pages only refer to it. question_id picks the question of a pie chart
+    and is 0 for bar and line charts. The ETag and Last-Modified change with
+    the survey's versions, so browsers and caches can check their copy is
+    current without the aggregate being worked out again. """
+    versions = _chart_versions(slug)
+    if versions is None:
+        raise Http404
+    etag = _chart_etag(request, slug, display_index, question_id, report,
+                       versions)
+    last_modified = _chart_last_modified(versions)
+    response = get_conditional_response(request,
+                                        etag=etag,
+                                        last_modified=last_modified)
+    if response is None:
+        display, question = _chart_display(
+            request, slug, report, int(display_index), int(question_id))
+        results = chart_results(display, question, request.GET,
+                                request.user.is_staff)
+        response = HttpResponse(content_type='application/json')
+        dump({"results": results}, response)
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    # Staff see answers that nobody else does.
+    if request.user.is_staff:
+        patch_cache_control(response, private=True, max_age=0)
+    else:
+        patch_cache_control(response, public=True, max_age=0,
+                            must_revalidate=True)
+    return response
+
+
+def _chart_versions(slug):
+    compiled = get_compiled_survey(slug=slug)
+    if compiled is None:
+        return None
+    survey_id = compiled.survey.pk
+    return survey_version(survey_id), submission_version(survey_id)
+
+
+def _chart_etag(request, slug, display_index, question_id, report, versions):
+    parts = (slug,
+             report,
+             int(display_index),
+             int(question_id),
+             _normalized_get(request.GET, CURSOR_PARAMS),
+             bool(request.user.is_staff),
+             versions)
+    return '"%s"' % hashlib.md5(repr(parts).encode("utf-8")).hexdigest()
+
+
+def _chart_last_modified(versions):
+    # The versions are milliseconds since the epoch when they're bumped.
+    return max(versions) // 1000
+
+
+def _chart_display(request, slug, report, display_index, question_id):
+    """ The report display and, for a pie chart, the question that the chart
+    is of. """
+    survey = _get_survey_or_404(slug, request)
+    is_public = survey.is_live and survey.can_have_public_submissions()
+    if not is_public and not request.user.is_staff:
+        raise Http404
+    if report:
+        report_obj = get_object_or_404(survey.surveyreport_set.all(),
+                                       slug=report)
+    else:
+        report_obj = _default_report(survey)
+    displays = report_obj.get_survey_report_displays()
+    if display_index >= len(displays):
+        raise Http404
+    display = displays[display_index]
+    SDTC = SURVEY_DISPLAY_TYPE_CHOICES
+    if display.display_type == SDTC.PIE:
+        fields = list(survey.get_fields())
+        questions = [q for q in display.questions(fields)
+                     if q.pk == question_id]
+        if not questions:
+            raise Http404
+        return display, questions[0]
+    elif display.display_type in (SDTC.BAR, SDTC.LINE) and not question_id:
+        return display, None
+    raise Http404
+
+
+CHART_RESULTS_KEY = "crowdsourcing_chart_results_%s"
+
+
+def chart_results(display, question, request_get, is_staff=False):
+    """ The rows that the display's chart plots. They're cached under the
+    survey's versions, so the report page, which checks there are some, and
+    the chart data request work them out once between them. """
+    report = display.get_report()
+    survey_id = report.survey.pk
+    parts = (survey_id,
+             report.slug,
+             display.index_in_report(),
+             question.pk if question else 0,
+             _normalized_get(request_get, CURSOR_PARAMS),
+             bool(is_staff),
+             survey_version(survey_id),
+             submission_version(survey_id))
+    digest = hashlib.md5(repr(parts).encode("utf-8")).hexdigest()
+    key = CHART_RESULTS_KEY % digest
+    results = cache.get(key)
+    record_cache(results is not None)
+    if results is None:
+        aggregate = _chart_aggregate(display, question, request_get, is_staff)
+        results = aggregate.answer_values if aggregate else []
+        cache.set(key, results)
+    return results
+
+
+def _chart_aggregate(display, question, request_get, is_staff=False):
+    """ The aggregate result that the display charts: the count of each of
+    question's answers for a pie chart, otherwise the display's y axes
+    against its x axis. None if the axes aren't questions in the survey. """
+    report = display.get_report()
+    if question:
+        return AggregateResultCount(report.survey,
+                                    question,
+                                    request_get,
+                                    report,
+                                    is_staff=is_staff)
+    y_axes = display.questions()
+    x_axis = display.x_axis_question()
+    SATC = SURVEY_AGGREGATE_TYPE_CHOICES
+    if not x_axis or (display.aggregate_type != SATC.COUNT and not y_axes):
+        return None
+    if display.aggregate_type in [SATC.DEFAULT, SATC.SUM]:
+        return AggregateResultSum(y_axes, x_axis, request_get, report)
+    elif display.aggregate_type == SATC.AVERAGE:
+        return AggregateResultAverage(y_axes, x_axis, request_get, report)
+    elif y_axes:
+        return AggregateResult2AxisCount(y_axes, x_axis, request_get, report)
+    return AggregateResultCount(x_axis.survey,
+                                x_axis,
+                                request_get,
+                                report,
+                                is_staff=is_staff)
+
+
 def _survey_report(request, slug, report, page, templates):
     """ Show a report for the survey. As rating is done in a separate
     application we don't directly check request.GET["sort"] here.
@@ -551,6 +762,59 @@ def _survey_report(request, slug, report, page, templates):
     is_public = survey.is_live and survey.can_have_public_submissions()
     if not is_public and not request.user.is_staff:
         raise Http404
+    timeout = crowdsourcing_settings.REPORT_CACHE_TIMEOUT
+    if not timeout:
+        return _render_survey_report(
+            request, survey, report, page, templates, is_public)
+    key = _report_cache_key(request, survey, report, page, templates)
+    cached = cache.get(key)
+    record_cache(cached is not None)
+    if cached is None:
+        response = _render_survey_report(
+            request, survey, report, page, templates, is_public)
+        if response.status_code == httplib.OK:
+            cache.set(key, (response.content, response["Content-Type"]),
+                      timeout)
+        return response
+    content, content_type = cached
+    return HttpResponse(content, content_type=content_type)
+
+
+def _normalized_get(get, ignore=()):
+    return sorted((k, sorted(v)) for k, v in get.lists() if k not in ignore)
+
+
+def _report_cache_key(request, survey, report, page, templates):
+    """ Everything that changes the report page goes into the key, including
+    the versions that change whenever the survey or its submissions do. """
+    get = _normalized_get(request.GET)
+    parts = (survey.pk,
+             report,
+             page,
+             templates[0],
+             get,
+             bool(request.user.is_staff),
+             get_language(),
+             survey_version(survey.pk),
+             submission_version(survey.pk))
+    digest = hashlib.md5(repr(parts).encode("utf-8")).hexdigest()
+    return "crowdsourcing_report_%s" % digest
+
+
+def _report_count_key(request, survey, report):
+    """ The cache key for the number of submissions the report lists, which
+    doesn't depend on the page or the cursor. """
+    parts = (survey.pk,
+             report,
+             _normalized_get(request.GET, CURSOR_PARAMS),
+             bool(request.user.is_staff),
+             submission_version(survey.pk))
+    digest = hashlib.md5(repr(parts).encode("utf-8")).hexdigest()
+    return "crowdsourcing_report_count_%s" % digest
+
+
+def _render_survey_report(request, survey, report, page, templates,
+                          is_public):
     reports = survey.surveyreport_set.all()
     if report:
         report_obj = get_object_or_404(reports, slug=report)
@@ -590,14 +854,22 @@ def _survey_report(request, slug, report, page, templates):
             submissions = submissions.filter(featured=True)
         if report_obj.limit_results_to:
             submissions = submissions[:report_obj.limit_results_to]
-    paginator, page_obj = paginate_or_404(submissions, page)
+    keyset = all([crowdsourcing_settings.KEYSET_PAGINATION,
+                  not crowdsourcing_settings.PRE_REPORT,
+                  not report_obj.limit_results_to])
+    if keyset:
+        count_key = _report_count_key(request, survey, report)
+        paginator, page_obj = paginate_by_keyset_or_404(
+            submissions, page, request.GET, count_key)
+        pages_to_link = pages_to_link_from_keyset_page(page_obj)
+    else:
+        paginator, page_obj = paginate_or_404(submissions, page)
+        pages_to_link = pages_to_link_from_paginator(page, paginator)
 
     page_answers = get_all_answers(
         page_obj.object_list,
         include_private_questions=is_staff)
 
-    pages_to_link = pages_to_link_from_paginator(page, paginator)
-
     display_individual_results = all([
         report_obj.display_individual_results,
         archive_fields or (is_staff and fields)])
@@ -644,6 +916,26 @@ def pages_to_link_from_paginator(page, paginator):
     return [p for p in pages if p != DISCARD]
 
 
+def pages_to_link_from_keyset_page(page_obj):
+    """ Like pages_to_link_from_paginator, but only the pages that keyset
+    pagination reaches without an OFFSET: the first page, and the pages on
+    either side of this one, which the cursors lead to. For example, on page
+    5 of 9, return [1, False, 4, 5, 6, False]. """
+    number = page_obj.number
+    pages = [number]
+    if page_obj.has_previous():
+        pages.insert(0, number - 1)
+    if page_obj.has_next():
+        pages.append(number + 1)
+    if pages[0] > 2:
+        pages = [1, False] + pages
+    elif pages[0] == 2:
+        pages = [1] + pages
+    if pages[-1] < page_obj.paginator.num_pages:
+        pages.append(False)
+    return pages
+
+
 def paginate_or_404(queryset, page, num_per_page=20):
     """
     paginate a queryset (or other iterator) for the given page, returning the
@@ -654,20 +946,340 @@ def paginate_or_404(queryset, page, num_per_page=20):
     paginator = Paginator(queryset, num_per_page)
     try:
         page_obj = paginator.page(page)
-    except EmptyPage, InvalidPage:
+    except (EmptyPage, InvalidPage):
         raise Http404
     return paginator, page_obj
 
 
+CURSOR_PARAMS = ('after', 'before')
+
+CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+
+
+class KeysetPaginator(object):
+    """ Just enough of django.core.paginator.Paginator for the report
+    templates. The count may be out of date as it comes from the cache. """
+
+    def __init__(self, count, per_page, at_least_pages=1):
+        self.count = count
+        self.per_page = per_page
+        pages = int(ceil(count / float(per_page)))
+        self.num_pages = max(1, pages, at_least_pages)
+
+
+class KeysetPage(object):
+    """ A page of submissions, newest first, that knows the cursors for the
+    pages on either side of it. """
+
+    def __init__(self, object_list, number, paginator, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    @property
+    def next_cursor(self):
+        if self.has_next() and self.object_list:
+            return encode_cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous() and self.object_list:
+            return encode_cursor(self.object_list[0])
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(submission):
+    submitted_at = submission.submitted_at
+    if timezone.is_aware(submitted_at):
+        submitted_at = timezone.make_naive(submitted_at, timezone.utc)
+    return "%s_%d" % (submitted_at.strftime(CURSOR_FORMAT), submission.pk)
+
+
+def decode_cursor(cursor):
+    """ Return the (submitted_at, id) in cursor, or raise Http404. """
+    try:
+        submitted_at, pk = cursor.split("_")
+        submitted_at = datetime.strptime(submitted_at, CURSOR_FORMAT)
+        pk = int(pk)
+    except ValueError:
+        raise Http404
+    if settings.USE_TZ:
+        submitted_at = timezone.make_aware(submitted_at, timezone.utc)
+    return submitted_at, pk
+
+
+def paginate_by_keyset_or_404(queryset, page, get, count_key,
+                              num_per_page=20):
+    """
+    Like paginate_or_404 for a queryset of submissions, but rather than an
+    OFFSET, get the page that comes right after the submission in the "after"
+    cursor, or right before the one in the "before" cursor, if either is in
+    get. The total, which only matters for the page links, is cached under
+    count_key.
+    """
+    if page is None:
+        page = 1
+    queryset = queryset.order_by("-submitted_at", "-id")
+    if get.get("after"):
+        submitted_at, pk = decode_cursor(get["after"])
+        rows = queryset.filter(
+            Q(submitted_at__lt=submitted_at) |
+            Q(submitted_at=submitted_at, id__lt=pk))
+        rows = list(rows[:num_per_page + 1])
+        has_next = len(rows) > num_per_page
+    elif get.get("before"):
+        submitted_at, pk = decode_cursor(get["before"])
+        rows = queryset.filter(
+            Q(submitted_at__gt=submitted_at) |
+            Q(submitted_at=submitted_at, id__gt=pk))
+        rows = list(rows.order_by("submitted_at", "id")[:num_per_page])
+        if len(rows) < num_per_page:
+            # These are the newest, so show the whole first page instead.
+            page = 1
+            rows = list(queryset[:num_per_page + 1])
+            has_next = len(rows) > num_per_page
+        else:
+            rows.reverse()
+            # There's at least the submission in the cursor after these.
+            has_next = True
+    else:
+        offset = (page - 1) * num_per_page
+        rows = list(queryset[offset:offset + num_per_page + 1])
+        has_next = len(rows) > num_per_page
+    rows = rows[:num_per_page]
+    if not rows and page != 1:
+        raise Http404
+    count = cache.get(count_key)
+    record_cache(count is not None)
+    if count is None:
+        count = queryset.count()
+        cache.set(count_key, count)
+    paginator = KeysetPaginator(count,
+                                num_per_page,
+                                page + 1 if has_next else page)
+    return paginator, KeysetPage(rows, page, paginator, has_next)
+
+
 def location_question_results(
         request,
         question_id,
         limit_map_answers,
         survey_report_slug=""):
+    question, is_staff, featured, limit_results_to = _location_question(
+        request, question_id, survey_report_slug)
+    points = _map_points(question, is_staff, featured)
+    limit_map_answers = int(limit_map_answers) if limit_map_answers else 0
+    limit = None
+    if limit_map_answers or limit_results_to:
+        limit = min(filter(None, [limit_map_answers, limit_results_to, ]))
+    indexes = range(len(points))
+    if filter_plan(question.survey, request.GET):
+        filtered = extra_from_filters(
+            question.survey.submission_set.all(),
+            Submission.get_id_field(),
+            question.survey,
+            request.GET)
+        indexes = _filtered_point_indexes(points, filtered, limit)
+    indexes = indexes[:limit]
+    url = _id_url_template("submission_for_map")
+    entries = []
+    for i in indexes:
+        d = {
+            "lat": points.latitudes[i],
+            "lng": points.longitudes[i],
+            "url": url % points.submission_ids[i]}
+        if points.icon_indexes[i] >= 0:
+            d["icon"] = points.icons[points.icon_indexes[i]]
+        entries.append(d)
+    response = HttpResponse(content_type='application/json')
+    dump({"entries": entries}, response)
+    return response
+
+
+def _filtered_point_indexes(points, filtered, limit=None, chunk_size=500):
+    """ The indexes of the points whose submissions are in the filtered
+    queryset, up to limit of them. The database checks a chunk of the points'
+    submission ids per query, so only submissions that have points are read
+    back, and it stops once it has enough. """
+    indexes = []
+    submission_ids = points.submission_ids
+    for start in range(0, len(submission_ids), chunk_size):
+        chunk = list(submission_ids[start:start + chunk_size])
+        matched = filtered.order_by().filter(id__in=chunk)
+        matched = set(matched.values_list("id", flat=True))
+        indexes.extend(i for i, submission_id in enumerate(chunk, start)
+                       if submission_id in matched)
+        if limit and len(indexes) >= limit:
+            break
+    return indexes
+
+
+def _id_url_template(view):
+    """ The view's URL with %d where its id goes, to build many of its URLs
+    without reversing each one. """
+    head, tail = reverse(view, kwargs={"id": 0}).rsplit("0", 1)
+    return head.replace("%", "%%") + "%d" + tail.replace("%", "%%")
+
+
+class _MapPoints(object):
+    """ The located answers to a question that a map shows, newest first, as
+    compact arrays that are cheap to cache. An icon index of -1 means the
+    point has no icon. """
+
+    def __init__(self, version):
+        self.version = version
+        self.latitudes = array("d")
+        self.longitudes = array("d")
+        self.submission_ids = array("l")
+        self.icon_indexes = array("h")
+        self.icons = []
+        # The newest answer and submission time seen, to add only what came
+        # after them.
+        self.last_answer_id = 0
+        self.newest = None
+
+    def __len__(self):
+        return len(self.submission_ids)
+
+    def prepend(self, rows, icon_lookup):
+        """ Add (answer id, submission id, latitude, longitude, submitted at)
+        rows, newest first, ahead of the points already here. """
+        if not rows:
+            return
+        latitudes, longitudes = array("d"), array("d")
+        submission_ids, icon_indexes = array("l"), array("h")
+        index_of_icon = dict((icon, i) for i, icon in enumerate(self.icons))
+        for row in rows:
+            answer_id, submission_id, latitude, longitude, submitted_at = row
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+            submission_ids.append(submission_id)
+            icon = icon_lookup.get(submission_id)
+            if icon is None:
+                icon_indexes.append(-1)
+                continue
+            if icon not in index_of_icon:
+                index_of_icon[icon] = len(self.icons)
+                self.icons.append(icon)
+            icon_indexes.append(index_of_icon[icon])
+        self.latitudes = latitudes + self.latitudes
+        self.longitudes = longitudes + self.longitudes
+        self.submission_ids = submission_ids + self.submission_ids
+        self.icon_indexes = icon_indexes + self.icon_indexes
+        self.last_answer_id = max(self.last_answer_id,
+                                  max(row[0] for row in rows))
+        if self.newest is None or rows[0][4] > self.newest:
+            self.newest = rows[0][4]
+
+
+MAP_POINTS_KEY = "crowdsourcing_map_points_%d_%d_%d"
+
+
+def _map_points(question, is_staff, featured):
+    """ The question's map points from the cache. New located answers are
+    added to them as they come. Anything that could move, hide or re-icon a
+    point already there changes the survey's map or survey version, which
+    builds them again. """
+    survey_id = question.survey_id
+    version = (survey_version(survey_id), map_version(survey_id))
+    key = MAP_POINTS_KEY % (question.pk, is_staff, featured)
+    located = _located_answers(question, is_staff, featured)
+    fields = ("id", "submission_id", "latitude", "longitude",
+              "submission__submitted_at")
+    points = cache.get(key)
+    record_cache(points is not None and points.version == version)
+    if points is not None and points.version == version:
+        total = located.count()
+        if total == len(points):
+            return points
+        rows = list(located.filter(id__gt=points.last_answer_id)
+                    .values_list(*fields))
+        # Answers committed out of id order or geocoded late can hide below
+        # last_answer_id, and a submission that came in with an old date
+        # would go in out of order, so start over for those.
+        if total == len(points) + len(rows) and rows[-1][4] >= points.newest:
+            points.prepend(rows, _map_icons(survey_id,
+                                            [row[1] for row in rows]))
+            cache.set(key, points)
+            return points
+    points = _MapPoints(version)
+    rows = list(located.values_list(*fields))
+    points.prepend(rows, _map_icons(survey_id, [row[1] for row in rows]))
+    cache.set(key, points)
+    return points
+
+
+def _map_icons(survey_id, submission_ids, chunk_size=500):
+    """ Map each of the submissions that answered one of the survey's icon
+    questions with an option that has an icon to that icon. Only the
+    submissions' own answers are read, a chunk of ids per query to stay
+    under the databases' limits on query parameters. """
+    icon_questions = _icons_by_answer(survey_id)
+    if not icon_questions or not submission_ids:
+        return {}
+    columns = sorted(set(q.value_column for q, _ in icon_questions))
+    found = {}
+    for i in range(0, len(submission_ids), chunk_size):
+        answers = Answer.objects.filter(
+            question__in=[q for q, _ in icon_questions],
+            submission__in=submission_ids[i:i + chunk_size])
+        answers = answers.order_by().values_list("question_id",
+                                                 "submission_id",
+                                                 *columns)
+        for row in answers:
+            found[(row[0], row[1])] = row[2:]
+    # Later icon questions win, as they always have.
+    icon_lookup = {}
+    for icon_question, by_answer in icon_questions:
+        column = columns.index(icon_question.value_column)
+        for submission_id in submission_ids:
+            row = found.get((icon_question.id, submission_id))
+            if row and row[column] in by_answer:
+                icon_lookup[submission_id] = by_answer[row[column]]
+    return icon_lookup
+
+
+def _icons_by_answer(survey_id):
+    """ A (question, {option: icon}) pair for each of the survey's icon
+    questions that has any icons, in order. """
+    survey = get_compiled_survey(survey_id=survey_id).get_survey()
+    pairs = []
+    for icon_question in survey.icon_questions():
+        by_answer = dict(
+            (option, icon)
+            for option, icon in icon_question.parsed_option_icon_pairs()
+            if icon)
+        if by_answer:
+            pairs.append((icon_question, by_answer))
+    return pairs
+
+
+def _location_question(request, question_id, survey_report_slug):
+    """ The question whose map it is, whether the user sees the non-public
+    submissions, whether the report shows only the featured ones, and the
+    report's limit_results_to. """
     question = get_object_or_404(Question.objects.select_related("survey"),
                                  pk=question_id,
                                  answer_is_public=True)
-    is_staff = request.user.is_staff
+    is_staff = bool(request.user.is_staff)
     if not question.survey.can_have_public_submissions() and not is_staff:
         raise Http404
     featured = limit_results_to = False
@@ -677,51 +1289,131 @@ def location_question_results(
                                           slug=survey_report_slug)
         featured = survey_report.featured
         limit_results_to = survey_report.limit_results_to
-    icon_lookup = {}
-    icon_questions = question.survey.icon_questions()
-    for icon_question in icon_questions:
-        icon_by_answer = {}
-        for (option, icon) in icon_question.parsed_option_icon_pairs():
-            if icon:
-                icon_by_answer[option] = icon
-        answer_set = icon_question.answer_set.all()
-        for answer in answer_set.select_related("question"):
-            if answer.value in icon_by_answer:
-                icon = icon_by_answer[answer.value]
-                icon_lookup[answer.submission_id] = icon
+    return question, is_staff, bool(featured), limit_results_to
+
 
+def _located_answers(question, is_staff, featured):
     answers = question.answer_set.filter(
         ~Q(latitude=None),
-        ~Q(longitude=None)).order_by("-submission__submitted_at")
+        ~Q(longitude=None)).order_by("-submission__submitted_at", "-id")
     if not is_staff:
         answers = answers.filter(submission__is_public=True)
     if featured:
         answers = answers.filter(submission__featured=True)
+    return answers
+
+
+def _location_answers(request, question_id, survey_report_slug, filters):
+    """ The question, the located answers to it that its map shows, newest
+    first, and the report's limit_results_to. """
+    question, is_staff, featured, limit_results_to = _location_question(
+        request, question_id, survey_report_slug)
     answers = extra_from_filters(
-        answers,
-        "submission_id",
+        _located_answers(question, is_staff, featured),
+        "crowdsourcing_answer.submission_id",
         question.survey,
-        request.GET)
-    limit_map_answers = int(limit_map_answers) if limit_map_answers else 0
-    if limit_map_answers or limit_results_to:
-        answers = answers[:min(filter(None, [limit_map_answers,
-                                             limit_results_to, ]))]
+        filters)
+    return question, answers, limit_results_to
+
+
+class _Floor(Func):
+    """ FLOOR, which SQLite doesn't have. Map cells are only ever numbered
+    from zero up, so truncating to an integer does the same there. """
+    function = "FLOOR"
+
+    def as_sqlite(self, compiler, connection):
+        return self.as_sql(compiler,
+                           connection,
+                           template="CAST(%(expressions)s AS INTEGER)")
+
+
+CLUSTER_PARAMS = ("bbox", "zoom")
+
+MAX_CLUSTER_ZOOM = 22
+
+
+def location_question_clusters(request, question_id, survey_report_slug=""):
+    """ The located answers to the question inside the bbox parameter, which
+    is west,south,east,north in degrees, grouped into the cells of a grid
+    that doubles in resolution at each level of the zoom parameter. Each
+    cell has the number of answers in it, their centroid, and the most
+    common map icon among them. A cell with a single answer also has the
+    URL of its submission. Other parameters filter the answers the way they
+    filter reports. """
+    try:
+        west, south, east, north = [
+            float(v) for v in request.GET["bbox"].split(",")]
+        zoom = int(request.GET.get("zoom", 0))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest(
+            "bbox must be west,south,east,north and zoom a whole number.",
+            content_type="text/plain")
+    zoom = min(max(zoom, 0), MAX_CLUSTER_ZOOM)
+    filters = request.GET.copy()
+    for key in CLUSTER_PARAMS:
+        filters.pop(key, None)
+    question, answers, _ = _location_answers(
+        request, question_id, survey_report_slug, filters)
+    size = 360.0 / 2 ** zoom / crowdsourcing_settings.MAP_CLUSTER_CELLS
+    if west <= east:
+        in_box = Q(longitude__gte=west, longitude__lte=east)
+    else:
+        # The box crosses the 180th meridian.
+        in_box = Q(longitude__gte=west) | Q(longitude__lte=east)
+    # Number the cells of one grid for the whole world so that they don't
+    # move around as the map pans.
+    answers = answers.filter(in_box,
+                             latitude__gte=south,
+                             latitude__lte=north)
+    answers = answers.order_by().annotate(
+        cell_x=_Floor((F("longitude") + 180.0) / size),
+        cell_y=_Floor((F("latitude") + 90.0) / size))
+    cells = answers.values("cell_x", "cell_y").annotate(
+        count=Count("id"),
+        lat=Avg("latitude"),
+        lng=Avg("longitude"),
+        submission_id=Min("submission_id"))
+    icons = _cluster_icons(question.survey_id, answers)
     entries = []
-    view = "crowdsourcing.views.submission_for_map"
-    for answer in answers:
-        kwargs = {"id": answer.submission_id}
-        d = {
-            "lat": answer.latitude,
-            "lng": answer.longitude,
-            "url": reverse(view, kwargs=kwargs)}
-        if answer.submission_id in icon_lookup:
-            d["icon"] = icon_lookup[answer.submission_id]
-        entries.append(d)
+    for cell in cells:
+        entry = {"lat": cell["lat"],
+                 "lng": cell["lng"],
+                 "count": cell["count"]}
+        icon = icons.get((int(cell["cell_x"]), int(cell["cell_y"])))
+        if icon:
+            entry["icon"] = icon
+        if 1 == cell["count"]:
+            kwargs = {"id": cell["submission_id"]}
+            entry["url"] = reverse("submission_for_map", kwargs=kwargs)
+        entries.append(entry)
     response = HttpResponse(content_type='application/json')
-    dump({"entries": entries}, response)
+    dump({"entries": entries, "zoom": zoom}, response)
     return response
 
 
+def _cluster_icons(survey_id, answers):
+    """ Map each (cell_x, cell_y) of answers, which are annotated with their
+    cells, to the most common icon of the survey's last icon question among
+    the cell's submissions. """
+    icon_questions = _icons_by_answer(survey_id)
+    if not icon_questions:
+        return {}
+    icon_question, by_answer = icon_questions[-1]
+    value = Answer.objects.filter(question=icon_question,
+                                  submission=OuterRef("submission"))
+    value = value.order_by().values(icon_question.value_column)[:1]
+    counts = answers.annotate(icon_value=Subquery(value))
+    counts = counts.values("cell_x", "cell_y", "icon_value")
+    counts = counts.annotate(count=Count("id"))
+    best = {}
+    for row in counts:
+        icon = by_answer.get(row["icon_value"])
+        cell = (int(row["cell_x"]), int(row["cell_y"]))
+        if icon and row["count"] > best.get(cell, (0, None))[0]:
+            best[cell] = (row["count"], icon)
+    return dict((cell, icon) for cell, (_, icon) in best.items())
+
+
 def location_question_map(
         request,
         question_id,
@@ -31,7 +31,7 @@ function loadMapsAndCharts() {
     };
     if (!yahooChartAPILoaded) {
       var loader = new YAHOO.util.YUILoader({
-        require: ["charts"],
+        require: ["charts", "connection", "json"],
         onSuccess: onAPILoaded,
         combine: true
       });
@@ -19,6 +19,9 @@ setup(name='django-crowdsourcing',
       author='Jacob Smullyan, Dave Smith',
       author_email='jsmullyan@gmail.com',
       url='http://code.google.com/p/django-crowdsourcing/',
-      packages=['crowdsourcing', 'crowdsourcing.templatetags'],
+      packages=['crowdsourcing',
+                'crowdsourcing.management',
+                'crowdsourcing.management.commands',
+                'crowdsourcing.templatetags'],
       license='MIT',
       )